@@ -0,0 +1,215 @@
+import os
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.http.response import HttpResponse, FileResponse, Http404
+from django.utils.module_loading import import_string
+from .cleanup import remove_files
+from .models import CaptchaImage
+from .rendering import renderer
+from .utils import encode_solution
+
+
+class DatabaseBackend(object):
+    """
+    Stores each captcha as a CaptchaImage, with its image in the default
+      storage. This is the default backend, and the only one using the
+      pre-rendered pool.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._served = deque()
+
+    @property
+    def sendfile_grace(self):
+        return getattr(settings, 'CAPTCHA_SENDFILE_GRACE', 10)
+
+    def _remove_served(self):
+        # Removes the files sent by the web server long enough ago.
+        current = time.time()
+        expired = []
+        with self._lock:
+            while self._served and self._served[0][0] <= current:
+                expired.append(self._served.popleft()[1])
+        remove_files(expired)
+
+    def generate(self, salt):
+        """
+        Creates a captcha for the given salt.
+        :param salt: The salt of the captcha field.
+        :return: The key of the new captcha.
+        """
+
+        return CaptchaImage.generate(salt).key
+
+    def respond(self, key):
+        """
+        Builds a response with the captcha's image, and discards it. The
+          stored PNG is sent as is: with CAPTCHA_SENDFILE set to
+          'x-accel-redirect' (nginx) or 'x-sendfile' (apache), the web
+          server sends it, and it is removed CAPTCHA_SENDFILE_GRACE
+          seconds later (by a later response: the files of a process
+          stopped meanwhile are left to `reapcaptchas --orphans`);
+          otherwise it is streamed from an open file, so it can be
+          removed right away.
+        :param key: The key of the captcha.
+        :return: The response.
+        """
+
+        sendfile = getattr(settings, 'CAPTCHA_SENDFILE', None)
+        if sendfile:
+            self._remove_served()
+
+        name = CaptchaImage.pop(key)
+        if name is None:
+            raise Http404
+
+        if sendfile:
+            # The web server reads the file after we are done.
+            with self._lock:
+                self._served.append((time.time() + self.sendfile_grace, name))
+            response = HttpResponse(content_type='image/png')
+            if sendfile == 'x-accel-redirect':
+                response['X-Accel-Redirect'] = getattr(settings, 'CAPTCHA_SENDFILE_PREFIX', '/protected/') + name
+            else:
+                response['X-Sendfile'] = default_storage.path(name)
+            return response
+
+        try:
+            path = default_storage.path(name)
+        except NotImplementedError:
+            # Remote storages: the content must be read before deleting it.
+            with default_storage.open(name) as image:
+                content = image.read()
+            default_storage.delete(name)
+            return HttpResponse(content, content_type='image/png')
+        # An open file can still be read after being removed.
+        image = open(path, 'rb')
+        os.remove(path)
+        return FileResponse(image, content_type='image/png')
+
+
+class InMemoryBackend(object):
+    """
+    Base for the backends keeping the rendered PNG content in memory,
+      so there is neither a database row nor a file for a captcha.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'CAPTCHA_TIMEOUT', 300)
+
+    def add(self, key, content):
+        """
+        Stores the content, unless the key is already in use.
+        :return: Whether the content was stored.
+        """
+
+        raise NotImplementedError
+
+    def pop(self, key):
+        """
+        Takes the content out of the store.
+        :return: The content, or None if not found (or expired).
+        """
+
+        raise NotImplementedError
+
+    def generate(self, salt):
+        for _ in range(self.MAX_ATTEMPTS):
+            solution, content = renderer.render()
+            key = encode_solution(salt, solution)
+            if self.add(key, content):
+                return key
+        raise RuntimeError('Could not find an unused captcha key')
+
+    def respond(self, key):
+        content = self.pop(key)
+        if content is None:
+            raise Http404
+        return HttpResponse(content, content_type='image/png')
+
+
+class CacheBackend(InMemoryBackend):
+    """
+    Keeps the captchas in the CAPTCHA_CACHE cache (by default, the
+      'default' one) for CAPTCHA_TIMEOUT seconds. With a shared cache
+      (e.g. memcached) every process can serve every captcha.
+    """
+
+    PREFIX = 'captcha:'
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'CAPTCHA_CACHE', 'default')]
+
+    def add(self, key, content):
+        return self.cache.add(self.PREFIX + key, content, self.timeout)
+
+    def pop(self, key):
+        # Getting and deleting are two operations: concurrent requests
+        #   first claim the key (add is atomic), so only one gets it.
+        cache = self.cache
+        claim = self.PREFIX + 'claim:' + key
+        if not cache.add(claim, 1, self.timeout):
+            return None
+        try:
+            content = cache.get(self.PREFIX + key)
+            if content is not None:
+                cache.delete(self.PREFIX + key)
+            return content
+        finally:
+            cache.delete(claim)
+
+
+class LocalMemoryBackend(InMemoryBackend):
+    """
+    Keeps the captchas in a bounded LRU dictionary of this process, for
+      CAPTCHA_TIMEOUT seconds and up to CAPTCHA_MEMORY_SIZE of them.
+      Only useful with a single process (or sticky sessions), since the
+      image must be fetched from the process which rendered it.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'CAPTCHA_MEMORY_SIZE', 1000)
+
+    def add(self, key, content):
+        now = time.time()
+        with self._lock:
+            if key in self._entries and self._entries[key][0] > now:
+                return False
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.timeout, content)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return True
+
+    def pop(self, key):
+        with self._lock:
+            expires, content = self._entries.pop(key, (0, None))
+        return content if expires > time.time() else None
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Gets the backend set in CAPTCHA_BACKEND (by default, the database one).
+    """
+
+    global _backend
+    if _backend is None:
+        _backend = import_string(getattr(settings, 'CAPTCHA_BACKEND', 'captcha.backends.DatabaseBackend'))()
+    return _backend
@@ -0,0 +1,75 @@
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils.timezone import now
+from .models import CaptchaImage, CaptchaPoolImage
+
+
+def ttl():
+    """
+    Seconds a captcha lives, unless fetched and solved before
+      (CAPTCHA_TTL, by default one hour).
+    """
+
+    return getattr(settings, 'CAPTCHA_TTL', 3600)
+
+
+def remove_files(names):
+    """
+    Removes a batch of captcha files from the storage, ignoring the ones
+      already gone.
+    """
+
+    for name in names:
+        try:
+            os.remove(default_storage.path(name))
+        except NotImplementedError:
+            default_storage.delete(name)
+        except OSError:
+            pass
+
+
+def reap_expired(chunk_size=1000):
+    """
+    Deletes the captchas older than the TTL, and their files, in chunks.
+      Rows are deleted with a single query per chunk instead of one per
+      object, so the post_delete cleanup does not run: files are removed
+      afterwards, in a single pass per chunk.
+    :param chunk_size: How many captchas are deleted per query.
+    :return: The number of deleted captchas.
+    """
+
+    expired = CaptchaImage.objects.filter(created_on__lt=now() - timedelta(seconds=ttl())).order_by('pk')
+    deleted = 0
+    while True:
+        rows = list(expired.values_list('pk', 'image')[:chunk_size])
+        if not rows:
+            return deleted
+        CaptchaImage.delete_rows('id', [pk for pk, _ in rows])
+        remove_files([name for _, name in rows])
+        deleted += len(rows)
+
+
+def sweep_orphan_files():
+    """
+    Removes the files, older than the TTL, which no captcha (nor pooled
+      one) refers to. These are left by processes stopped before removing
+      the files of their sendfile responses, or between a file write and
+      its row insert.
+    :return: The number of removed files.
+    """
+
+    directory = CaptchaImage._meta.get_field('image').upload_to
+    if not default_storage.exists(directory):
+        return 0
+    horizon = now() - timedelta(seconds=ttl())
+    in_use = set(CaptchaImage.objects.values_list('image', flat=True))
+    in_use.update(CaptchaPoolImage.objects.values_list('image', flat=True))
+    orphans = []
+    for filename in default_storage.listdir(directory)[1]:
+        name = '%s/%s' % (directory, filename)
+        if name not in in_use and default_storage.get_modified_time(name) < horizon:
+            orphans.append(name)
+    remove_files(orphans)
+    return len(orphans)
@@ -1,80 +1,15 @@
-from threading import local
 from uuid import uuid4
-from django import VERSION
-from django.conf import settings
-from django.utils.module_loading import import_string
-from django.core.exceptions import ImproperlyConfigured
 from django.utils.translation import ugettext_lazy as _
 from django.forms.fields import MultiValueField, CharField, ValidationError
 from django.forms.widgets import MultiWidget, HiddenInput, TextInput
 from captcha.utils import encode_solution
-from .models import CaptchaImage
+from .backends import get_backend
+from .middleware import get_current_request
 
 
-CURRENT = local()
 BASE_SESSION_KEY = 'HumanCheck'
 
 
-def _middleware_call_wrapper(method):
-    # Notes: There will ALWAYS be a method,
-    #   since the method is __call__ and, if not
-    #   available, we have more stuff to care
-    #   about than this wrapper breaking into pieces.
-    def wrapped(self, request):
-        CURRENT.request = request
-        result = method(self, request)
-        del CURRENT.request
-        return result
-    return wrapped
-
-
-def _middleware_process_request_wrapper(method):
-    if method is None:
-        def wrapped(self, request):
-            CURRENT.request = request
-            return None
-    else:
-        def wrapped(self, request):
-            CURRENT.request = request
-            return method(self, request)
-    return wrapped
-
-
-def _middleware_process_response_wrapper(method):
-    if method is None:
-        def wrapped(self, request, response):
-            del CURRENT.request
-            return response
-    else:
-        def wrapped(self, request, response):
-            response = method(self, request, response)
-            del CURRENT.request
-            return response
-    return wrapped
-
-
-# TODO fix it to an actual condition when a version is released
-# TODO where MIDDLEWARE_CLASSES is not allowed anymore.
-MIDDLEWARE_CLASSES_STILL_ALLOWED = True
-MIDDLEWARE_NOT_SPECIFIED = settings.MIDDLEWARE is None
-MIDDLEWARE_NOT_AVAILABLE = VERSION[0:2] <= (1, 10)
-
-
-if MIDDLEWARE_CLASSES_STILL_ALLOWED and (MIDDLEWARE_NOT_SPECIFIED or MIDDLEWARE_NOT_AVAILABLE):
-    if not settings.MIDDLEWARE_CLASSES:
-        raise ImproperlyConfigured('What the actual fuck are you doing? No middleware is configured '
-                                   'under MIDDLEWARE_CLASSES')
-    first_mw = import_string(settings.MIDDLEWARE_CLASSES[0])
-    first_mw.process_request = _middleware_process_request_wrapper(getattr(first_mw, 'process_request', None))
-    first_mw.process_response = _middleware_process_response_wrapper(getattr(first_mw, 'process_response', None))
-else:
-    if not settings.MIDDLEWARE:
-        raise ImproperlyConfigured('What the actual fuck are you doing? No middleware is configured '
-                                   'under MIDDLEWARE')
-    first_mw = import_string(settings.MIDDLEWARE[0])
-    first_mw.__call__ = _middleware_call_wrapper(first_mw.__call__)
-
-
 class CaptchaWidget(MultiWidget):
 
     template_name = 'captcha/widget.html'
@@ -93,8 +28,8 @@ class CaptchaWidget(MultiWidget):
           the generated captcha.
         """
         salt = attrs.pop('salt')
-        key = CaptchaImage.generate(salt).key
-        CURRENT.request.session[BASE_SESSION_KEY + salt] = key
+        key = get_backend().generate(salt)
+        get_current_request().session[BASE_SESSION_KEY + salt] = key
         value = [key, '']
         context = super(CaptchaWidget, self).get_context(name, value, attrs)
         context.update({
@@ -117,7 +52,7 @@ class CaptchaField(MultiValueField):
         # Also, the field must exist in user's session, so the user can never
         #   use a replay attack against the captcha.
         encoded = encode_solution(self._salt, value[1])
-        if value[0] != encoded or CURRENT.request.session.get(BASE_SESSION_KEY + self._salt) != encoded:
+        if value[0] != encoded or get_current_request().session.get(BASE_SESSION_KEY + self._salt) != encoded:
             raise ValidationError(_('Security code was not entered properly, or has expired.'))
 
     def __init__(self, *args, **kwargs):
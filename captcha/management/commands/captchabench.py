@@ -0,0 +1,117 @@
+import os
+import random
+import time
+from io import BytesIO
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from PIL import Image, ImageDraw, ImageFont
+from captcha import rendering
+from captcha.backends import DatabaseBackend
+from captcha.models import CaptchaImage, image_file
+from captcha.rendering import renderer
+
+
+# Python 2 has no process_time, but its clock measures CPU time (on unix).
+cpu_time = getattr(time, 'process_time', time.clock if hasattr(time, 'clock') else time.time)
+
+
+def render_uncached():
+    """
+    The rendering as it was before CaptchaRenderer: fonts and background
+      loaded on each call, and one mask and composite per glyph. Kept
+      only as the baseline of this benchmark.
+    """
+
+    solution = ''.join(random.choice(rendering.SOLUTION_CHARS) for _ in range(rendering.SOLUTION_LENGTH))
+    bg_image = Image.open(rendering.BACKGROUND_PATH)
+    offset = rendering.BASE_TEXT_OFFSET
+
+    for character in solution:
+        font_file = os.path.join(rendering.BASE_FONT_PATH, random.choice(rendering.FONTS))
+        font = ImageFont.truetype(font_file, random.randrange(rendering.FONT_MIN, rendering.FONT_MAX))
+
+        ch_image = Image.new('L', font.getsize(' %s ' % character), '#000000')
+        draw = ImageDraw.Draw(ch_image)
+        draw.text((0, 0), ' %s ' % character, font=font, fill='#ffffff')
+        ch_image = ch_image.rotate(random.randrange(rendering.ROTATION_MIN, rendering.ROTATION_MAX),
+                                   expand=1, resample=Image.BILINEAR)
+        ch_image = ch_image.crop(ch_image.getbbox())
+
+        mk_image = Image.new('L', rendering.BACKGROUND_SIZE)
+        ypos = random.randrange(rendering.YPOS_MIN, rendering.YPOS_MAX)
+        mk_image.paste(ch_image, (offset, ypos, ch_image.size[0] + offset, ch_image.size[1] + ypos))
+
+        fg_image = Image.new('RGBA', rendering.BACKGROUND_SIZE, rendering.FOREGROUND_COLOR)
+        bg_image = Image.composite(fg_image, bg_image, mk_image)
+
+        offset += ch_image.size[0] + random.randrange(rendering.OFFSET_MIN, rendering.OFFSET_MAX)
+
+    img_io = BytesIO()
+    bg_image.save(img_io, format='PNG')
+    return solution, img_io.getvalue()
+
+
+def serve_reencoded(key):
+    """
+    The serving as it was before streaming: the captcha is fetched, its
+      image decoded and encoded again into the response, and then the
+      captcha is deleted (its file, by the post_delete cleanup). Kept
+      only as the baseline of this benchmark.
+    """
+
+    instance = CaptchaImage.objects.get(key=key)
+    response = HttpResponse(content_type='image/png')
+    Image.open(instance.image).save(response, 'PNG')
+    instance.delete()
+    return response
+
+
+def consume(response):
+    # Reads the whole body, as the web server would.
+    if response.streaming:
+        b''.join(response.streaming_content)
+    response.close()
+
+
+class Command(BaseCommand):
+    """
+    Compares the captchas per second of the uncached rendering and the
+      CaptchaRenderer, and the CPU time render_once spends per image when
+      re-encoding it with PIL versus streaming the stored file through
+      the database backend. The latter inserts (and serves, so deletes)
+      real captchas: run it against a development database.
+    """
+
+    help = 'Benchmarks captcha rendering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='How many captchas to render per engine')
+
+    def cpu_per_response(self, respond, count):
+        content = renderer.render()[1]
+        keys = [CaptchaImage.create('bench-%d-%d' % (os.getpid(), index), image_file(content)).key
+                for index in range(count)]
+        started = cpu_time()
+        for key in keys:
+            consume(respond(key))
+        return (cpu_time() - started) / count
+
+    def measure(self, render, count):
+        started = time.time()
+        for _ in range(count):
+            render()
+        return count / (time.time() - started)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        # Warm the caches up, so only the steady state is measured.
+        renderer.render()
+        before = self.measure(render_uncached, count)
+        after = self.measure(renderer.render, count)
+        self.stdout.write('uncached: %.1f captchas/s' % before)
+        self.stdout.write('cached:   %.1f captchas/s (x%.2f)' % (after, after / before))
+
+        reencoded = self.cpu_per_response(serve_reencoded, count)
+        streamed = self.cpu_per_response(DatabaseBackend().respond, count)
+        self.stdout.write('render_once, re-encoding: %.3f ms CPU per image' % (reencoded * 1000))
+        self.stdout.write('render_once, streaming:   %.3f ms CPU per image' % (streamed * 1000))
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from captcha.pool import captcha_pool
+
+
+class Command(BaseCommand):
+    """
+    Fills the captcha pool up to CAPTCHA_POOL_SIZE. With --loop it keeps
+      doing so, which allows refilling the pool from a separate process
+      (and setting CAPTCHA_POOL_WORKER = False in the web processes).
+    """
+
+    help = 'Pre-renders captchas until the pool is full'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep refilling the pool every CAPTCHA_POOL_INTERVAL seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            refilled = captcha_pool.refill()
+            if not options['loop']:
+                self.stdout.write('Rendered %d captchas' % refilled)
+                return
+            time.sleep(captcha_pool.interval)
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from captcha.cleanup import reap_expired, sweep_orphan_files
+
+
+class Command(BaseCommand):
+    """
+    Deletes the captchas (and files) older than CAPTCHA_TTL. Meant to be
+      run periodically (or with --loop, as a separate process) so the
+      table and the directory stay bounded under bot traffic.
+    """
+
+    help = 'Deletes the expired captchas and their files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='How many captchas are deleted per query')
+        parser.add_argument('--orphans', action='store_true', default=False,
+                            help='Also remove old files no captcha refers to')
+        parser.add_argument('--loop', type=int, default=0, metavar='SECONDS',
+                            help='Keep reaping, every this amount of seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            self.stdout.write('Reaped %d captchas' % reap_expired(options['chunk_size']))
+            if options['orphans']:
+                self.stdout.write('Removed %d orphan files' % sweep_orphan_files())
+            if not options['loop']:
+                return
+            time.sleep(options['loop'])
@@ -0,0 +1,62 @@
+from threading import local
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    class ContextVar(object):
+        """
+        Minimal stand-in for Python < 3.7: a thread-local value with the
+          same set/reset interface (it is not asyncio-aware, of course).
+        """
+
+        def __init__(self, name, default=None):
+            self._local = local()
+            self._default = default
+
+        def get(self):
+            return getattr(self._local, 'value', self._default)
+
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            self._local.value = token
+
+
+CURRENT_REQUEST = ContextVar('captcha_current_request', default=None)
+
+
+class CaptchaRequestMiddleware(object):
+    """
+    Makes the current request available to the captcha fields and
+      widgets, which need its session. The request is kept in a context
+      variable and is always released when the response is done, even
+      on errors. Before Python 3.7 the variable is a thread-local one,
+      which covers threaded and (monkey-patched) gevent workers, but not
+      asyncio ones: Django 1.11 has no asynchronous handler anyway.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = CURRENT_REQUEST.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            CURRENT_REQUEST.reset(token)
+
+
+def get_current_request():
+    """
+    Gets the request being processed.
+    """
+
+    request = CURRENT_REQUEST.get()
+    if request is None:
+        raise ImproperlyConfigured('Captcha fields need captcha.middleware.CaptchaRequestMiddleware '
+                                   'to be installed, and can only be used while serving a request')
+    return request
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('captcha', '0002_auto_20171030_0217'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaptchaPoolImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.ImageField(editable=False, upload_to='captcha')),
+                ('solution', models.CharField(editable=False, max_length=6)),
+            ],
+        ),
+    ]
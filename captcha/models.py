@@ -1,29 +1,23 @@
-from django.db import models
+from django.db import models, connections, transaction, IntegrityError
 from django.core.files.base import ContentFile
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
-from django.utils.six import StringIO
-from PIL import Image, ImageFont, ImageDraw
+from django.utils.timezone import now
+from .rendering import SOLUTION_LENGTH, renderer
+from .signals import captcha_generated
 from .utils import encode_solution
-import random
+from uuid import uuid4
 import os
+import time
 
 
-SOLUTION_LENGTH = 6
-SOLUTION_CHARS = 'abcdefhkmnprtuvwxyABCDEFGHJKLMNPRTUVWXY3468'
-BACKGROUND_SIZE = (180, 40)
-BACKGROUND_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'images', 'background.png')
-BASE_FONT_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'fonts')
-FONTS = ['DejaVuSans.ttf', 'DejaVuSansMono.ttf', 'DejaVuSerif.ttf']
-FONT_MIN = 30
-FONT_MAX = 35
-BASE_TEXT_OFFSET = 7
-OFFSET_MIN = -2
-OFFSET_MAX = 8
-ROTATION_MIN = -30
-ROTATION_MAX = 31
-YPOS_MIN = 8
-YPOS_MAX = 12
+def image_file(content):
+    """
+    Wraps a rendered captcha as a file to be saved. The name is random
+      (the solution must not be guessable from the url).
+    """
+
+    return ContentFile(content, '%s.png' % uuid4().hex)
 
 
 class CaptchaImage(models.Model):
@@ -32,51 +26,147 @@ class CaptchaImage(models.Model):
     """
     image = models.ImageField(upload_to='captcha', null=False, editable=False)
     key = models.CharField(max_length=40, null=False, editable=False, unique=True)
+    created_on = models.DateTimeField(default=now, null=False, editable=False, db_index=True)
+
+    MAX_ATTEMPTS = 5
+
+    @staticmethod
+    def render():
+        """
+        Renders a new random captcha.
+        :return: A (solution, png image content) tuple.
+        """
+
+        return renderer.render()
 
     @staticmethod
     def generate(salt):
-        # Get a solution not being used right now
-        while True:
-            solution = ''.join(random.choice(SOLUTION_CHARS) for _ in range(SOLUTION_LENGTH))
-            key = encode_solution(salt, solution)
-            try:
-                CaptchaImage.objects.get(key=key)
-            except CaptchaImage.DoesNotExist:
-                break
-
-        bg_image = Image.open(BACKGROUND_PATH)
-        offset = BASE_TEXT_OFFSET
-
-        for character in solution:
-            # Random font
-            font_file = os.path.join(BASE_FONT_PATH, random.choice(FONTS))
-            font = ImageFont.truetype(font_file, random.randrange(FONT_MIN, FONT_MAX))
-
-            # Text image
-            ch_image = Image.new('L', font.getsize(' %s ' % character), '#000000')
-            draw = ImageDraw.Draw(ch_image)
-            draw.text((0,0), ' %s ' % character, font=font, fill='#ffffff')
-            ch_image = ch_image.rotate(random.randrange(ROTATION_MIN, ROTATION_MAX),
-                                       expand=1, resample=Image.BILINEAR)
-            ch_image = ch_image.crop(ch_image.getbbox())
-
-            # Mask image
-            mk_image = Image.new('L', BACKGROUND_SIZE)
-            ypos = random.randrange(YPOS_MIN, YPOS_MAX)
-            mk_image.paste(ch_image, (offset, ypos, ch_image.size[0] + offset, ch_image.size[1] + ypos))
-
-            # Pasting image
-            fg_image = Image.new('RGBA', BACKGROUND_SIZE, '#a6a6a6')
-            bg_image = Image.composite(fg_image, bg_image, mk_image)
-
-            # Changing offset
-            offset += ch_image.size[0] + random.randrange(OFFSET_MIN, OFFSET_MAX)
-
-        # Now we have bg_image and solution, we save it and return it.
-        img_io = StringIO()
-        bg_image.save(img_io, format='PNG')
-        fn_image = ContentFile(img_io.getvalue(), '%s.jpg' % solution)
-        return CaptchaImage.objects.create(key=key, image=fn_image)
+        """
+        Creates a captcha for the given salt. It is taken from the pool
+          when CAPTCHA_POOL_SIZE is set and the pool is not empty, and
+          rendered right now otherwise (up to MAX_ATTEMPTS times, if the
+          keys are in use). Sends captcha_generated.
+        """
+
+        from .pool import captcha_pool
+
+        started = time.time()
+        captcha, source = None, 'pool'
+        if captcha_pool.enabled:
+            captcha = captcha_pool.claim(salt)
+        if captcha is None:
+            source = 'rendered'
+            for _ in range(CaptchaImage.MAX_ATTEMPTS):
+                solution, content = CaptchaImage.render()
+                captcha = CaptchaImage.create(encode_solution(salt, solution), image_file(content))
+                if captcha is not None:
+                    break
+            else:
+                raise RuntimeError('Could not find an unused captcha key')
+        captcha_generated.send(sender=CaptchaImage, captcha=captcha, source=source, seconds=time.time() - started)
+        return captcha
+
+    @staticmethod
+    def create(key, image):
+        """
+        Inserts a captcha, relying on the unique index to detect a key
+          already in use (instead of checking it beforehand).
+        :param key: The key of the captcha.
+        :param image: The image file (or the name of an already saved one).
+        :return: The new captcha, or None if the key was in use (the
+          image is discarded in that case). Other integrity errors are
+          raised.
+        """
+
+        captcha = CaptchaImage(key=key, image=image)
+        try:
+            with transaction.atomic():
+                captcha.save()
+        except IntegrityError:
+            captcha.image.delete(save=False)
+            if CaptchaImage.objects.filter(key=key).exists():
+                return None
+            # Not a key collision.
+            raise
+        return captcha
+
+    @staticmethod
+    def pop(key):
+        """
+        Deletes the captcha with the given key, in a single query where the
+          database supports DELETE ... RETURNING. The post_delete cleanup
+          is not triggered: the caller takes care of the file.
+        :param key: The key of the captcha.
+        :return: The name of its image, or None if there was no such captcha.
+        """
+
+        connection = connections[CaptchaImage.objects.db]
+        if connection.vendor == 'postgresql' or (connection.vendor == 'sqlite' and
+                                                 connection.Database.sqlite_version_info >= (3, 35)):
+            return CaptchaImage._pop_returning(connection, key)
+        return CaptchaImage._pop_selected(key)
+
+    @staticmethod
+    def _pop_returning(connection, key):
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE %s = %%s RETURNING %s' % (
+                qn(CaptchaImage._meta.db_table), qn('key'), qn('image')
+            ), [key])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _pop_selected(key):
+        # Without RETURNING, the deleted row count tells whether the
+        #   captcha was still there, so concurrent requests can't both
+        #   take it.
+        name = CaptchaImage.objects.filter(key=key).values_list('image', flat=True).first()
+        if name is not None and CaptchaImage.delete_rows('key', [key]):
+            return name
+        return None
+
+    @staticmethod
+    def delete_rows(column, values):
+        """
+        Deletes the captchas having one of the given values in a column,
+          with a single query. The post_delete cleanup is not triggered:
+          the caller takes care of the files.
+        :param column: The column (e.g. 'id' or 'key').
+        :param values: The values.
+        :return: The number of deleted captchas.
+        """
+
+        connection = connections[CaptchaImage.objects.db]
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                qn(CaptchaImage._meta.db_table), qn(column), ', '.join(['%s'] * len(values))
+            ), list(values))
+            return cursor.rowcount
+
+
+class CaptchaPoolImage(models.Model):
+    """
+    A pre-rendered captcha, not yet tied to any salt. Claiming one
+      turns it into a CaptchaImage (reusing the same file).
+    """
+    image = models.ImageField(upload_to='captcha', null=False, editable=False)
+    solution = models.CharField(max_length=SOLUTION_LENGTH, null=False, editable=False)
+
+    @staticmethod
+    def generate(count):
+        """
+        Renders many captchas into the pool, inserting them in one go.
+        :param count: How many captchas to render.
+        :return: The new pooled captchas.
+        """
+
+        pooled = []
+        for _ in range(count):
+            solution, content = CaptchaImage.render()
+            pooled.append(CaptchaPoolImage(solution=solution, image=image_file(content)))
+        return CaptchaPoolImage.objects.bulk_create(pooled)
 
 
 @receiver(post_delete, sender=CaptchaImage)
@@ -0,0 +1,174 @@
+import logging
+import os
+import random
+import time
+from threading import Lock, Thread
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from .models import CaptchaImage, CaptchaPoolImage
+from .utils import encode_solution
+
+
+logger = logging.getLogger(__name__)
+
+
+class CaptchaPool(object):
+    """
+    Keeps CAPTCHA_POOL_SIZE captchas pre-rendered (as CaptchaPoolImage
+      objects) so rendering a form just claims one of them.
+
+    The pool is refilled by a daemon thread started on the first claim
+      (unless CAPTCHA_POOL_WORKER is False) every CAPTCHA_POOL_INTERVAL
+      seconds, or by the `fillcaptchapool` command running as a separate
+      process. Since the pool lives in the database, every process
+      claims from the same one.
+
+    Only one process refills the pool at a time: refills take a lock in
+      the CAPTCHA_CACHE cache (by default, the 'default' one), for at most
+      CAPTCHA_POOL_LOCK_TIMEOUT seconds. The cache must then be shared
+      by the processes (e.g. memcached); with a per-process one, set
+      CAPTCHA_POOL_WORKER = False and refill with `fillcaptchapool --loop`.
+    """
+
+    LOCK_KEY = 'captcha:pool:refill'
+    CLAIM_ATTEMPTS = 3
+    CLAIM_CANDIDATES = 8
+
+    def __init__(self):
+        self._lock = Lock()
+        self._worker = None
+        self._stats = {
+            'depth': 0,
+            'claims': 0,
+            'misses': 0,
+            'refilled': 0,
+            'last_claim_latency': 0.0,
+            'total_claim_latency': 0.0,
+        }
+
+    @property
+    def size(self):
+        return getattr(settings, 'CAPTCHA_POOL_SIZE', 0)
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'CAPTCHA_POOL_BATCH_SIZE', 50)
+
+    @property
+    def interval(self):
+        return getattr(settings, 'CAPTCHA_POOL_INTERVAL', 1)
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'CAPTCHA_CACHE', 'default')]
+
+    @property
+    def lock_timeout(self):
+        return getattr(settings, 'CAPTCHA_POOL_LOCK_TIMEOUT', 60)
+
+    def stats(self):
+        """
+        Returns a copy of the pool's counters. The depth is the one seen
+          by the last refill, minus the claims since then.
+        """
+
+        with self._lock:
+            return dict(self._stats)
+
+    def _take(self):
+        # Concurrent claimers pick at random among the oldest entries,
+        #   so they don't all fight for the same one.
+        candidates = list(CaptchaPoolImage.objects.order_by('pk').values_list(
+            'pk', 'image', 'solution'
+        )[:self.CLAIM_CANDIDATES])
+        if not candidates:
+            return None
+        pk, image, solution = random.choice(candidates)
+        if CaptchaPoolImage.objects.filter(pk=pk).delete()[0]:
+            return image, solution
+        return False
+
+    def claim(self, salt):
+        """
+        Claims a pre-rendered captcha and ties it to the given salt.
+        :param salt: The salt of the captcha field.
+        :return: The new CaptchaImage, or None if the pool ran dry.
+        """
+
+        self.ensure_worker()
+        started = time.time()
+        taken = None
+        for _ in range(self.CLAIM_ATTEMPTS):
+            taken = self._take()
+            if taken is not False:
+                break
+
+        captcha = None
+        if taken:
+            image, solution = taken
+            captcha = CaptchaImage.create(encode_solution(salt, solution), image)
+
+        latency = time.time() - started
+        with self._lock:
+            if captcha is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['claims'] += 1
+                self._stats['last_claim_latency'] = latency
+                self._stats['total_claim_latency'] += latency
+                if self._stats['depth']:
+                    self._stats['depth'] -= 1
+        return captcha
+
+    def refill(self):
+        """
+        Renders captchas until the pool has CAPTCHA_POOL_SIZE of them,
+          unless another process is refilling it right now.
+        :return: The number of rendered captchas.
+        """
+
+        cache = self.cache
+        if not cache.add(self.LOCK_KEY, os.getpid(), self.lock_timeout):
+            return 0
+        try:
+            depth = CaptchaPoolImage.objects.count()
+            missing = max(self.size - depth, 0)
+            for batch in range(0, missing, self.batch_size):
+                CaptchaPoolImage.generate(min(self.batch_size, missing - batch))
+        finally:
+            cache.delete(self.LOCK_KEY)
+        with self._lock:
+            self._stats['depth'] = depth + missing
+            self._stats['refilled'] += missing
+        return missing
+
+    def _work(self):
+        while True:
+            try:
+                self.refill()
+            except Exception:
+                logger.exception('Could not refill the captcha pool')
+            finally:
+                connection.close()
+            time.sleep(self.interval)
+
+    def ensure_worker(self):
+        """
+        Starts the refilling thread, if not started yet.
+        """
+
+        if self._worker is not None or not getattr(settings, 'CAPTCHA_POOL_WORKER', True):
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = Thread(target=self._work, name='captcha-pool')
+                self._worker.daemon = True
+                self._worker.start()
+
+
+captcha_pool = CaptchaPool()
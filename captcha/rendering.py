@@ -0,0 +1,106 @@
+import os
+import random
+from io import BytesIO
+from threading import Lock
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+
+SOLUTION_LENGTH = 6
+SOLUTION_CHARS = 'abcdefhkmnprtuvwxyABCDEFGHJKLMNPRTUVWXY3468'
+BACKGROUND_SIZE = (180, 40)
+BACKGROUND_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'images', 'background.png')
+BASE_FONT_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'fonts')
+FONTS = ['DejaVuSans.ttf', 'DejaVuSansMono.ttf', 'DejaVuSerif.ttf']
+FONT_MIN = 30
+FONT_MAX = 35
+FOREGROUND_COLOR = '#a6a6a6'
+BASE_TEXT_OFFSET = 7
+OFFSET_MIN = -2
+OFFSET_MAX = 8
+ROTATION_MIN = -30
+ROTATION_MAX = 31
+YPOS_MIN = 8
+YPOS_MAX = 12
+
+
+class CaptchaRenderer(object):
+    """
+    Renders captchas out of cached resources: the fonts and the background
+      are loaded once, and each (font, size, character) glyph is rasterized
+      once and then only rotated. All the glyphs are drawn into the same
+      mask, so the foreground is composited over the background in a
+      single pass.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._fonts = {}
+        self._glyphs = {}
+        self._background = None
+        self._foreground = None
+
+    def _font(self, name, size):
+        key = (name, size)
+        if key not in self._fonts:
+            self._fonts[key] = ImageFont.truetype(os.path.join(BASE_FONT_PATH, name), size)
+        return self._fonts[key]
+
+    def glyph(self, name, size, character):
+        """
+        Gets the (unrotated) grayscale image of a character.
+        """
+
+        key = (name, size, character)
+        glyph = self._glyphs.get(key)
+        if glyph is None:
+            with self._lock:
+                font = self._font(name, size)
+                text = ' %s ' % character
+                glyph = Image.new('L', font.getsize(text), '#000000')
+                ImageDraw.Draw(glyph).text((0, 0), text, font=font, fill='#ffffff')
+                self._glyphs[key] = glyph
+        return glyph
+
+    def layers(self):
+        """
+        Gets the (background, foreground) images, loading them if needed.
+        """
+
+        if self._background is None:
+            with self._lock:
+                if self._background is None:
+                    self._foreground = Image.new('RGBA', BACKGROUND_SIZE, FOREGROUND_COLOR)
+                    self._background = Image.open(BACKGROUND_PATH).convert('RGBA')
+        return self._background, self._foreground
+
+    def render(self):
+        """
+        Renders a new random captcha.
+        :return: A (solution, png image content) tuple.
+        """
+
+        solution = ''.join(random.choice(SOLUTION_CHARS) for _ in range(SOLUTION_LENGTH))
+        mask = Image.new('L', BACKGROUND_SIZE)
+        offset = BASE_TEXT_OFFSET
+
+        for character in solution:
+            ch_image = self.glyph(random.choice(FONTS), random.randrange(FONT_MIN, FONT_MAX), character)
+            ch_image = ch_image.rotate(random.randrange(ROTATION_MIN, ROTATION_MAX),
+                                       expand=1, resample=Image.BILINEAR)
+            ch_image = ch_image.crop(ch_image.getbbox())
+
+            # Glyphs may overlap, so they are merged into the mask
+            #   instead of replacing what is already there.
+            ypos = random.randrange(YPOS_MIN, YPOS_MAX)
+            box = (offset, ypos, ch_image.size[0] + offset, ch_image.size[1] + ypos)
+            mask.paste(ImageChops.lighter(mask.crop(box), ch_image), box)
+
+            offset += ch_image.size[0] + random.randrange(OFFSET_MIN, OFFSET_MAX)
+
+        background, foreground = self.layers()
+        img_io = BytesIO()
+        Image.composite(foreground, background, mask).save(img_io, format='PNG')
+        return solution, img_io.getvalue()
+
+
+renderer = CaptchaRenderer()
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+
+# Sent once a captcha is generated, with the `captcha`, its `source`
+#   ('pool' or 'rendered') and the `seconds` it took.
+captcha_generated = Signal(providing_args=['captcha', 'source', 'seconds'])
+
+# Sent once a captcha image is served, with the `seconds` it took.
+captcha_served = Signal(providing_args=['seconds'])
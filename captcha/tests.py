@@ -0,0 +1,289 @@
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from threading import Thread
+from io import BytesIO
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection
+from django.http import FileResponse, Http404
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+from PIL import Image
+from .backends import CacheBackend, DatabaseBackend, LocalMemoryBackend
+from .cleanup import reap_expired, sweep_orphan_files
+from .middleware import CaptchaRequestMiddleware, get_current_request
+from .models import CaptchaImage, CaptchaPoolImage, image_file
+from .pool import CaptchaPool
+from .rendering import BACKGROUND_SIZE, SOLUTION_CHARS, SOLUTION_LENGTH, CaptchaRenderer
+from .utils import encode_solution
+
+
+class CaptchaTestCase(TestCase):
+    """
+    Captchas stored in a fresh media root, with an empty cache.
+    """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = self.settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        caches['default'].clear()
+
+    def assertStored(self, name, stored=True):
+        self.assertEqual(os.path.isfile(default_storage.path(name)), stored)
+
+
+class PoolTests(CaptchaTestCase):
+
+    def setUp(self):
+        super(PoolTests, self).setUp()
+        self.pool = CaptchaPool()
+        pool_settings = self.settings(CAPTCHA_POOL_SIZE=3, CAPTCHA_POOL_WORKER=False)
+        pool_settings.enable()
+        self.addCleanup(pool_settings.disable)
+
+    def test_claim_ties_a_pooled_captcha_to_the_salt(self):
+        pooled = {image.solution: image.image.name for image in CaptchaPoolImage.generate(2)}
+        captcha = self.pool.claim('salt')
+        solution = [solution for solution in pooled if encode_solution('salt', solution) == captcha.key][0]
+        self.assertEqual(captcha.image.name, pooled[solution])
+        self.assertStored(captcha.image.name)
+        self.assertEqual(list(CaptchaPoolImage.objects.values_list('solution', flat=True)),
+                         [other for other in pooled if other != solution])
+        self.assertEqual(self.pool.stats()['claims'], 1)
+
+    def test_dry_pool_falls_back_to_rendering(self):
+        self.assertIsNone(self.pool.claim('salt'))
+        self.assertEqual(self.pool.stats()['misses'], 1)
+        captcha = CaptchaImage.generate('salt')
+        self.assertStored(captcha.image.name)
+
+    def test_refill_tops_the_pool_up(self):
+        CaptchaPoolImage.generate(1)
+        self.assertEqual(self.pool.refill(), 2)
+        self.assertEqual(CaptchaPoolImage.objects.count(), 3)
+        self.assertEqual(self.pool.refill(), 0)
+        self.assertEqual(self.pool.stats()['depth'], 3)
+
+    def test_refill_is_skipped_while_locked(self):
+        self.pool.cache.add(CaptchaPool.LOCK_KEY, 0)
+        self.assertEqual(self.pool.refill(), 0)
+        self.assertFalse(CaptchaPoolImage.objects.exists())
+        self.pool.cache.delete(CaptchaPool.LOCK_KEY)
+        self.assertEqual(self.pool.refill(), 3)
+        self.assertIsNone(self.pool.cache.get(CaptchaPool.LOCK_KEY))
+
+
+class RendererTests(SimpleTestCase):
+
+    def test_render(self):
+        solution, content = CaptchaRenderer().render()
+        self.assertEqual(len(solution), SOLUTION_LENGTH)
+        self.assertTrue(set(solution) <= set(SOLUTION_CHARS))
+        image = Image.open(BytesIO(content))
+        self.assertEqual((image.format, image.size), ('PNG', BACKGROUND_SIZE))
+
+    def test_resources_are_loaded_once(self):
+        renderer = CaptchaRenderer()
+        glyph = renderer.glyph('DejaVuSans.ttf', 30, 'a')
+        self.assertIs(renderer.glyph('DejaVuSans.ttf', 30, 'a'), glyph)
+        self.assertIsNot(renderer.glyph('DejaVuSans.ttf', 31, 'a'), glyph)
+        layers = renderer.layers()
+        renderer.render()
+        self.assertIs(renderer.layers()[0], layers[0])
+        self.assertIs(renderer.layers()[1], layers[1])
+        # One font per (name, size), however many characters use it.
+        self.assertEqual(set(renderer._fonts), set((name, size) for name, size, _ in renderer._glyphs))
+
+
+class InMemoryBackendTests(CaptchaTestCase):
+
+    def assertServedOnce(self, backend):
+        key = backend.generate('salt')
+        response = backend.respond(key)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(Image.open(BytesIO(response.content)).format, 'PNG')
+        with self.assertRaises(Http404):
+            backend.respond(key)
+
+    def test_cache_backend(self):
+        self.assertServedOnce(CacheBackend())
+
+    def test_cache_backend_claims_before_taking(self):
+        backend = CacheBackend()
+        key = backend.generate('salt')
+        # Another request is taking it right now.
+        backend.cache.add(backend.PREFIX + 'claim:' + key, 1)
+        self.assertIsNone(backend.pop(key))
+        backend.cache.delete(backend.PREFIX + 'claim:' + key)
+        self.assertIsNotNone(backend.pop(key))
+        self.assertIsNone(backend.pop(key))
+
+    def test_local_memory_backend(self):
+        self.assertServedOnce(LocalMemoryBackend())
+
+    def test_local_memory_backend_is_bounded(self):
+        backend = LocalMemoryBackend()
+        with self.settings(CAPTCHA_MEMORY_SIZE=2):
+            for key in ('a', 'b', 'c'):
+                self.assertTrue(backend.add(key, key.encode()))
+        self.assertFalse(backend.add('c', b'again'))
+        self.assertEqual([backend.pop(key) for key in ('a', 'b', 'c')], [None, b'b', b'c'])
+
+    def test_local_memory_backend_expires(self):
+        backend = LocalMemoryBackend()
+        with self.settings(CAPTCHA_TIMEOUT=0):
+            backend.add('a', b'a')
+        self.assertIsNone(backend.pop('a'))
+        self.assertTrue(backend.add('a', b'a'))
+
+
+class DatabaseBackendTests(CaptchaTestCase):
+
+    def create(self, key):
+        return CaptchaImage.create(key, image_file(b'png'))
+
+    def test_pop_returning(self):
+        if connection.vendor == 'sqlite' and connection.Database.sqlite_version_info < (3, 35):
+            self.skipTest('DELETE ... RETURNING needs SQLite 3.35')
+        name = self.create('key').image.name
+        self.assertEqual(CaptchaImage._pop_returning(connection, 'key'), name)
+        self.assertIsNone(CaptchaImage._pop_returning(connection, 'key'))
+        self.assertFalse(CaptchaImage.objects.exists())
+
+    def test_pop_selected(self):
+        name = self.create('key').image.name
+        self.assertEqual(CaptchaImage._pop_selected('key'), name)
+        self.assertIsNone(CaptchaImage._pop_selected('key'))
+        self.assertFalse(CaptchaImage.objects.exists())
+
+    def test_pop_leaves_the_file(self):
+        name = self.create('key').image.name
+        self.assertEqual(CaptchaImage.pop('key'), name)
+        self.assertStored(name)
+
+    def test_served_once(self):
+        backend = DatabaseBackend()
+        name = self.create('key').image.name
+        response = backend.respond('key')
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), b'png')
+        response.close()
+        self.assertStored(name, False)
+        with self.assertRaises(Http404):
+            backend.respond('key')
+
+    def test_sendfile(self):
+        backend = DatabaseBackend()
+        name = self.create('key').image.name
+        with self.settings(CAPTCHA_SENDFILE='x-accel-redirect', CAPTCHA_SENDFILE_GRACE=0):
+            response = backend.respond('key')
+            self.assertEqual(response['X-Accel-Redirect'], '/protected/' + name)
+            # The web server still has to read it.
+            self.assertStored(name)
+            self.create('other')
+            backend.respond('other')
+        self.assertStored(name, False)
+
+
+@override_settings(CAPTCHA_TTL=60)
+class CleanupTests(CaptchaTestCase):
+
+    def test_reap_expired(self):
+        captchas = [CaptchaImage.create(key, image_file(b'png')) for key in ('a', 'b', 'c')]
+        CaptchaImage.objects.filter(key__in=['a', 'b']).update(created_on=now() - timedelta(seconds=61))
+        self.assertEqual(reap_expired(chunk_size=1), 2)
+        self.assertEqual(list(CaptchaImage.objects.values_list('key', flat=True)), ['c'])
+        for captcha, stored in zip(captchas, (False, False, True)):
+            self.assertStored(captcha.image.name, stored)
+        self.assertEqual(reap_expired(), 0)
+
+    def test_sweep_orphan_files(self):
+        kept = CaptchaImage.create('a', image_file(b'png')).image.name
+        pooled = CaptchaPoolImage.generate(1)[0].image.name
+        orphan = default_storage.save('captcha/orphan.png', ContentFile(b'png'))
+        recent = default_storage.save('captcha/recent.png', ContentFile(b'png'))
+        for name in (kept, pooled, orphan):
+            past = time.time() - 61
+            os.utime(default_storage.path(name), (past, past))
+        self.assertEqual(sweep_orphan_files(), 1)
+        self.assertStored(orphan, False)
+        for name in (kept, pooled, recent):
+            self.assertStored(name)
+
+
+class CreateTests(CaptchaTestCase):
+
+    def test_used_key_is_reported(self):
+        kept = CaptchaImage.create('key', image_file(b'png'))
+        self.assertIsNone(CaptchaImage.create('key', image_file(b'png')))
+        self.assertEqual(list(CaptchaImage.objects.values_list('image', flat=True)), [kept.image.name])
+        # The file of the discarded one is removed.
+        self.assertEqual(os.listdir(default_storage.path('captcha')), [os.path.basename(kept.image.name)])
+
+    def test_other_integrity_errors_are_raised(self):
+        with self.assertRaises(IntegrityError):
+            CaptchaImage.create(None, image_file(b'png'))
+        self.assertFalse(CaptchaImage.objects.exists())
+
+    def test_pool_is_filled_in_one_insert(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(CaptchaPoolImage.generate(3)), 3)
+
+
+class MiddlewareTests(SimpleTestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+
+    def test_request_is_set_while_serving(self):
+        seen = []
+        middleware = CaptchaRequestMiddleware(lambda request: seen.append(get_current_request()))
+        middleware(self.request)
+        self.assertEqual(seen, [self.request])
+        with self.assertRaises(ImproperlyConfigured):
+            get_current_request()
+
+    def test_request_is_reset_on_errors(self):
+        def view(request):
+            raise ValueError
+
+        with self.assertRaises(ValueError):
+            CaptchaRequestMiddleware(view)(self.request)
+        with self.assertRaises(ImproperlyConfigured):
+            get_current_request()
+
+    def test_nested_requests_restore_the_outer_one(self):
+        inner = RequestFactory().get('/inner')
+        seen = []
+
+        def view(request):
+            CaptchaRequestMiddleware(lambda request: seen.append(get_current_request()))(inner)
+            seen.append(get_current_request())
+
+        CaptchaRequestMiddleware(view)(self.request)
+        self.assertEqual(seen, [inner, self.request])
+
+    def test_request_is_not_shared_across_threads(self):
+        seen = []
+
+        def lookup():
+            try:
+                seen.append(get_current_request())
+            except ImproperlyConfigured:
+                seen.append(None)
+
+        def view(request):
+            thread = Thread(target=lookup)
+            thread.start()
+            thread.join()
+
+        CaptchaRequestMiddleware(view)(self.request)
+        self.assertEqual(seen, [None])
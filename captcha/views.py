@@ -1,18 +1,18 @@
-from PIL import Image
-from django.http.response import HttpResponse
-from . import models
+import time
+from .backends import get_backend
+from .signals import captcha_served
 
 
 def render_once(request, key):
     """
     Renders a specific captcha's image, and deletes it
     :param key: The sha key to render. It will be stored
-                in the model.
+                in the backend (by default, in the model).
     :return:
     """
 
-    instance = models.CaptchaImage.objects.get(key=key)
-    response = HttpResponse(content_type='image/png')
-    Image.open(instance.image).save(response, "PNG")
-    instance.delete()
+    started = time.time()
+    backend = get_backend()
+    response = backend.respond(key)
+    captcha_served.send(sender=backend.__class__, seconds=time.time() - started)
     return response
@@ -1,15 +1,77 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+from datetime import datetime, time, timedelta
+from django import forms
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.db.models import Q, Sum
+from django.http import Http404, HttpResponseBadRequest
+from django.template.response import TemplateResponse
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.html import format_html
+from django.utils.timezone import make_aware, now, utc
+from django.utils.translation import ugettext_lazy as _
 from polymorphic.admin import PolymorphicParentModelAdmin, PolymorphicChildModelAdmin, PolymorphicInlineModelAdmin, \
     PolymorphicInlineSupportMixin, StackedPolymorphicInline
-from .models import SiteSetting, SiteResource, SiteResourceAlias, SiteConcreteResource, SiteConcreteResourceVisit, \
-    SiteBundle, SiteAsset, ImageAsset, TextAsset
+from .exports import day_start, visits_for, csv_response, xlsx_response
+from .models import SiteSetting, SiteResource, SiteResourceAlias, SiteConcreteResource, \
+    SiteConcreteResourceVisit, SiteConcreteResourceVisitRollup, SiteBundle, SiteAsset, ImageAsset, TextAsset
+from .rollups import PERIOD_LENGTHS
+
+
+class ExportVisitsForm(forms.Form):
+    """
+    Asks for the range of dates of the visits to export.
+    """
+
+    since = forms.DateField(label=_('Since'), required=False, help_text=_('The first day to export'))
+    until = forms.DateField(label=_('Until'), required=False, help_text=_('The day to export up to, excluded'))
+
+
+def export_visits_action(respond, name, description):
+    """
+    Makes an admin action exporting the visits of the selected objects
+      (as given by the visits_of method of their admin) through the given
+      response function, once the range of dates was asked for.
+    """
+
+    def export(modeladmin, request, queryset):
+        form = ExportVisitsForm(request.POST if 'export' in request.POST else None)
+        if form.is_valid():
+            since, until = form.cleaned_data['since'], form.cleaned_data['until']
+            return respond(modeladmin.visits_of(queryset, since=since and day_start(since),
+                                                until=until and day_start(until)), 'visits')
+        context = dict(
+            modeladmin.admin_site.each_context(request),
+            title=description,
+            opts=modeladmin.model._meta,
+            form=form,
+            action=name,
+            queryset=queryset,
+            action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
+        )
+        return TemplateResponse(request, 'admin/manysites/export_visits.html', context)
+
+    export.__name__ = str(name)
+    export.short_description = description
+    return export
+
+
+export_visits_csv = export_visits_action(csv_response, 'export_visits_csv', _('Export visits (CSV)'))
+export_visits_xlsx = export_visits_action(xlsx_response, 'export_visits_xlsx', _('Export visits (XLSX)'))
 
 
 class SiteSettingAdmin(admin.ModelAdmin):
 
     list_display = ('site', 'index', 'enabled')
+    list_select_related = ('site', 'index__setting__site')
+    actions = [export_visits_csv, export_visits_xlsx]
+
+    def visits_of(self, queryset, since=None, until=None):
+        return visits_for(sites=queryset.values('site_id'), since=since, until=until)
 
 
 class SiteResourceParentAdmin(PolymorphicParentModelAdmin):
@@ -20,25 +82,38 @@ class SiteResourceParentAdmin(PolymorphicParentModelAdmin):
     class SiteConcreteResourceChildAdmin(PolymorphicChildModelAdmin):
         base_model = SiteResource
 
-        class SiteConcreteResourceVisitsInline(admin.TabularInline):
-            model = SiteConcreteResourceVisit
-            ordering = ('-visited_on',)
-            fields = ('visited_on', 'visited_from')
-            readonly_fields = ('visited_on', 'visited_from')
-
-            def has_add_permission(self, request):
-                return False
+        readonly_fields = ('visits_summary',)
+
+        def visits_summary(self, obj):
+            """
+            Only the totals of the rollups are shown here: the visits
+              themselves are browsed in their own (paginated) list.
+            """
+
+            if obj is None or obj.pk is None:
+                return '-'
+            rollups = SiteConcreteResourceVisitRollup.objects.filter(resource=obj, period='day')
+            total = rollups.aggregate(hits=Sum('hits'))['hits'] or 0
+            recent = rollups.filter(period_start__gte=now() - timedelta(days=7)).aggregate(
+                hits=Sum('hits')
+            )['hits'] or 0
+            return format_html(
+                '{0} visits ({1} in the last 7 days, as of the last rollup). <a href="{2}?resource={3}">Browse</a>',
+                total, recent, reverse('admin:manysites_siteconcreteresourcevisit_changelist'), obj.pk
+            )
+        visits_summary.short_description = _('Visits')
 
-            def has_delete_permission(self, request, obj=None):
-                return False
+    base_model = SiteResource
+    list_display = ('__str__', 'title', 'description', 'enabled')
+    actions = [export_visits_csv, export_visits_xlsx]
 
-            def has_change_permission(self, request, obj=None):
-                return True
+    def visits_of(self, queryset, since=None, until=None):
+        return visits_for(resources=queryset.values('pk'), since=since, until=until)
 
-        inlines = [SiteConcreteResourceVisitsInline]
+    def get_queryset(self, request):
+        # The list is not polymorphic: __str__ only needs the setting and site.
+        return super(SiteResourceParentAdmin, self).get_queryset(request).select_related('setting__site')
 
-    base_model = SiteResource
-    list_display = ('__str__', 'title', 'description', 'enabled')
     child_models = (
         (SiteResourceAlias, SiteResourceChildAdmin),
         (SiteConcreteResource, SiteConcreteResourceChildAdmin)
@@ -48,6 +123,7 @@ class SiteResourceParentAdmin(PolymorphicParentModelAdmin):
 class SiteBundleAdmin(PolymorphicInlineSupportMixin, admin.ModelAdmin):
 
     list_display = ('__str__', 'setting', 'code', 'title', 'description')
+    list_select_related = ('setting__site',)
 
     class SiteAssetInlineModelAdmin(StackedPolymorphicInline):
         model = SiteAsset
@@ -80,7 +156,89 @@ class SiteAssetAdmin(PolymorphicParentModelAdmin):
     class Media:
         css = {'all': ['manysites/css/admin.css']}
 
+
+class SiteConcreteResourceVisitAdmin(admin.ModelAdmin):
+    """
+    Browses the visits of a resource, newest first, a page at a time.
+      Pages are sought by (visited_on, id) past the last row of the
+      previous page, using the (resource, visited_on) index, instead of
+      being counted and offset: the cost of a page does not depend on how
+      deep it is. The day filters and the (estimated) count come from the
+      daily rollups, so no COUNT(*) is run either.
+    """
+
+    list_per_page = 100
+    change_list_template = 'admin/manysites/siteconcreteresourcevisit/change_list.html'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def get_model_perms(self, request):
+        # Only reachable from a resource: hidden in the admin index.
+        return {}
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            resource = SiteConcreteResource.objects.non_polymorphic().select_related('setting__site').get(
+                pk=request.GET.get('resource')
+            )
+        except (SiteConcreteResource.DoesNotExist, ValueError):
+            raise Http404('Unknown resource')
+
+        rollups = SiteConcreteResourceVisitRollup.objects.filter(resource=resource, period='day')
+        visits = SiteConcreteResourceVisit.objects.filter(resource=resource)
+        day = parse_date(request.GET.get('day') or '')
+        if day is not None:
+            # Rollup days start at midnight, UTC.
+            start = datetime.combine(day, time())
+            if settings.USE_TZ:
+                start = make_aware(start, utc)
+            visits = visits.filter(visited_on__gte=start, visited_on__lt=start + PERIOD_LENGTHS['day'])
+            rollups = rollups.filter(period_start=start)
+
+        before = request.GET.get('before', '')
+        if before:
+            visited_on, separator, last_id = before.rpartition('_')
+            try:
+                # Well formatted but invalid dates raise ValueError.
+                visited_on = parse_datetime(visited_on)
+            except ValueError:
+                visited_on = None
+            if visited_on is None or not last_id.isdigit():
+                return HttpResponseBadRequest('Invalid page')
+            visits = visits.filter(Q(visited_on__lt=visited_on) | Q(visited_on=visited_on, id__lt=last_id))
+
+        page = list(visits.order_by('-visited_on', '-id')[:self.list_per_page + 1])
+        following = None
+        if len(page) > self.list_per_page:
+            page = page[:self.list_per_page]
+            following = '%s_%d' % (page[-1].visited_on.isoformat(), page[-1].pk)
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title=_('Visits of %s') % resource,
+            resource=resource,
+            visits=page,
+            day=day,
+            days=SiteConcreteResourceVisitRollup.objects.filter(resource=resource, period='day').order_by(
+                '-period_start'
+            )[:31],
+            estimated_count=rollups.aggregate(hits=Sum('hits'))['hits'] or 0,
+            first_page=before == '',
+            following=following,
+        )
+        context.update(extra_context or {})
+        return TemplateResponse(request, self.change_list_template, context)
+
+
 admin.site.register(SiteSetting, SiteSettingAdmin)
 admin.site.register(SiteResource, SiteResourceParentAdmin)
 admin.site.register(SiteBundle, SiteBundleAdmin)
-admin.site.register(SiteAsset, SiteAssetAdmin)
\ No newline at end of file
+admin.site.register(SiteAsset, SiteAssetAdmin)
+admin.site.register(SiteConcreteResourceVisit, SiteConcreteResourceVisitAdmin)
\ No newline at end of file
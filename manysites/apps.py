@@ -1,8 +1,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.apps import AppConfig
+from django.apps import AppConfig, apps
 
 
 class SitesConfig(AppConfig):
-    name = 'project'
+    name = 'manysites'
+
+    def ready(self):
+        # Registers the cache invalidation and bundle building handlers.
+        from . import caches, assets
+        self.register_collectors(caches)
+
+    def register_collectors(self, caches):
+        # Exposes the stats() of the caches, buffers and pools as metrics.
+        from . import metrics
+        from .loaders import template_cache
+        from .metrics import registry
+        from .visits import visit_buffer
+
+        registry.register_collector('manysites_resolution_cache', caches.resolution_cache.stats)
+        registry.register_collector('manysites_response_cache', caches.response_cache.stats)
+        registry.register_collector('manysites_asset_index', caches.asset_index.stats)
+        registry.register_collector('manysites_template_cache', template_cache.stats)
+        registry.register_collector('manysites_visit_buffer', visit_buffer.stats)
+
+        # The captcha app knows nothing about metrics: it sends signals.
+        if apps.is_installed('captcha'):
+            from captcha.pool import captcha_pool
+            from captcha.signals import captcha_generated, captcha_served
+            registry.register_collector('captcha_pool', captcha_pool.stats)
+            captcha_generated.connect(metrics.captcha_generated, dispatch_uid='manysites.metrics.captcha_generated')
+            captcha_served.connect(metrics.captcha_served, dispatch_uid='manysites.metrics.captcha_served')
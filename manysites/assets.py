@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import re
+from io import BytesIO
+from threading import Lock
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.timezone import now
+from .models import SiteBundle, SiteBundleArtifact, TextAsset
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from rcssmin import cssmin
+except ImportError:
+    cssmin = None
+
+try:
+    from rjsmin import jsmin
+except ImportError:
+    jsmin = None
+
+
+#######################################################################
+#
+# Text assets of a bundle are built, per subtype, into a single file
+#   (concatenated and minified) in the static storage, named after a
+#   hash of its content, along with .gz (and .br, if the brotli package
+#   is installed) variants the web server can send as they are. Since
+#   the name changes with the content, these files can be served with
+#   far-future cache headers.
+#
+# rcssmin and rjsmin are used for the minification, if installed.
+#   Otherwise, css is minified by the naive minifier below, and
+#   javascript is just concatenated (it can't be safely minified by
+#   a couple of regular expressions).
+#
+#######################################################################
+
+
+BUILT_SUBTYPES = {
+    'css': ('css', '\n'),
+    'javascript': ('js', ';\n'),
+}
+CSS_STRINGS = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+CSS_STRINGS_RE = re.compile(r'(%s)' % CSS_STRINGS, re.S)
+CSS_COMMENTS_RE = re.compile(r'(%s)|/\*.*?\*/' % CSS_STRINGS, re.S)
+CSS_SPACES_RE = re.compile(r'\s+')
+# Spaces before a colon are kept: "a :hover" is not "a:hover".
+CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,>])\s*|(:)\s+')
+
+
+def _squeeze_css(content):
+    content = CSS_SPACES_RE.sub(' ', content)
+    return CSS_PUNCTUATION_RE.sub(lambda match: match.group(1) or match.group(2), content).replace(';}', '}')
+
+
+def _naive_cssmin(content):
+    # Strings are kept as they are: only what is around them is squeezed.
+    content = CSS_COMMENTS_RE.sub(lambda match: match.group(1) or ' ', content)
+    parts = CSS_STRINGS_RE.split(content)
+    parts[::2] = [_squeeze_css(part) for part in parts[::2]]
+    return ''.join(parts).strip()
+
+
+def minify(content, subtype):
+    """
+    Minifies css or javascript content.
+    """
+
+    if subtype == 'css':
+        return cssmin(content) if cssmin else _naive_cssmin(content)
+    return jsmin(content) if jsmin else content
+
+
+def _gzip(content):
+    buffer = BytesIO()
+    # A fixed mtime makes the output depend only on the content.
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as compressed:
+        compressed.write(content)
+    return buffer.getvalue()
+
+
+def _save(name, content):
+    if not staticfiles_storage.exists(name):
+        staticfiles_storage.save(name, ContentFile(content))
+
+
+def build_bundle(bundle):
+    """
+    Builds the artifacts of a bundle: one per subtype having text assets.
+      Artifacts of subtypes without assets are discarded (their files are
+      kept, since pages cached elsewhere may still refer to them).
+    :param bundle: The bundle to build.
+    :return: The current artifacts of the bundle.
+    """
+
+    artifacts = []
+    for subtype, (extension, separator) in BUILT_SUBTYPES.items():
+        contents = list(TextAsset.objects.filter(bundle=bundle, content_subtype=subtype).order_by(
+            'code'
+        ).values_list('content', flat=True))
+        if not contents:
+            SiteBundleArtifact.objects.filter(bundle=bundle, content_subtype=subtype).delete()
+            continue
+
+        content = minify(separator.join(contents), subtype).encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()
+        name = 'manysites/bundles/%d/%s.%s.%s' % (bundle.setting_id, bundle.code or '_default',
+                                                  digest[:12], extension)
+        _save(name, content)
+        _save(name + '.gz', _gzip(content))
+        if brotli is not None:
+            _save(name + '.br', brotli.compress(content))
+
+        artifact, _ = SiteBundleArtifact.objects.update_or_create(
+            bundle=bundle, content_subtype=subtype, defaults={'name': name, 'digest': digest, 'built_on': now()}
+        )
+        artifacts.append(artifact)
+    return artifacts
+
+
+_build_lock = Lock()
+_built = {}
+
+
+def _build_after(bundle_id):
+    # Saving many assets in a transaction schedules as many builds: the
+    #   first one builds the bundle, and the others find its text assets
+    #   as they were built, which is cheaper to check than to build again.
+    with _build_lock:
+        bundle = SiteBundle.objects.filter(pk=bundle_id).first()
+        if bundle is None:
+            _built.pop(bundle_id, None)
+            return
+        assets = list(TextAsset.objects.filter(bundle=bundle).order_by('code').values_list(
+            'code', 'content_subtype', 'content'
+        ))
+        fingerprint = hashlib.sha256(repr((bundle.setting_id, bundle.code, assets)).encode('utf-8')).hexdigest()
+        if _built.get(bundle_id) == fingerprint:
+            return
+        build_bundle(bundle)
+        _built[bundle_id] = fingerprint
+
+
+def schedule_build(bundle_id):
+    """
+    Builds a bundle once the current transaction is committed. Saving
+      many assets of a bundle (e.g. in its admin page) builds it once.
+    """
+
+    transaction.on_commit(lambda: _build_after(bundle_id))
+
+
+@receiver([post_save, post_delete], sender=TextAsset)
+def after_text_asset_change(sender, instance, **kwargs):
+    """
+    Rebuild of the bundle of a text asset
+    """
+    schedule_build(instance.bundle_id)
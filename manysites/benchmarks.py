@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import sys
+import time
+from io import BytesIO
+from wsgiref.util import setup_testing_defaults
+from django.contrib.sites.models import Site
+from django.db import connection, transaction
+from .models import SiteSetting, SiteResourceAlias, SiteConcreteResource, SiteBundle, TextAsset
+
+
+#######################################################################
+#
+# Benchmark of the request path: a fixture generator creating many
+#   sites (each with resources, aliases, a bundle and text assets), and
+#   a runner sending requests straight to the WSGI application, through
+#   the whole middleware stack, measuring the requests per second, the
+#   latency percentiles and the queries per request of each scenario.
+#   See the benchsites command, which runs it against a test database.
+#
+#######################################################################
+
+
+RESOURCE_TEMPLATE = '''{% load site_assets %}<!DOCTYPE html>
+<html>
+  <head>
+    <title>{{ resource.title }}</title>
+    <link rel="stylesheet" href="{% site_bundle 'css' %}" />
+  </head>
+  <body>
+    <h1>{{ resource.title }}</h1>
+    <p>{{ resource.description }}</p>
+    {% site_asset 'plain' 'notice' %}
+    <script src="{% site_bundle 'javascript' %}"></script>
+  </body>
+</html>'''
+
+ASSET_CONTENTS = (
+    ('css', 'body { margin: 0; padding: 0; }'),
+    ('javascript', 'var benchmark = true;'),
+    ('plain', '<p>Benchmark notice</p>'),
+)
+
+
+def bench_domain(number):
+    return 'site-%d.bench' % number
+
+
+def generate_fixtures(sites=1000, resources=5, aliases=2, assets=3):
+    """
+    Creates the benchmark sites, in a single transaction.
+    :param sites: How many sites to create.
+    :param resources: How many concrete resources per site (the first
+      one being the site's index).
+    :param aliases: How many aliases per site (to its first resources).
+    :param assets: How many text assets of each subtype (css,
+      javascript, plain) per site, in its default bundle.
+    :return: A dictionary with the site domains and, per domain, the
+      url codes of its resources and aliases.
+    """
+
+    fixtures = {'domains': [], 'resources': {}, 'aliases': {}}
+    with transaction.atomic():
+        for number in range(sites):
+            site = Site.objects.create(domain=bench_domain(number), name='Benchmark site %d' % number)
+            setting = SiteSetting.objects.create(site=site)
+            codes = []
+            for index in range(resources):
+                resource = SiteConcreteResource.objects.create(
+                    setting=setting, url_code='page-%d' % index, title='Page %d' % index,
+                    description='Page %d of %s' % (index, site.domain), content=RESOURCE_TEMPLATE,
+                    log_visits=index % 2 == 0
+                )
+                codes.append(resource)
+            setting.index = codes[0]
+            setting.save()
+            alias_codes = []
+            for index in range(aliases):
+                alias = SiteResourceAlias.objects.create(
+                    setting=setting, url_code='alias-%d' % index, title='Alias %d' % index,
+                    description='Alias %d of %s' % (index, site.domain), resource=codes[index % len(codes)]
+                )
+                alias_codes.append(alias.url_code)
+            bundle = SiteBundle.objects.create(setting=setting, code='', title='Default')
+            for subtype, content in ASSET_CONTENTS:
+                for index in range(assets):
+                    # The template includes the first plain asset.
+                    code = 'notice' if subtype == 'plain' and not index else '%s-%d' % (subtype, index)
+                    TextAsset.objects.create(bundle=bundle, code=code, content_subtype=subtype,
+                                             content='/* %s %d */ %s' % (subtype, index, content))
+            fixtures['domains'].append(site.domain)
+            fixtures['resources'][site.domain] = [resource.url_code for resource in codes]
+            fixtures['aliases'][site.domain] = alias_codes
+    return fixtures
+
+
+def percentile(values, rate):
+    """
+    Gets a percentile (rate between 0 and 1) of a sorted list of values.
+    """
+
+    if not values:
+        return 0.0
+    return values[min(int(round(rate * (len(values) - 1))), len(values) - 1)]
+
+
+class WSGIBenchmark(object):
+    """
+    Sends requests to a WSGI application, in this process, and measures
+      them. Queries are counted through the connection's query log,
+      which Django resets at the start of each request.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def request(self, host, path):
+        """
+        Sends a GET request and consumes its response.
+        :return: The (status code, elapsed seconds, number of queries).
+        """
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'HTTP_HOST': host, 'SERVER_NAME': host,
+                   'REMOTE_ADDR': '10.0.%d.%d' % (random.randrange(256), random.randrange(1, 255)),
+                   'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr}
+        setup_testing_defaults(environ)
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(int(status.split(' ', 1)[0]))
+
+        started = time.time()
+        response = self.application(environ, start_response)
+        try:
+            for _ in response:
+                pass
+        finally:
+            # Queries are counted before close(): it fires request_finished.
+            queries = len(connection.queries_log)
+            if hasattr(response, 'close'):
+                response.close()
+        return statuses[0], time.time() - started, queries
+
+    def run(self, name, requests, warmup=0):
+        """
+        Measures a scenario.
+        :param name: The scenario's name.
+        :param requests: A list of (host, path) pairs, sent in order.
+        :param warmup: How many of the requests are sent before measuring.
+        :return: A dictionary with the results.
+        """
+
+        for host, path in requests[:warmup]:
+            self.request(host, path)
+
+        force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        latencies = []
+        queries = []
+        statuses = {}
+        started = time.time()
+        try:
+            for host, path in requests[warmup:]:
+                status, latency, count = self.request(host, path)
+                latencies.append(latency)
+                queries.append(count)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            connection.force_debug_cursor = force_debug_cursor
+        elapsed = time.time() - started
+
+        latencies.sort()
+        return {
+            'scenario': name,
+            'requests': len(latencies),
+            'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'mean_queries': float(sum(queries)) / len(queries) if queries else 0.0,
+            'max_queries': max(queries) if queries else 0,
+            'statuses': dict((str(status), count) for status, count in statuses.items()),
+        }
+
+
+def scenarios(fixtures, count, seed=0):
+    """
+    Builds the (host, path) requests of each scenario.
+    :param fixtures: The result of generate_fixtures.
+    :param count: How many requests per scenario.
+    :param seed: The seed of the random choices, so runs are comparable.
+    :return: A list of (name, requests) pairs.
+    """
+
+    rnd = random.Random(seed)
+    domains = fixtures['domains']
+
+    def pick(codes):
+        domain = rnd.choice(domains)
+        return domain, '/%s' % rnd.choice(fixtures[codes][domain])
+
+    built = [
+        ('index', [(rnd.choice(domains), '/') for _ in range(count)]),
+        ('resolved', [pick('resources') for _ in range(count)]),
+    ]
+    if fixtures['aliases'][domains[0]]:
+        built.append(('alias', [pick('aliases') for _ in range(count)]))
+    built.append(('miss', [(rnd.choice(domains), '/missing-%d' % number) for number in range(count)]))
+    return built
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http.request import split_domain_port
+from .models import SiteSetting, SiteResource, SiteResourceAlias, SiteConcreteResource, SiteBundle, \
+    SiteAsset, ImageAsset, TextAsset, SiteBundleArtifact, SiteCacheVersion, joined_child
+
+
+#######################################################################
+#
+# Per-process caches over the site resources and assets. They are meant
+#   to keep the request path free of queries in the common case, and they
+#   are invalidated (per site) by the signal handlers at the bottom of
+#   this module whenever a setting, a resource or an asset changes, and
+#   again once the change is committed.
+#
+#######################################################################
+
+
+URL_CODE_RE = re.compile(r'^[-a-zA-Z0-9_]+\Z')
+MISSING = object()
+ResolvedResource = namedtuple('ResolvedResource', ('resource_id', 'enabled', 'log_visits', 'updated_on'))
+CachedResponse = namedtuple('CachedResponse', ('updated_on', 'etag', 'last_modified', 'content', 'content_type'))
+SiteRoute = namedtuple('SiteRoute', ('site', 'setting_id', 'enabled', 'index_id'))
+
+
+def normalize_path(path):
+    """
+    Turns a request path into the url_code it would be served by.
+    :param path: The request's path_info.
+    :return: The url code (which may be '' for the root url).
+    """
+
+    return path.strip('/')
+
+
+class SiteCache(object):
+    """
+    A per-process cache split in one bucket per site. A bucket is dropped
+      as a whole when one of its site's settings or resources changes.
+      A generation counter keeps a value computed before an invalidation
+      from being stored afterwards.
+
+    Buckets hold at most the number of entries given by the setting
+      named in SIZE_SETTING, to keep random urls from growing them
+      forever: the least recently used entry makes room for a new one.
+    """
+
+    SIZE_SETTING = None
+    DEFAULT_SIZE = 10000
+
+    def __init__(self):
+        self._lock = Lock()
+        self._sites = {}
+        self._generations = {}
+        self._epoch = 0
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @property
+    def max_entries(self):
+        return getattr(settings, self.SIZE_SETTING, self.DEFAULT_SIZE)
+
+    def generation(self, site_id):
+        return self._epoch, self._generations.get(site_id, 0)
+
+    def stats(self):
+        """
+        Returns a copy of the cache's counters (hits and misses are not
+          counted under the lock, so they are approximate).
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['sites'] = len(self._sites)
+            stats['size'] = sum(len(bucket) for bucket in self._sites.values())
+            return stats
+
+    def get(self, site_id, key):
+        """
+        Gets a cached value, or MISSING if not cached.
+        """
+
+        bucket = self._sites.get(site_id)
+        value = MISSING if bucket is None else bucket.get(key, MISSING)
+        if value is MISSING:
+            self._stats['misses'] += 1
+            return value
+        self._stats['hits'] += 1
+        try:
+            bucket.move_to_end(key)
+        except (AttributeError, KeyError):
+            # Python 2 (entries are then evicted in insertion order), or
+            #   evicted meanwhile.
+            pass
+        return value
+
+    def set(self, site_id, key, value, generation):
+        """
+        Caches a value, unless the site was invalidated since the given
+          generation (i.e. since the value started being computed).
+        """
+
+        with self._lock:
+            if self.generation(site_id) == generation:
+                bucket = self._sites.get(site_id)
+                if bucket is None:
+                    bucket = self._sites[site_id] = OrderedDict()
+                bucket.pop(key, None)
+                while bucket and len(bucket) >= self.max_entries:
+                    bucket.popitem(last=False)
+                bucket[key] = value
+
+    def invalidate(self, site_id=None):
+        """
+        Drops the entries of a site, or the entire cache if no site is given.
+        :param site_id: The id of the site to invalidate.
+        :return:
+        """
+
+        with self._lock:
+            self._stats['invalidations'] += 1
+            if site_id is None:
+                self._epoch += 1
+                self._sites.clear()
+            else:
+                self._generations[site_id] = self._generations.get(site_id, 0) + 1
+                self._sites.pop(site_id, None)
+
+
+class SiteRoutes(object):
+    """
+    Maps the domains of all the sites to their SiteRoute: the site, and
+      the id, enabled flag and index id of its setting (or None, False
+      and None, for sites having no setting). The table is loaded at
+      once, in two queries, and dropped as a whole whenever a site or a
+      setting changes. While loaded, it also tells the site of each
+      setting.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._table = None
+
+    def _load(self):
+        settings_by_site = dict((site_id, (pk, enabled, index_id)) for site_id, pk, enabled, index_id in
+                                SiteSetting.objects.values_list('site_id', 'pk', 'enabled', 'index_id'))
+        by_domain = {}
+        by_site = {}
+        by_setting = {}
+        for site in Site.objects.all():
+            route = SiteRoute(site, *settings_by_site.get(site.pk, (None, False, None)))
+            by_domain[site.domain.lower()] = route
+            by_site[site.pk] = route
+            if route.setting_id is not None:
+                by_setting[route.setting_id] = route
+        return by_domain, by_site, by_setting
+
+    def _get_table(self):
+        table = self._table
+        if table is None:
+            with self._lock:
+                if self._table is None:
+                    self._table = self._load()
+                table = self._table
+        return table
+
+    def for_host(self, host):
+        """
+        Gets the route of a host, trying it with and without its port
+          (like Django's get_current_site does), and falling back to the
+          SITE_ID site, if that setting is present.
+        :param host: The request's host.
+        :return: A SiteRoute, or None if no site is served there.
+        """
+
+        by_domain, by_site, _ = self._get_table()
+        host = host.lower()
+        route = by_domain.get(host)
+        if route is None:
+            route = by_domain.get(split_domain_port(host)[0])
+        if route is None and getattr(settings, 'SITE_ID', None):
+            route = by_site.get(settings.SITE_ID)
+        return route
+
+    def for_site(self, site_id):
+        """
+        Gets the route of a site by its id, or None.
+        """
+
+        return self._get_table()[1].get(site_id)
+
+    def site_of_setting(self, setting_id):
+        """
+        Gets the id of a setting's site, only if the table is already
+          loaded (it is not loaded for this).
+        :return: The id of the site, or None if unknown.
+        """
+
+        table = self._table
+        route = None if table is None else table[2].get(setting_id)
+        return None if route is None else route.site.pk
+
+    def invalidate(self):
+        with self._lock:
+            self._table = None
+
+
+class ResolutionCache(SiteCache):
+    """
+    Maps (site id, normalized path) to the concrete resource that would
+      be served, already following aliases (and the site's index for the
+      root url). Misses are cached as well (as None), so random urls don't
+      hit the database each time. Paths which can't be url codes are
+      not even looked up (nor cached).
+
+    Resolved resources are only enabled if the site's setting is, and
+      they are considered updated when either the setting, the resource
+      or the alias (if any) was.
+    """
+
+    SIZE_SETTING = 'MANYSITES_RESOLUTION_CACHE_SIZE'
+
+    def _lookup(self, **filters):
+        resource = SiteResource.objects.with_children().filter(**filters).first()
+        if resource is None:
+            return None
+        resource = resource.as_child()
+        # Aliases point to their target; concrete resources to themselves.
+        target = getattr(resource, 'resource', None)
+        if target is None:
+            return None
+        return ResolvedResource(target.pk, resource.enabled and target.enabled and resource.setting.enabled,
+                                target.log_visits,
+                                max(resource.updated_on, target.updated_on, resource.setting.updated_on))
+
+    def lookup(self, site_id, url_code):
+        if url_code == '':
+            route = site_routes.for_site(site_id)
+            return None if route is None or route.index_id is None else self._lookup(pk=route.index_id)
+        if URL_CODE_RE.match(url_code):
+            return self._lookup(setting__site_id=site_id, url_code=url_code)
+        return None
+
+    def resolve(self, site_id, path):
+        """
+        Resolves a path in a site to its concrete resource.
+        :param site_id: The id of the current site.
+        :param path: The request's path_info.
+        :return: A ResolvedResource instance, or None if nothing is served there.
+        """
+
+        url_code = normalize_path(path)
+        if url_code and not URL_CODE_RE.match(url_code):
+            return None
+        entry = self.get(site_id, url_code)
+        if entry is MISSING:
+            generation = self.generation(site_id)
+            entry = self.lookup(site_id, url_code)
+            self.set(site_id, url_code, entry, generation)
+        return entry
+
+
+class ResponseCache(SiteCache):
+    """
+    Keeps the rendered content of the resources, per site and per
+      (url code, variant), along with the update of the resource it was
+      rendered from, and its validators.
+    """
+
+    SIZE_SETTING = 'MANYSITES_RESPONSE_CACHE_SIZE'
+    DEFAULT_SIZE = 1000
+
+
+def split_asset_path(path):
+    """
+    Splits an asset path, '<bundle>/<asset>' (or just '<asset>' for the
+      default bundle), into its (bundle code, asset code).
+    """
+
+    bundle, _, code = path.rpartition('/')
+    return bundle, code
+
+
+class AssetIndex(SiteCache):
+    """
+    Maps the '<bundle>/<asset>' paths of a site to their (concrete)
+      assets, and the (bundle code, subtype) pairs to their built
+      artifacts. Missing assets are cached as None. Assets are loaded in
+      a single query however many are asked for at once, so a template
+      can have all of its assets prefetched before being rendered.
+    """
+
+    SIZE_SETTING = 'MANYSITES_ASSET_INDEX_SIZE'
+    CHILDREN = ('imageasset', 'textasset')
+
+    def _concrete(self, asset):
+        concrete = joined_child(asset, *self.CHILDREN)
+        concrete.bundle = asset.bundle
+        return concrete
+
+    def _load(self, site_id, keys):
+        condition = Q()
+        for bundle, code in keys:
+            condition |= Q(bundle__code=bundle, code=code)
+        assets = SiteAsset.objects.non_polymorphic().filter(
+            condition, bundle__setting__site_id=site_id
+        ).select_related('bundle', *self.CHILDREN)
+        return dict(((asset.bundle.code, asset.code), self._concrete(asset)) for asset in assets)
+
+    def resolve_many(self, site_id, paths):
+        """
+        Resolves many asset paths of a site at once.
+        :param site_id: The id of the site.
+        :param paths: The '<bundle>/<asset>' paths.
+        :return: A dictionary mapping each path to its asset (or None).
+        """
+
+        resolved = {}
+        missing = {}
+        for path in paths:
+            key = split_asset_path(path)
+            asset = self.get(site_id, key)
+            if asset is MISSING:
+                missing[key] = path
+            else:
+                resolved[path] = asset
+        if missing:
+            generation = self.generation(site_id)
+            loaded = self._load(site_id, missing)
+            for key, path in missing.items():
+                resolved[path] = loaded.get(key)
+                self.set(site_id, key, resolved[path], generation)
+        return resolved
+
+    def resolve(self, site_id, path):
+        """
+        Resolves an asset path of a site.
+        :return: The asset, or None if there is no such asset.
+        """
+
+        return self.resolve_many(site_id, [path])[path]
+
+    def artifact(self, site_id, bundle, subtype):
+        """
+        Gets the built artifact of a bundle of a site, for a subtype.
+        :return: The artifact, or None if there is none.
+        """
+
+        artifacts = self.get(site_id, 'artifacts')
+        if artifacts is MISSING:
+            generation = self.generation(site_id)
+            artifacts = dict(((artifact.bundle.code, artifact.content_subtype), artifact)
+                             for artifact in SiteBundleArtifact.objects.filter(
+                                 bundle__setting__site_id=site_id
+                             ).select_related('bundle'))
+            self.set(site_id, 'artifacts', artifacts, generation)
+        return artifacts.get((bundle, subtype))
+
+
+site_routes = SiteRoutes()
+resolution_cache = ResolutionCache()
+response_cache = ResponseCache()
+asset_index = AssetIndex()
+
+
+def drop_site(site_id=None):
+    """
+    Drops every cache this process keeps for a site (or all of them, if
+      no site is given), without telling the other processes.
+    :param site_id: The id of the affected site, or None.
+    :return:
+    """
+
+    resolution_cache.invalidate(site_id)
+    response_cache.invalidate(site_id)
+    asset_index.invalidate(site_id)
+
+
+class InvalidationBus(object):
+    """
+    Tells the other processes (e.g. the other workers of the server)
+      which sites changed, through the SiteCacheVersion table: each
+      invalidation bumps the version of its site (or the 0 one, for all
+      the sites), and each process polls the table, in a single query, at
+      most once every MANYSITES_CACHE_STALENESS seconds (by default, 2),
+      dropping its caches of the sites whose version changed. So a change
+      takes at most that long to be seen everywhere. The first poll of a
+      process (made by the routing middleware before any cache is used)
+      only takes the current versions as the ones already seen.
+
+    Setting MANYSITES_CACHE_STALENESS to None disables the bus (for
+      single-process deployments).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._versions = None
+        self._polled_on = None
+
+    @property
+    def staleness(self):
+        return getattr(settings, 'MANYSITES_CACHE_STALENESS', 2)
+
+    def publish(self, site_id=None):
+        """
+        Bumps the version of a site (or of all of them, if None).
+        """
+
+        if self.staleness is not None:
+            SiteCacheVersion.bump(site_id or 0)
+
+    def poll(self):
+        """
+        Drops the local caches of the sites changed by other processes,
+          unless polled less than MANYSITES_CACHE_STALENESS seconds ago.
+        """
+
+        staleness = self.staleness
+        if staleness is None:
+            return
+        current = time.time()
+        if self._polled_on is not None and current - self._polled_on < staleness:
+            return
+        if not self._lock.acquire(False):
+            # Another thread is polling right now.
+            return
+        try:
+            self._polled_on = current
+            versions = dict(SiteCacheVersion.objects.values_list('site_id', 'version'))
+            if self._versions is None:
+                changed = []
+            else:
+                changed = [site_id for site_id, version in versions.items()
+                           if self._versions.get(site_id) != version]
+            self._versions = versions
+        finally:
+            self._lock.release()
+        if changed:
+            site_routes.invalidate()
+        if 0 in changed:
+            drop_site()
+        else:
+            for site_id in changed:
+                drop_site(site_id)
+
+
+invalidation_bus = InvalidationBus()
+
+
+def invalidate_site(site_id=None, routes=False):
+    """
+    Invalidates every cache we keep for a site (or all of them, if the
+      site could not be determined), in this process and, through the
+      invalidation bus, in the others. This process' caches are dropped
+      right away and again once the current transaction is committed
+      (values computed meanwhile by other threads may predate the
+      change), and the other processes are told after the commit.
+    :param site_id: The id of the affected site, or None.
+    :param routes: Whether the routes table must be dropped as well.
+    :return:
+    """
+
+    def drop():
+        if routes:
+            site_routes.invalidate()
+        drop_site(site_id)
+
+    def committed():
+        drop()
+        invalidation_bus.publish(site_id)
+
+    drop()
+    transaction.on_commit(committed)
+
+
+def _loaded(instance, name):
+    # The related object, if already loaded (e.g. assigned by a form).
+    return getattr(instance, instance._meta.get_field(name).get_cache_name(), None)
+
+
+def _site_id_for_setting(setting_id, setting=None):
+    # Queried only when neither the setting nor the routes table tell it.
+    if setting is not None:
+        return setting.site_id
+    site_id = site_routes.site_of_setting(setting_id)
+    if site_id is not None:
+        return site_id
+    try:
+        return SiteSetting.objects.values_list('site_id', flat=True).get(pk=setting_id)
+    except SiteSetting.DoesNotExist:
+        return None
+
+
+@receiver([post_save, post_delete], sender=Site)
+def after_site_change(sender, instance, **kwargs):
+    """
+    Invalidation of the routes, and the caches of the site
+    """
+    invalidate_site(instance.pk, routes=True)
+
+
+@receiver([post_save, post_delete], sender=SiteSetting)
+def after_setting_change(sender, instance, **kwargs):
+    """
+    Invalidation of the routes, and the caches of the setting's site
+    """
+    invalidate_site(instance.site_id, routes=True)
+
+
+@receiver([post_save, post_delete], sender=SiteResource)
+@receiver([post_save, post_delete], sender=SiteResourceAlias)
+@receiver([post_save, post_delete], sender=SiteConcreteResource)
+def after_resource_change(sender, instance, **kwargs):
+    """
+    Invalidation of the caches of the resource's site
+    """
+    invalidate_site(_site_id_for_setting(instance.setting_id, _loaded(instance, 'setting')))
+
+
+def _site_id_for_bundle(bundle_id, bundle=None):
+    if bundle is not None:
+        return _site_id_for_setting(bundle.setting_id, _loaded(bundle, 'setting'))
+    try:
+        return SiteBundle.objects.values_list('setting__site_id', flat=True).get(pk=bundle_id)
+    except SiteBundle.DoesNotExist:
+        return None
+
+
+@receiver([post_save, post_delete], sender=SiteBundle)
+def after_bundle_change(sender, instance, **kwargs):
+    """
+    Invalidation of the caches of the bundle's site
+    """
+    invalidate_site(_site_id_for_setting(instance.setting_id, _loaded(instance, 'setting')))
+
+
+@receiver([post_save, post_delete], sender=SiteAsset)
+@receiver([post_save, post_delete], sender=ImageAsset)
+@receiver([post_save, post_delete], sender=TextAsset)
+@receiver([post_save, post_delete], sender=SiteBundleArtifact)
+def after_asset_change(sender, instance, **kwargs):
+    """
+    Invalidation of the caches of the asset's (or artifact's) site
+    """
+    invalidate_site(_site_id_for_bundle(instance.bundle_id, _loaded(instance, 'bundle')))
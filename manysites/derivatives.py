@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import os
+from io import BytesIO
+from threading import Lock
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+logger = logging.getLogger(__name__)
+
+
+#######################################################################
+#
+# Image assets get resized copies (derivatives) of their image, for each
+#   width in MANYSITES_IMAGE_DERIVATIVE_WIDTHS smaller than the original,
+#   in its original format and in each of MANYSITES_IMAGE_DERIVATIVE_FORMATS
+#   (by default, WEBP). They are generated after the upload is committed,
+#   by a pool of MANYSITES_IMAGE_DERIVATIVE_WORKERS threads (or inline if
+#   concurrent.futures is not available), and stored under names which
+#   only depend on the original's name, the width and the format.
+#
+# Each asset records the formats having all their derivatives, which
+#   pages offer independently of each other, and the formats Pillow could
+#   not write (e.g. WEBP, if built without it), which are not tried again
+#   until a new image is uploaded.
+#
+#######################################################################
+
+
+FORMAT_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'GIF': 'gif',
+    'WEBP': 'webp',
+}
+FORMAT_MIME_TYPES = {
+    'WEBP': 'image/webp',
+}
+ORIGINAL_FORMAT = 'ORIGINAL'
+
+
+def derivative_widths(width):
+    """
+    Gets the widths of the derivatives of an image that wide.
+    """
+
+    widths = getattr(settings, 'MANYSITES_IMAGE_DERIVATIVE_WIDTHS', (160, 320, 640, 1280))
+    return [w for w in widths if w < width]
+
+
+def derivative_formats():
+    """
+    Gets the extra formats of the derivatives (None stands for the
+      original format, which is always generated).
+    """
+
+    return [None] + list(getattr(settings, 'MANYSITES_IMAGE_DERIVATIVE_FORMATS', ('WEBP',)))
+
+
+def format_code(image_format):
+    """
+    Gets the code of a derivative format, as recorded by the assets
+      (ORIGINAL_FORMAT for the original format).
+    """
+
+    return image_format or ORIGINAL_FORMAT
+
+
+def derivative_name(image_name, width, image_format=None):
+    """
+    Gets the storage name of a derivative.
+    :param image_name: The storage name of the original image.
+    :param width: The width of the derivative.
+    :param image_format: The format of the derivative, or None for the original format.
+    :return: The name.
+    """
+
+    base, extension = os.path.splitext(image_name)
+    if image_format is not None:
+        extension = '.' + FORMAT_EXTENSIONS.get(image_format, image_format.lower())
+    digest = hashlib.sha1(image_name.encode('utf-8')).hexdigest()[:12]
+    return 'bundle/derivatives/%s/%s-%dw%s' % (digest, os.path.basename(base), width, extension)
+
+
+def generate_derivatives(asset_id, image_name):
+    """
+    Generates the missing derivatives of an image asset, and records the
+      formats having all of them, and the ones which could not be
+      written, unless the image changed in the meantime.
+    :param asset_id: The id of the asset.
+    :param image_name: The storage name of the image the derivatives are for.
+    """
+
+    from .models import ImageAsset
+
+    with default_storage.open(image_name) as original_file:
+        original = Image.open(original_file)
+        original.load()
+    original_format = original.format
+
+    formats = derivative_formats()
+    unsupported = set()
+    for width in derivative_widths(original.size[0]):
+        height = max(int(round(original.size[1] * width / float(original.size[0]))), 1)
+        resized = None
+        for image_format in formats:
+            name = derivative_name(image_name, width, image_format)
+            if image_format in unsupported or default_storage.exists(name):
+                continue
+            if resized is None:
+                resized = original.resize((width, height), Image.ANTIALIAS)
+            output = BytesIO()
+            target_format = image_format or original_format
+            image = resized
+            if target_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            try:
+                image.save(output, format=target_format)
+            except (IOError, KeyError):
+                # e.g. a Pillow without WEBP support.
+                logger.warning('Could not save a %s derivative of %s', target_format, image_name)
+                unsupported.add(image_format)
+                continue
+            default_storage.save(name, ContentFile(output.getvalue()))
+
+    # This update sends no signal, so the caches must be told.
+    if ImageAsset.objects.filter(pk=asset_id, image=image_name).update(
+        ready_formats=' '.join(format_code(image_format) for image_format in formats
+                               if image_format not in unsupported),
+        unsupported_formats=' '.join(format_code(image_format) for image_format in formats
+                                     if image_format in unsupported)
+    ):
+        from .caches import invalidate_site
+        invalidate_site(ImageAsset.objects.non_polymorphic().values_list(
+            'bundle__setting__site_id', flat=True
+        ).filter(pk=asset_id).first())
+
+
+class DerivativesPool(object):
+    """
+    Runs the generation of derivatives in background threads.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._executor = None
+
+    def _run(self, asset_id, image_name):
+        try:
+            generate_derivatives(asset_id, image_name)
+        except Exception:
+            logger.exception('Could not generate the derivatives of %s', image_name)
+        finally:
+            connection.close()
+
+    def submit(self, asset_id, image_name):
+        if ThreadPoolExecutor is None:
+            generate_derivatives(asset_id, image_name)
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(getattr(settings, 'MANYSITES_IMAGE_DERIVATIVE_WORKERS', 2))
+        self._executor.submit(self._run, asset_id, image_name)
+
+    def schedule(self, asset_id, image_name):
+        """
+        Generates the derivatives once the current transaction is
+          committed (so the worker can see the asset).
+        """
+
+        transaction.on_commit(lambda: self.submit(asset_id, image_name))
+
+
+derivatives_pool = DerivativesPool()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import tempfile
+from datetime import datetime, time
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import six, timezone
+from .models import SiteConcreteResourceVisit
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+
+#######################################################################
+#
+# Exports of the raw visits, meant for tables of tens of millions of
+#   rows: they are read in chunks, seeking by id (each chunk is a query
+#   starting after the last id of the previous one, so memory does not
+#   depend on the number of rows, nor the queries on the offset), and
+#   written as they come, either as a CSV stream or as an XLSX workbook
+#   in XlsxWriter's constant_memory mode.
+#
+#######################################################################
+
+
+HEADERS = ('id', 'site', 'resource', 'visited_on', 'visited_from')
+XLSX_MAX_ROWS = 1048576
+
+
+def day_start(day):
+    """
+    Gets the moment a day starts, in the current time zone.
+    """
+
+    moment = datetime.combine(day, time())
+    return timezone.make_aware(moment) if settings.USE_TZ else moment
+
+
+def visits_for(resources=None, sites=None, since=None, until=None):
+    """
+    Gets the visits to export.
+    :param resources: Ids (or instances) of the resources, or None for all.
+    :param sites: Ids (or instances) of the sites, or None for all.
+    :param since: The first date (or datetime) to export, if any.
+    :param until: The date (or datetime) to export up to (excluded), if any.
+    :return: The visits queryset.
+    """
+
+    visits = SiteConcreteResourceVisit.objects.all()
+    if resources is not None:
+        visits = visits.filter(resource__in=resources)
+    if sites is not None:
+        visits = visits.filter(resource__setting__site__in=sites)
+    if since is not None:
+        visits = visits.filter(visited_on__gte=since)
+    if until is not None:
+        visits = visits.filter(visited_on__lt=until)
+    return visits
+
+
+def iter_visit_rows(visits, chunk_size=10000):
+    """
+    Iterates the rows of the visits (see HEADERS), in chunks.
+    :param visits: The visits queryset.
+    :param chunk_size: How many rows are read per query.
+    """
+
+    rows = visits.order_by('id').values_list('id', 'resource__setting__site__domain', 'resource__url_code',
+                                             'visited_on', 'visited_from')
+    last_id = 0
+    while True:
+        chunk = list(rows.filter(id__gt=last_id)[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+class Echo(object):
+    """
+    A file-like object giving back what is written to it, so csv.writer
+      can produce the chunks of a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    if six.PY2 and isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return value
+
+
+def iter_csv(rows):
+    """
+    Iterates the lines of the rows, as CSV, headers included.
+    """
+
+    writer = csv.writer(Echo())
+    yield writer.writerow(HEADERS)
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+def write_csv(rows, output):
+    """
+    Writes the rows, as CSV, to a file.
+    :return: The number of rows.
+    """
+
+    count = 0
+    for count, line in enumerate(iter_csv(rows)):
+        output.write(line)
+    return count
+
+
+def _xlsx_value(value):
+    # Excel knows nothing about time zones: dates are written in UTC.
+    if isinstance(value, datetime) and timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return value
+
+
+def write_xlsx(rows, output):
+    """
+    Writes the rows to an XLSX workbook, in constant memory: each row is
+      flushed as soon as the next one starts. Rows exceeding the limit of
+      a worksheet go on to a new one.
+    :param output: A file name or a file-like object.
+    :return: The number of rows.
+    """
+
+    if xlsxwriter is None:
+        raise RuntimeError('XlsxWriter must be installed to export XLSX files')
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    worksheet = None
+    sheet_row = XLSX_MAX_ROWS
+    count = 0
+    try:
+        for row in rows:
+            if sheet_row == XLSX_MAX_ROWS:
+                worksheet = workbook.add_worksheet('Visits %d' % (len(workbook.worksheets()) + 1))
+                worksheet.write_row(0, 0, HEADERS)
+                sheet_row = 1
+            worksheet.write_row(sheet_row, 0, [_xlsx_value(value) for value in row])
+            sheet_row += 1
+            count += 1
+        if worksheet is None:
+            workbook.add_worksheet('Visits 1').write_row(0, 0, HEADERS)
+    finally:
+        workbook.close()
+    return count
+
+
+def csv_response(visits, filename):
+    """
+    Streams the visits as a CSV attachment.
+    """
+
+    response = StreamingHttpResponse(iter_csv(iter_visit_rows(visits)), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % filename
+    return response
+
+
+def xlsx_response(visits, filename):
+    """
+    Sends the visits as an XLSX attachment. The workbook is built in a
+      temporary file (a zip file can't be streamed while written) which
+      is then streamed, and removed once closed.
+    """
+
+    output = tempfile.TemporaryFile()
+    write_xlsx(iter_visit_rows(visits), output)
+    output.seek(0)
+    response = FileResponse(output, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    response['Content-Disposition'] = 'attachment; filename="%s.xlsx"' % filename
+    return response
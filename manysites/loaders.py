@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+from collections import OrderedDict
+from threading import Lock
+from django.conf import settings
+from django.template import engines, Origin, TemplateDoesNotExist
+from django.template.loaders.base import Loader
+from .models import SiteConcreteResource
+
+
+class CompiledTemplateCache(object):
+    """
+    Keeps the compiled templates of the resources' contents, keyed by
+      (resource id, last update), so a template is parsed once per
+      process and version. Django's cached loader can't do this for us
+      since contents live in the database, not in files.
+
+    The least recently used templates are evicted beyond
+      MANYSITES_TEMPLATE_CACHE_SIZE entries.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._templates = OrderedDict()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'MANYSITES_TEMPLATE_CACHE_SIZE', 500)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._templates)
+            return stats
+
+    def get_template(self, resource_id, updated_on, content=None):
+        """
+        Gets the compiled template of a resource.
+        :param resource_id: The id of the resource.
+        :param updated_on: When the resource was last updated.
+        :param content: The content, if already loaded. Otherwise it is
+          only loaded if the template is not cached.
+        :return: A template of the django engine.
+        """
+
+        key = (resource_id, updated_on)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._stats['hits'] += 1
+                self._templates.pop(key)
+                self._templates[key] = template
+                return template
+            self._stats['misses'] += 1
+
+        if content is None:
+            content = SiteConcreteResource.objects.non_polymorphic().values_list(
+                'content', flat=True
+            ).get(pk=resource_id)
+        template = engines['django'].from_string(content)
+
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+                self._stats['evictions'] += 1
+        return template
+
+
+template_cache = CompiledTemplateCache()
+
+
+class ResourceLoader(Loader):
+    """
+    Loads the content of a resource as template, by the name
+      'manysites/resource/<id>', from the compiled templates cache. It is
+      not installed by default: adding it to the loaders of the django
+      engine (after the file ones, and not inside the cached loader,
+      which would keep outdated contents) allows things like:
+
+        {% include 'manysites/resource/12' %}
+    """
+
+    NAME_RE = re.compile(r'^manysites/resource/(\d+)$')
+
+    def get_template(self, template_name, template_dirs=None, skip=None):
+        match = self.NAME_RE.match(template_name)
+        if not match:
+            raise TemplateDoesNotExist(template_name)
+        origin = Origin(name=template_name, template_name=template_name, loader=self)
+        if skip is not None and origin in skip:
+            raise TemplateDoesNotExist(template_name, tried=[(origin, 'Skipped')])
+        try:
+            updated_on = SiteConcreteResource.objects.non_polymorphic().values_list(
+                'updated_on', flat=True
+            ).get(pk=match.group(1))
+        except SiteConcreteResource.DoesNotExist:
+            raise TemplateDoesNotExist(template_name, tried=[(origin, 'Source does not exist')])
+        return template_cache.get_template(int(match.group(1)), updated_on).template
+
+    def get_contents(self, origin):
+        match = self.NAME_RE.match(origin.template_name)
+        try:
+            return SiteConcreteResource.objects.non_polymorphic().values_list(
+                'content', flat=True
+            ).get(pk=match.group(1))
+        except SiteConcreteResource.DoesNotExist:
+            raise TemplateDoesNotExist(origin)
+
+    def get_template_sources(self, template_name):
+        if self.NAME_RE.match(template_name):
+            yield Origin(name=template_name, template_name=template_name, loader=self)
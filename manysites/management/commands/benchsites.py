@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+from django.core.servers.basehttp import get_internal_wsgi_application
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import override_settings
+from captcha.backends import get_backend
+from manysites.benchmarks import WSGIBenchmark, generate_fixtures, scenarios
+
+
+class Command(BaseCommand):
+    """
+    Benchmarks the request path of the sites: creates a test database
+      (an in-memory one, for SQLite) with many generated sites, and sends
+      requests for indexes, resources, aliases, missing urls and captcha
+      images (already generated: only serving them is measured) through
+      the project's WSGI application. Files (built bundles, captchas) go
+      to a temporary directory. The results are printed (or written) as
+      JSON, to be compared across runs.
+    """
+
+    help = 'Benchmarks the sites request path against generated fixtures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sites', type=int, default=1000, help='How many sites to generate')
+        parser.add_argument('--resources', type=int, default=5, help='How many resources per site')
+        parser.add_argument('--aliases', type=int, default=2, help='How many aliases per site')
+        parser.add_argument('--assets', type=int, default=3, help='How many text assets per subtype and site')
+        parser.add_argument('--requests', type=int, default=1000, help='How many requests per scenario')
+        parser.add_argument('--warmup', type=int, default=100,
+                            help='How many requests per scenario are sent before measuring')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random choice of urls')
+        parser.add_argument('--output', default=None, help='Write the JSON results to this file')
+
+    def captcha_requests(self, fixtures, count, seed):
+        rnd = random.Random(seed)
+        backend = get_backend()
+        return [(rnd.choice(fixtures['domains']), reverse('captcha:render', args=[backend.generate('benchmark')]))
+                for _ in range(count)]
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='benchsites-')
+        with override_settings(MEDIA_ROOT=os.path.join(directory, 'media'),
+                               STATIC_ROOT=os.path.join(directory, 'static'), DEBUG=False):
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                started = time.time()
+                # No need to tell other processes about each fixture saved.
+                with override_settings(MANYSITES_CACHE_STALENESS=None):
+                    fixtures = generate_fixtures(options['sites'], options['resources'], options['aliases'],
+                                                 options['assets'])
+                fixtures_seconds = time.time() - started
+
+                benchmark = WSGIBenchmark(get_internal_wsgi_application())
+                count = options['requests'] + options['warmup']
+                results = [benchmark.run(name, requests, options['warmup'])
+                           for name, requests in scenarios(fixtures, count, options['seed'])]
+                results.append(benchmark.run('captcha_serve', self.captcha_requests(fixtures, count, options['seed']),
+                                             options['warmup']))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                shutil.rmtree(directory, ignore_errors=True)
+
+        output = json.dumps({
+            'database': connection.vendor,
+            'fixtures': {
+                'sites': options['sites'],
+                'resources_per_site': options['resources'],
+                'aliases_per_site': options['aliases'],
+                'assets_per_site': options['assets'] * 3,
+                'seconds': fixtures_seconds,
+            },
+            'results': results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as results_file:
+                results_file.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from manysites.assets import build_bundle
+from manysites.models import SiteBundle
+
+
+class Command(BaseCommand):
+    """
+    Builds the css and javascript files of the bundles. Bundles are built
+      on their own when their text assets change: this is meant for the
+      initial build, or for rebuilding after a change of minifiers.
+    """
+
+    help = 'Builds the bundles of all (or some) sites'
+
+    def add_arguments(self, parser):
+        parser.add_argument('domains', nargs='*', help='Only build the bundles of the sites with these domains')
+
+    def handle(self, *args, **options):
+        bundles = SiteBundle.objects.select_related('setting__site')
+        if options['domains']:
+            bundles = bundles.filter(setting__site__domain__in=options['domains'])
+        for bundle in bundles:
+            for artifact in build_bundle(bundle):
+                self.stdout.write('%s: %s' % (bundle, artifact.name))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import sys
+from datetime import datetime
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from manysites.exports import day_start, visits_for, iter_visit_rows, write_csv, write_xlsx
+
+
+class Command(BaseCommand):
+    """
+    Exports the visits of some sites and/or resources over a range of
+      dates, as CSV or XLSX, in constant memory however many they are.
+    """
+
+    help = 'Exports the visits to a CSV or XLSX file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', action='append', dest='sites', metavar='DOMAIN',
+                            help='Export the visits of the site having this domain (can be repeated)')
+        parser.add_argument('--resource', action='append', dest='resources', type=int, metavar='ID',
+                            help='Export the visits of the resource having this id (can be repeated)')
+        parser.add_argument('--since', help='The first day to export (YYYY-MM-DD)')
+        parser.add_argument('--until', help='The day to export up to, excluded (YYYY-MM-DD)')
+        parser.add_argument('--format', choices=('csv', 'xlsx'), default='csv')
+        parser.add_argument('--output', help='The file to write (the standard output, for CSV, if not given)')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='How many visits are read per query')
+
+    def parse_date(self, value):
+        if value is None:
+            return None
+        try:
+            return day_start(datetime.strptime(value, '%Y-%m-%d').date())
+        except ValueError:
+            raise CommandError('Invalid date: %s' % value)
+
+    def handle(self, *args, **options):
+        sites = None
+        if options['sites']:
+            sites = list(Site.objects.filter(domain__in=options['sites']).values_list('pk', flat=True))
+            if len(sites) != len(set(options['sites'])):
+                raise CommandError('Some of the given domains have no site')
+        visits = visits_for(resources=options['resources'], sites=sites, since=self.parse_date(options['since']),
+                            until=self.parse_date(options['until']))
+        rows = iter_visit_rows(visits, options['chunk_size'])
+
+        if options['format'] == 'xlsx':
+            if not options['output']:
+                raise CommandError('An output file is required for XLSX exports')
+            try:
+                count = write_xlsx(rows, options['output'])
+            except RuntimeError as e:
+                raise CommandError(str(e))
+        elif options['output']:
+            # The csv module ends its lines on its own.
+            with (open(options['output'], 'wb') if sys.version_info[0] == 2 else
+                  open(options['output'], 'w', newline='')) as output:
+                count = write_csv(rows, output)
+        else:
+            count = write_csv(rows, sys.stdout)
+        self.stderr.write('Exported %d visits' % count)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import time
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from manysites.provisioning import export_site, provision_site
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+class Command(BaseCommand):
+    """
+    Creates a site out of a manifest file (JSON, or YAML if PyYAML is
+      installed), or clones an existing site. With --export, prints the
+      manifest of an existing site instead (e.g. to be used as template).
+    """
+
+    help = 'Provisions a site from a manifest, or clones an existing one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', nargs='?', help='The JSON or YAML manifest file of the new site')
+        parser.add_argument('--clone', metavar='DOMAIN', help='Clone the site having this domain instead')
+        parser.add_argument('--export', metavar='DOMAIN', help='Print the manifest of the site having this domain')
+        parser.add_argument('--domain', help='The domain of the new site (required when cloning)')
+        parser.add_argument('--name', help='The name of the new site')
+
+    def get_site(self, domain):
+        try:
+            return Site.objects.get(domain=domain)
+        except Site.DoesNotExist:
+            raise CommandError('There is no site with domain %s' % domain)
+
+    def load(self, path):
+        with open(path) as manifest_file:
+            if path.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise CommandError('PyYAML must be installed to read YAML manifests')
+                return yaml.safe_load(manifest_file)
+            return json.load(manifest_file)
+
+    def handle(self, *args, **options):
+        if options['export']:
+            self.stdout.write(json.dumps(export_site(self.get_site(options['export'])), indent=2, sort_keys=True))
+            return
+
+        if options['clone']:
+            if not options['domain']:
+                raise CommandError('The domain of the clone is required')
+            manifest = export_site(self.get_site(options['clone']))
+        elif options['manifest']:
+            manifest = self.load(options['manifest'])
+        else:
+            raise CommandError('Either a manifest or a site to clone is required')
+
+        started = time.time()
+        try:
+            site = provision_site(manifest, options['domain'], options['name'])
+        except (ValueError, KeyError) as e:
+            raise CommandError('Invalid manifest: %s' % e)
+        self.stdout.write('Provisioned %s (%d resources) in %.2fs' % (
+            site.domain, len(manifest.get('resources', [])), time.time() - started
+        ))
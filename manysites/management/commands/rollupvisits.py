@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from manysites.rollups import rollup_visits, prune_visits
+
+
+class Command(BaseCommand):
+    """
+    Rolls up the visits logged since the last run, and optionally prunes
+      the raw visits already rolled up. Meant to be run periodically.
+    """
+
+    help = 'Rolls up the new visits into the hourly and daily rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='How many visits are processed per transaction')
+        parser.add_argument('--lag', type=int, default=None,
+                            help='Overrides MANYSITES_VISIT_ROLLUP_LAG: how many seconds a visit must have '
+                                 'been seen before it is rolled up')
+        parser.add_argument('--prune', action='store_true', default=False,
+                            help='Delete the rolled up visits older than the retention period')
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help='Overrides MANYSITES_VISIT_RETENTION_DAYS when pruning')
+
+    def handle(self, *args, **options):
+        rolled_up = rollup_visits(batch_size=options['batch_size'], lag=options['lag'])
+        self.stdout.write('Rolled up %d visits' % rolled_up)
+        if options['prune']:
+            pruned = prune_visits(retention_days=options['retention_days'])
+            self.stdout.write('Pruned %d visits' % pruned)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from manysites.visits import VisitWriter
+
+
+class Command(BaseCommand):
+    """
+    Runs the writer of the visits queued by the web processes (with
+      MANYSITES_VISIT_BUFFER = 'queue'), storing them in batches. Meant
+      to run as a separate, long-lived process on each web host.
+    """
+
+    help = 'Stores the queued visits in the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait between drains of the queue')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Drain the queue once and exit')
+
+    def handle(self, *args, **options):
+        writer = VisitWriter()
+        if options['once']:
+            # Everything already queued is settled by now.
+            writer.SETTLE = 0
+        try:
+            while True:
+                writer.drain()
+                if options['verbosity'] > 1 or options['once']:
+                    self.stdout.write(' '.join('%s=%s' % item for item in sorted(writer.stats().items())))
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import bisect
+import logging
+import numbers
+import time
+from contextlib import contextmanager
+from threading import Lock
+from django.conf import settings
+from django.db import connection
+
+
+slow_logger = logging.getLogger('manysites.slow')
+
+
+#######################################################################
+#
+# Per-process instrumentation. With MANYSITES_METRICS set, requests are
+#   timed and their queries counted per site (by MetricsMiddleware),
+#   and a few hot spots are timed through `timed` (visit logging and
+#   writing) or through the signals of their app (captcha generation
+#   and rendering, see the receivers below). Everything is exposed in
+#   the Prometheus text format by the metrics view, along with the
+#   counters of the caches, buffers and pools (their stats() methods).
+#
+# Counting queries requires the connections to log them, which has a
+#   cost of its own: that is why all of this is opt-in.
+#
+#######################################################################
+
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def enabled():
+    return getattr(settings, 'MANYSITES_METRICS', False)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observations, in the Prometheus fashion.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+class MetricsRegistry(object):
+    """
+    Keeps the histograms and counters, keyed by (name, labels), and the
+      collectors: callables returning a dictionary of numbers (like the
+      stats() methods around), exposed as gauges under a prefix.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_collector(self, prefix, collector):
+        self._collectors.append((prefix, collector))
+
+    def render(self):
+        """
+        Renders everything in the Prometheus text format.
+        """
+
+        lines = []
+        with self._lock:
+            histograms = sorted((key, list(histogram.cumulative()), histogram.sum)
+                                for key, histogram in self._histograms.items())
+            counters = sorted(self._counters.items())
+        declared = set()
+        for (name, labels), buckets, total in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for bound, count in buckets:
+                lines.append('%s_bucket%s %d' % (name, _labels(labels + (('le', bound),)), count))
+            lines.append('%s_sum%s %f' % (name, _labels(labels), total))
+            lines.append('%s_count%s %d' % (name, _labels(labels), buckets[-1][1]))
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+        for prefix, collector in self._collectors:
+            for key, value in sorted(collector().items()):
+                if isinstance(value, bool):
+                    value = int(value)
+                elif not isinstance(value, numbers.Number):
+                    # Gauges are numbers: anything else (e.g. a mode,
+                    #   or a depth not known yet) is left out.
+                    continue
+                lines.append('# TYPE %s_%s gauge' % (prefix, key))
+                lines.append('%s_%s %s' % (prefix, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+registry = MetricsRegistry()
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Times a block into the given histogram, if metrics are enabled.
+    """
+
+    if not enabled():
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        registry.observe(name, time.time() - started, **labels)
+
+
+def count(name, amount=1, **labels):
+    """
+    Increments a counter, if metrics are enabled.
+    """
+
+    if enabled():
+        registry.increment(name, amount, **labels)
+
+
+def captcha_generated(sender, source, seconds, **kwargs):
+    """
+    Receiver of captcha.signals.captcha_generated.
+    """
+
+    if enabled():
+        registry.observe('captcha_generate_seconds', seconds)
+        registry.increment('captcha_generated_total', source=source)
+
+
+def captcha_served(sender, seconds, **kwargs):
+    """
+    Receiver of captcha.signals.captcha_served.
+    """
+
+    if enabled():
+        registry.observe('captcha_render_once_seconds', seconds)
+
+
+class MetricsMiddleware(object):
+    """
+    Times each request and counts its queries, per site. Meant to be
+      the first middleware, so the whole stack is measured.
+
+    With MANYSITES_SLOW_REQUEST_SECONDS set, requests taking longer than
+      that are logged (to the 'manysites.slow' logger) with their SQL.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not enabled():
+            return self.get_response(request)
+
+        force_debug_cursor = connection.force_debug_cursor
+        connection.force_debug_cursor = True
+        first_query = len(connection.queries_log)
+        started = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            connection.force_debug_cursor = force_debug_cursor
+        elapsed = time.time() - started
+        queries = list(connection.queries_log)[first_query:]
+
+        site = getattr(request, 'site', None)
+        site = site.domain if site is not None else '-'
+        registry.observe('manysites_request_seconds', elapsed, site=site)
+        registry.observe('manysites_request_queries', len(queries), buckets=QUERIES_BUCKETS, site=site)
+        registry.increment('manysites_requests_total', site=site, status='%dxx' % (response.status_code // 100))
+
+        threshold = getattr(settings, 'MANYSITES_SLOW_REQUEST_SECONDS', None)
+        if threshold is not None and elapsed >= threshold:
+            slow_logger.warning('Slow request: %s %s%s took %.3fs and %d queries:\n%s', request.method, site,
+                                request.get_full_path(), elapsed, len(queries),
+                                '\n'.join('[%s] %s' % (query['time'], query['sql']) for query in queries))
+        return response
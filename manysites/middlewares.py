@@ -1,12 +1,50 @@
+from django.conf import settings
+from django.http import Http404
 from django.utils.deprecation import MiddlewareMixin
 
-from manysites.models import SiteResource
+from manysites.caches import resolution_cache, site_routes, invalidation_bus
+from manysites.metrics import timed
+from manysites.models import SiteConcreteResource
+
+
+class SiteRoutingMiddleware(MiddlewareMixin):
+    """
+    Replaces django.contrib.sites' CurrentSiteMiddleware: sets request.site
+      (and request.site_route, with the site's setting id, enabled flag
+      and index id) out of the in-memory routes table, so no query is
+      made per request. Unknown hosts, and sites whose setting is disabled,
+      get a 404 (except under MANYSITES_ROUTING_EXEMPT_PATHS, by default
+      the admin and the metrics, so disabled sites can still be managed).
+
+    It also polls the invalidation bus, so the caches of this process
+      catch up with the changes made by the other ones.
+    """
+
+    def process_request(self, request):
+        invalidation_bus.poll()
+        route = site_routes.for_host(request.get_host())
+        exempt = request.path_info.startswith(tuple(getattr(settings, 'MANYSITES_ROUTING_EXEMPT_PATHS',
+                                                            ('/admin/', '/manysites/'))))
+        if route is None:
+            if exempt:
+                request.site_route = None
+                return
+            raise Http404('No site is served at this host')
+        if route.setting_id is not None and not route.enabled and not exempt:
+            raise Http404('This site is disabled')
+        request.site = route.site
+        request.site_route = route
 
 
 class SiteResourceVisitsLogger(MiddlewareMixin):
 
     def process_request(self, request):
-        try:
-            SiteResource.objects.get(sitesetting__site=request.site, url_code=request.path_info).resource.visit(request)
-        except SiteResource.DoesNotExist:
-            pass
+        site = getattr(request, 'site', None)
+        route = getattr(request, 'site_route', None)
+        if site is None or (route is not None and route.setting_id is None):
+            # Sites without a setting have no resources.
+            return
+        with timed('manysites_resolution_seconds'):
+            resolved = resolution_cache.resolve(request.site.pk, request.path_info)
+        if resolved is not None and resolved.enabled and resolved.log_visits:
+            SiteConcreteResource.log_visit(resolved.resource_id, request)
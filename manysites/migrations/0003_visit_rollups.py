@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 12:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manysites', '0002_auto_20171217_2105'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteConcreteResourceVisitRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('period_start', models.DateTimeField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('unique_ips', models.PositiveIntegerField(default=0)),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visit_rollups', to='manysites.SiteConcreteResource')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SiteConcreteResourceVisitRollupMark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_visit_id', models.PositiveIntegerField(default=0)),
+                ('updated_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('pending_visit_id', models.PositiveIntegerField(default=0)),
+                ('pending_on', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='siteconcreteresourcevisitrollup',
+            unique_together=set([('resource', 'period', 'period_start')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# The resources need no index of their own: the unique (setting, url_code)
+#   one already serves their lookups, and a partial one (WHERE enabled)
+#   would only duplicate it, since the enabled flag is read from the row
+#   found (a disabled resource must still be told apart from a missing one).
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manysites', '0003_visit_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='siteconcreteresourcevisit',
+            index=models.Index(fields=['resource', 'visited_on'], name='manysites_visit_resource_on'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 15:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manysites', '0004_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteBundleArtifact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_subtype', models.CharField(choices=[('plain', 'Plain'), ('javascript', 'Javascript'), ('css', 'CSS')], max_length=10)),
+                ('name', models.CharField(max_length=255)),
+                ('digest', models.CharField(max_length=64)),
+                ('built_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('bundle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='artifacts', to='manysites.SiteBundle')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='sitebundleartifact',
+            unique_together=set([('bundle', 'content_subtype')]),
+        ),
+    ]
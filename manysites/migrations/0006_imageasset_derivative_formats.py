@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manysites', '0005_sitebundleartifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageasset',
+            name='ready_formats',
+            field=models.CharField(blank=True, default='', editable=False, help_text='The formats having all their derivatives generated', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='imageasset',
+            name='unsupported_formats',
+            field=models.CharField(blank=True, default='', editable=False, help_text='The formats derivatives could not be generated in', max_length=255),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-18 17:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manysites', '0007_siteresource_managers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteCacheVersion',
+            fields=[
+                ('site_id', models.PositiveIntegerField(primary_key=True, serialize=False)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('updated_on', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
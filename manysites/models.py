@@ -2,16 +2,26 @@
 from __future__ import unicode_literals
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models.signals import pre_save, post_save
+from django.dispatch import receiver
 from django.utils.html import format_html
 from django.utils.six import python_2_unicode_compatible
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
+from django.contrib.staticfiles.storage import staticfiles_storage
+from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
 from grimoire.django.tracked.models import TrackedLive
-from grimoire.django.tracked.models.polymorphic import TrackedLive as PolymorphicTrackedLive
+from grimoire.django.tracked.models.polymorphic import TrackedLive as PolymorphicTrackedLive, \
+    TrackedLiveQuerySet as PolymorphicTrackedLiveQuerySet
+from .derivatives import derivative_formats, derivative_name, derivative_widths, derivatives_pool, format_code
+from .metrics import count, timed
+from .visits import visit_buffer
 
 
 #######################################################################
@@ -53,6 +63,46 @@ class SiteSetting(TrackedLive):
         return "%s site's setting" % self.site
 
 
+def joined_child(instance, *names):
+    """
+    Gets the child row of a non polymorphic instance, out of the ones
+      joined by select_related(*names). The accessors of the child rows
+      can't be used for this: polymorphic replaces them by ones always
+      querying the database.
+    :return: The first child row joined, or the instance itself if none.
+    """
+
+    for name in names:
+        child = getattr(instance, instance._meta.get_field(name).get_cache_name(), None)
+        if child is not None:
+            return child
+    return instance
+
+
+class SiteResourceQuerySet(PolymorphicTrackedLiveQuerySet):
+    """
+    Adds a fast path to the polymorphic (and tracked) queries of the
+      resources.
+    """
+
+    CHILDREN = ('siteresourcealias__resource', 'siteconcreteresource')
+
+    def with_children(self):
+        """
+        Gets the resources as plain (non polymorphic) rows, with their
+          setting and site, and their child rows, joined in the same
+          query. This is a single query regardless of the number of rows
+          and their types, while the polymorphic dispatch takes one per
+          child type (plus one per row and relation being accessed).
+
+        Rows can then be turned into their concrete type by calling
+          .as_child() on them, which does not hit the database.
+        :return: A non polymorphic queryset.
+        """
+
+        return self.non_polymorphic().select_related('setting__site', *self.CHILDREN)
+
+
 @python_2_unicode_compatible
 class SiteResource(PolymorphicTrackedLive):
     """
@@ -86,11 +136,31 @@ class SiteResource(PolymorphicTrackedLive):
                                   help_text=_('If you uncheck this, this resource when being '
                                               'accessed will raise a 404 error'))
 
+    objects = PolymorphicManager.from_queryset(SiteResourceQuerySet)()
+
     class Meta:
         unique_together = (('setting', 'url_code'),)
 
+    def as_child(self):
+        """
+        Gets the instance of the concrete type of this resource, out of
+          the child rows joined by .with_children() (otherwise, it costs
+          a query). The setting is shared with the returned instance.
+        :return: A SiteResourceAlias or SiteConcreteResource instance.
+        """
+
+        model = ContentType.objects.get_for_id(self.polymorphic_ctype_id).model_class()
+        if model is None or isinstance(self, model):
+            return self
+        child = joined_child(self, model._meta.model_name)
+        if child is self:
+            child = model.base_objects.get(pk=self.pk)
+        child.setting = self.setting
+        return child
+
     def __str__(self):
-        return '%s/%s' % (self.setting.site, '' if self.setting.index == self else self.url_code)
+        # Comparing ids keeps the index from being fetched.
+        return '%s/%s' % (self.setting.site, '' if self.setting.index_id == self.pk else self.url_code)
 
 
 class SiteResourceAlias(SiteResource):
@@ -131,7 +201,8 @@ class SiteConcreteResource(SiteResource):
         """
         return self
 
-    def _get_client_ip(self, request):
+    @staticmethod
+    def _get_client_ip(request):
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
             last_ip = getattr(settings, 'MANYSITES_VISIT_TRACK_LAST_PROXYCHAIN_IP', False)
@@ -148,7 +219,29 @@ class SiteConcreteResource(SiteResource):
         """
 
         if self.log_visits:
-            self.visits.create(visited_from=self._get_client_ip(request))
+            self.log_visit(self.pk, request)
+
+    @classmethod
+    def log_visit(cls, resource_id, request):
+        """
+        Stores a visit to a resource, given just its id. This one is
+          useful when the resource was resolved without being loaded.
+
+        If MANYSITES_VISIT_BUFFER is set, the visit is buffered and
+          stored later, in a batch (see manysites.visits).
+        :param resource_id: The id of the visited resource.
+        :param request: The request to take the ip from.
+        :return:
+        """
+
+        mode = visit_buffer.mode or 'direct'
+        count('manysites_visit_writes_total', mode=mode)
+        with timed('manysites_visit_write_seconds', mode=mode):
+            if visit_buffer.mode:
+                visit_buffer.add(resource_id, cls._get_client_ip(request))
+            else:
+                SiteConcreteResourceVisit.objects.create(resource_id=resource_id,
+                                                         visited_from=cls._get_client_ip(request))
 
 
 @python_2_unicode_compatible
@@ -211,16 +304,86 @@ class ImageAsset(SiteAsset):
                               width_field='width', height_field='height')
     width = models.PositiveIntegerField(null=False, editable=False)
     height = models.PositiveIntegerField(null=False, editable=False)
+    ready_formats = models.CharField(max_length=255, default='', null=False, blank=True, editable=False,
+                                     help_text=_('The formats having all their derivatives generated'))
+    unsupported_formats = models.CharField(max_length=255, default='', null=False, blank=True, editable=False,
+                                           help_text=_('The formats derivatives could not be generated in'))
+
+    def derivatives_ready(self, image_format=None):
+        """
+        Tells whether the derivatives in the given format (or the
+          original's) are all generated.
+        """
+
+        return format_code(image_format) in self.ready_formats.split()
+
+    def pending_formats(self):
+        """
+        Gets the formats whose derivatives were neither generated nor
+          found unsupported.
+        """
+
+        done = self.ready_formats.split() + self.unsupported_formats.split()
+        return [image_format for image_format in derivative_formats() if format_code(image_format) not in done]
+
+    def derivative_urls(self, image_format=None):
+        """
+        Gets the (width, url) pairs of the derivatives in the given format
+          (or the original's), or an empty list if not generated yet.
+        """
+
+        if not self.derivatives_ready(image_format):
+            return []
+        return [(width, default_storage.url(derivative_name(self.image.name, width, image_format)))
+                for width in derivative_widths(self.width)]
+
+    def srcset(self, image_format=None):
+        """
+        Gets a srcset attribute value with the derivatives in the given
+          format (or the original's), and the original itself.
+        """
+
+        candidates = self.derivative_urls(image_format)
+        if image_format is None:
+            candidates.append((self.width, self.image.url))
+        return ', '.join('%s %dw' % (url, width) for width, url in candidates)
+
+    def thumbnail_url(self):
+        """
+        Gets the url of the smallest derivative, or of the original if
+          there are no derivatives (yet).
+        """
+
+        urls = self.derivative_urls()
+        return urls[0][1] if urls else self.image.url
 
     def preview(self):
         return format_html('<img class="admin-image-asset-thumbnail" src="{0}" />',
-                           self.image.url)
+                           self.thumbnail_url())
     preview.short_description = _('Content Preview')
 
     def _to_str(self):
         return '%s (image)' % (super(ImageAsset, self)._to_str(),)
 
 
+@receiver(pre_save, sender=ImageAsset)
+def before_image_asset_save(sender, instance, **kwargs):
+    """
+    A new upload needs new derivatives
+    """
+    if not instance.image._committed:
+        instance.ready_formats = instance.unsupported_formats = ''
+
+
+@receiver(post_save, sender=ImageAsset)
+def after_image_asset_save(sender, instance, **kwargs):
+    """
+    Generation of the missing derivatives
+    """
+    if instance.pending_formats():
+        derivatives_pool.schedule(instance.pk, instance.image.name)
+
+
 class TextAsset(SiteAsset):
     """
     This type of asset involves only text. The text will be stored as content in the
@@ -247,6 +410,31 @@ class TextAsset(SiteAsset):
         return '%s (text)' % (super(TextAsset, self)._to_str(),)
 
 
+@python_2_unicode_compatible
+class SiteBundleArtifact(models.Model):
+    """
+    The built (concatenated and minified) file of a bundle's text assets
+      of a given subtype, in the static storage. Its name includes a hash
+      of its content, so it can be cached forever.
+    """
+
+    bundle = models.ForeignKey(SiteBundle, null=False, related_name='artifacts')
+    content_subtype = models.CharField(max_length=10, choices=TextAsset.SUBTYPES, null=False, blank=False)
+    name = models.CharField(max_length=255, null=False, blank=False)
+    digest = models.CharField(max_length=64, null=False, blank=False)
+    built_on = models.DateTimeField(default=now, null=False)
+
+    class Meta:
+        unique_together = (('bundle', 'content_subtype'),)
+
+    @property
+    def url(self):
+        return staticfiles_storage.url(self.name)
+
+    def __str__(self):
+        return self.name
+
+
 @python_2_unicode_compatible
 class SiteConcreteResourceVisit(models.Model):
     """
@@ -257,5 +445,86 @@ class SiteConcreteResourceVisit(models.Model):
     visited_on = models.DateTimeField(default=now, null=False)
     visited_from = models.GenericIPAddressField(null=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource', 'visited_on'], name='manysites_visit_resource_on'),
+        ]
+
     def __str__(self):
         return '%s from %s' % (self.visited_on.strftime('%Y-%m-%d %H:%M:%S'), self.visited_from)
+
+
+@python_2_unicode_compatible
+class SiteConcreteResourceVisitRollup(models.Model):
+    """
+    Visits to a resource, aggregated per hour or per day. These ones are
+      computed from the raw visits by the `rollupvisits` command, so the
+      raw visits can be pruned afterwards.
+    """
+
+    PERIODS = (
+        ('hour', _('Hour')),
+        ('day', _('Day')),
+    )
+
+    resource = models.ForeignKey('SiteConcreteResource', null=False, related_name='visit_rollups')
+    period = models.CharField(max_length=4, choices=PERIODS, null=False, blank=False)
+    period_start = models.DateTimeField(null=False)
+    hits = models.PositiveIntegerField(default=0, null=False)
+    unique_ips = models.PositiveIntegerField(default=0, null=False)
+
+    class Meta:
+        unique_together = (('resource', 'period', 'period_start'),)
+
+    def __str__(self):
+        return '%s (%s): %d hits from %d ips' % (self.period_start.strftime('%Y-%m-%d %H:%M'), self.period,
+                                                 self.hits, self.unique_ips)
+
+
+class SiteConcreteResourceVisitRollupMark(models.Model):
+    """
+    The high-water mark of the rollups: visits up to this id (included)
+      are already accounted for. There is only one of these.
+
+    The pending id is the highest one seen by a previous run (on the
+      pending date): visits up to it can be rolled up once the
+      transactions in progress back then are surely committed.
+    """
+
+    last_visit_id = models.PositiveIntegerField(default=0, null=False)
+    updated_on = models.DateTimeField(default=now, null=False)
+    pending_visit_id = models.PositiveIntegerField(default=0, null=False)
+    pending_on = models.DateTimeField(null=True)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.get_or_create(pk=1)[0]
+
+
+class SiteCacheVersion(models.Model):
+    """
+    Versions of the per-process caches of each site, bumped whenever
+      something cached for the site changes, so the other processes can
+      tell their caches are stale (see manysites.caches). The site id 0
+      stands for all the sites at once.
+    """
+
+    site_id = models.PositiveIntegerField(primary_key=True)
+    version = models.PositiveIntegerField(default=0, null=False)
+    updated_on = models.DateTimeField(default=now, null=False)
+
+    @classmethod
+    def bump(cls, site_id):
+        """
+        Bumps the version of a site's caches (of all sites, if 0).
+        :param site_id: The id of the site, or 0.
+        :return:
+        """
+
+        if not cls.objects.filter(site_id=site_id).update(version=models.F('version') + 1, updated_on=now()):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(site_id=site_id, version=1)
+            except IntegrityError:
+                # Created by another process in the meantime.
+                cls.objects.filter(site_id=site_id).update(version=models.F('version') + 1, updated_on=now())
@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image
+from .assets import schedule_build
+from .derivatives import ORIGINAL_FORMAT, derivative_name, derivative_widths, derivatives_pool
+from .models import SiteSetting, SiteResource, SiteResourceAlias, SiteConcreteResource, SiteBundle, \
+    SiteAsset, ImageAsset, TextAsset, joined_child
+
+
+#######################################################################
+#
+# Sites are provisioned out of manifests: dictionaries (usually loaded
+#   from JSON or YAML files) describing a site's setting, resources and
+#   bundles with their assets:
+#
+#   {"name": "Example", "enabled": true, "index": "home",
+#    "resources": [
+#      {"type": "concrete", "url_code": "home", "title": "Home",
+#       "description": "...", "content": "...", "log_visits": true},
+#      {"type": "alias", "url_code": "start", "title": "Start",
+#       "description": "...", "target": "home"}],
+#    "bundles": [
+#      {"code": "", "title": "Default", "description": "", "assets": [
+#        {"type": "text", "code": "main", "content_subtype": "css",
+#         "content": "..."},
+#        {"type": "image", "code": "logo", "image": "bundle/images/logo.png"}]}]}
+#
+# Image assets refer to files already in the default storage, which are
+#   hard-linked (or copied, when linking is not possible) along with
+#   their derivatives, instead of being uploaded again.
+#
+# Django can't bulk_create models inheriting from concrete ones (not even
+#   given their parent pointers), so the rows are inserted level by level:
+#   the parent rows with bulk_create (carrying the content type of their
+#   child), and then the child rows with multi-row INSERTs of their own
+#   fields only (see _insert_children).
+#   The post_save handlers do not run, so their work (building bundles,
+#   generating missing derivatives) is triggered here.
+#
+#######################################################################
+
+
+def export_site(site):
+    """
+    Describes a site as a manifest, which can be provisioned elsewhere
+      (or again, to clone the site).
+    :param site: The site to describe.
+    :return: The manifest.
+    """
+
+    setting = SiteSetting.objects.get(site=site)
+    index = None
+    resources = []
+    for resource in SiteResource.objects.with_children().filter(setting=setting).order_by('pk'):
+        resource = resource.as_child()
+        if resource.pk == setting.index_id:
+            index = resource.url_code
+        entry = {'url_code': resource.url_code, 'title': resource.title, 'description': resource.description,
+                 'enabled': resource.enabled}
+        if isinstance(resource, SiteResourceAlias):
+            entry.update(type='alias', target=resource.resource.url_code)
+        else:
+            entry.update(type='concrete', content=resource.content, log_visits=resource.log_visits)
+        resources.append(entry)
+
+    bundles = []
+    assets_by_bundle = {}
+    for bundle in SiteBundle.objects.filter(setting=setting).order_by('code'):
+        assets_by_bundle[bundle.pk] = []
+        bundles.append({'code': bundle.code, 'title': bundle.title, 'description': bundle.description,
+                        'assets': assets_by_bundle[bundle.pk]})
+    for asset in SiteAsset.objects.non_polymorphic().filter(bundle__setting=setting).order_by('code').select_related(
+        'imageasset', 'textasset'
+    ):
+        asset = joined_child(asset, 'imageasset', 'textasset')
+        assets = assets_by_bundle[asset.bundle_id]
+        if isinstance(asset, ImageAsset):
+            assets.append({'type': 'image', 'code': asset.code, 'image': asset.image.name,
+                           'width': asset.width, 'height': asset.height, 'ready_formats': asset.ready_formats,
+                           'unsupported_formats': asset.unsupported_formats})
+        elif isinstance(asset, TextAsset):
+            assets.append({'type': 'text', 'code': asset.code, 'content_subtype': asset.content_subtype,
+                           'content': asset.content})
+
+    return {
+        'domain': site.domain,
+        'name': site.name,
+        'enabled': setting.enabled,
+        'index': index,
+        'resources': resources,
+        'bundles': bundles,
+    }
+
+
+def _insert_children(model, children):
+    """
+    Inserts the child rows of already inserted parent rows, in batches.
+      Each batch is a multi-row INSERT spelled by the database operations
+      (as bulk_create does), if the database supports them, and the
+      values are prepared by the fields themselves (pre_save and
+      get_db_prep_save).
+    """
+
+    ops = connection.ops
+    fields = model._meta.local_concrete_fields
+    sql = 'INSERT INTO %s (%s) ' % (ops.quote_name(model._meta.db_table),
+                                    ', '.join(ops.quote_name(field.column) for field in fields))
+    placeholders = ['%s'] * len(fields)
+    if connection.features.has_bulk_insert:
+        batch_size = max(ops.bulk_batch_size(fields, children), 1)
+    else:
+        batch_size = 1
+    with connection.cursor() as cursor:
+        for start in range(0, len(children), batch_size):
+            batch = children[start:start + batch_size]
+            if connection.features.has_bulk_insert:
+                values = ops.bulk_insert_sql(fields, [placeholders] * len(batch))
+            else:
+                values = 'VALUES (%s)' % ', '.join(placeholders)
+            cursor.execute(sql + values, [field.get_db_prep_save(field.pre_save(child, True), connection)
+                                          for child in batch for field in fields])
+
+
+def _reject_duplicates(values, kind):
+    """
+    Rejects the repeated url codes (or codes) of a manifest, which would
+      otherwise be silently merged (entries are indexed by them).
+    """
+
+    seen = set()
+    for value in values:
+        if value in seen:
+            raise ValueError('The manifest has more than one %s with code "%s"' % (kind, value))
+        seen.add(value)
+
+
+def _insert_level(parent_model, child_model, parents, children, key):
+    """
+    Inserts parent and child rows of a given type: the parents with
+      bulk_create (and the child's content type), then gets their ids
+      back by their natural key (bulk_create does not give them back
+      on every database), and inserts the children.
+    :param parents: A dictionary mapping the natural key values (the
+      value of `key`) to the unsaved parent instances.
+    :param children: A dictionary mapping the same values to callables
+      building the child instance out of the parent's id.
+    :return: A dictionary mapping the same values to the ids.
+    """
+
+    if not parents:
+        return {}
+    ctype = ContentType.objects.get_for_model(child_model, for_concrete_model=False)
+    for parent in parents.values():
+        parent.polymorphic_ctype = ctype
+    parent_model.objects.bulk_create(list(parents.values()))
+    filters, field = key
+    ids = dict(parent_model.objects.non_polymorphic().filter(
+        **dict(filters, **{'%s__in' % field: list(parents)})
+    ).values_list(field, 'pk'))
+    _insert_children(child_model, [children[value](ids[value]) for value in parents])
+    return ids
+
+
+def _link(source, target, files):
+    """
+    Hard-links (or copies) a file of the default storage under a new
+      name. Storages without local paths get a copy through the storage.
+    :param files: A list the target is added to, if created.
+    :return: Whether the source existed.
+    """
+
+    if not default_storage.exists(source):
+        return False
+    files.append(target)
+    try:
+        source_path, target_path = default_storage.path(source), default_storage.path(target)
+    except NotImplementedError:
+        with default_storage.open(source) as content:
+            default_storage.save(target, content)
+        return True
+    directory = os.path.dirname(target_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        os.link(source_path, target_path)
+    except (OSError, AttributeError):
+        shutil.copyfile(source_path, target_path)
+    return True
+
+
+def _provision_image(entry, files):
+    """
+    Links the image of an image asset entry, and its derivatives in the
+      formats they are ready in.
+    :param files: A list the created files are added to.
+    :return: The (name, width, height, ready formats, unsupported formats)
+      of the copy.
+    """
+
+    source = entry['image']
+    upload_to = ImageAsset._meta.get_field('image').upload_to
+    name = default_storage.get_available_name('%s/%s' % (upload_to, os.path.basename(source)))
+    if not _link(source, name, files):
+        raise ValueError('The image %s of the asset %s does not exist' % (source, entry['code']))
+
+    width, height = entry.get('width'), entry.get('height')
+    if not width or not height:
+        with default_storage.open(name) as image_file:
+            width, height = Image.open(image_file).size
+
+    ready = []
+    for code in entry.get('ready_formats', '').split():
+        image_format = None if code == ORIGINAL_FORMAT else code
+        if all([_link(derivative_name(source, derivative_width, image_format),
+                      derivative_name(name, derivative_width, image_format), files)
+                for derivative_width in derivative_widths(width)]):
+            ready.append(code)
+    return name, width, height, ' '.join(ready), entry.get('unsupported_formats', '')
+
+
+def provision_site(manifest, domain=None, name=None):
+    """
+    Creates a site, with its setting, resources, bundles and assets, out
+      of a manifest, in a single transaction.
+    :param manifest: The manifest (see above).
+    :param domain: The domain of the new site, if not the manifest's.
+    :param name: The name of the new site, if not the manifest's.
+    :return: The new site.
+    """
+
+    domain = domain or manifest.get('domain')
+    if not domain:
+        raise ValueError('A domain is required')
+    if Site.objects.filter(domain=domain).exists():
+        raise ValueError('There is already a site with domain %s' % domain)
+
+    files = []
+    try:
+        return _provision(manifest, domain, name, files)
+    except Exception:
+        # The transaction was rolled back: the linked files are of no use.
+        for created in files:
+            default_storage.delete(created)
+        raise
+
+
+def _provision(manifest, domain, name, files):
+    images = []
+    with transaction.atomic():
+        site = Site.objects.create(domain=domain, name=name or manifest.get('name') or domain)
+        setting = SiteSetting.objects.create(site=site, enabled=manifest.get('enabled', True))
+
+        def parent(entry):
+            return SiteResource(setting=setting, url_code=entry['url_code'], title=entry['title'],
+                                description=entry.get('description', ''), enabled=entry.get('enabled', True))
+
+        entries = manifest.get('resources', [])
+        _reject_duplicates([entry['url_code'] for entry in entries], 'resource')
+        concrete = [entry for entry in entries if entry.get('type', 'concrete') == 'concrete']
+        aliases = [entry for entry in entries if entry.get('type') == 'alias']
+        key = ({'setting': setting}, 'url_code')
+        ids = _insert_level(
+            SiteResource, SiteConcreteResource, dict((entry['url_code'], parent(entry)) for entry in concrete),
+            dict((entry['url_code'], lambda pk, entry=entry: SiteConcreteResource(
+                siteresource_ptr_id=pk, content=entry['content'], log_visits=entry.get('log_visits', False)
+            )) for entry in concrete), key
+        )
+        for entry in aliases:
+            if entry['target'] not in ids:
+                raise ValueError('The alias %s targets an unknown resource: %s' % (entry['url_code'],
+                                                                                   entry['target']))
+        ids.update(_insert_level(
+            SiteResource, SiteResourceAlias, dict((entry['url_code'], parent(entry)) for entry in aliases),
+            dict((entry['url_code'], lambda pk, entry=entry: SiteResourceAlias(
+                siteresource_ptr_id=pk, resource_id=ids[entry['target']]
+            )) for entry in aliases), key
+        ))
+
+        built = []
+        _reject_duplicates([entry.get('code', '') for entry in manifest.get('bundles', [])], 'bundle')
+        for bundle_entry in manifest.get('bundles', []):
+            bundle = SiteBundle.objects.create(setting=setting, code=bundle_entry.get('code', ''),
+                                               title=bundle_entry['title'],
+                                               description=bundle_entry.get('description', ''))
+            assets = bundle_entry.get('assets', [])
+            _reject_duplicates([entry['code'] for entry in assets], 'asset in the bundle "%s"' % bundle.code)
+            texts = [entry for entry in assets if entry.get('type', 'text') == 'text']
+            key = ({'bundle': bundle}, 'code')
+            _insert_level(
+                SiteAsset, TextAsset, dict((entry['code'], SiteAsset(bundle=bundle, code=entry['code']))
+                                           for entry in texts),
+                dict((entry['code'], lambda pk, entry=entry: TextAsset(
+                    siteasset_ptr_id=pk, content=entry['content'], content_subtype=entry['content_subtype']
+                )) for entry in texts), key
+            )
+            linked = dict((entry['code'], _provision_image(entry, files))
+                          for entry in assets if entry.get('type') == 'image')
+            image_ids = _insert_level(
+                SiteAsset, ImageAsset, dict((code, SiteAsset(bundle=bundle, code=code)) for code in linked),
+                dict((code, lambda pk, image=image: ImageAsset(
+                    siteasset_ptr_id=pk, image=image[0], width=image[1], height=image[2], ready_formats=image[3],
+                    unsupported_formats=image[4]
+                )) for code, image in linked.items()), key
+            )
+            images.extend((image_ids[code], image[0]) for code, image in linked.items()
+                          if ImageAsset(ready_formats=image[3], unsupported_formats=image[4]).pending_formats())
+            if texts:
+                built.append(bundle.pk)
+
+        # Saving the setting also invalidates the caches of the site.
+        setting.index_id = ids.get(manifest.get('index'))
+        setting.save()
+        for bundle_id in built:
+            schedule_build(bundle_id)
+        for asset_id, image_name in images:
+            derivatives_pool.schedule(asset_id, image_name)
+    return site
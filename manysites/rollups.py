@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, Max, Q, When
+from django.utils import timezone
+from .models import SiteConcreteResourceVisit, SiteConcreteResourceVisitRollup, SiteConcreteResourceVisitRollupMark
+
+
+#######################################################################
+#
+# Rollups are maintained incrementally: each run only reads the visits
+#   past the stored high-water mark, finds the (resource, hour) and
+#   (resource, day) buckets they fall in, and adds to each bucket the
+#   hits of its new visits, and their ips not seen in the bucket's
+#   earlier visits (hits add up, but distinct counts don't).
+#
+# Earlier visits of a bucket are looked up by the (resource, visited_on)
+#   index, so they must be kept until their whole day was rolled up (see
+#   prune_visits). Visits arriving late (e.g. from a spool) into buckets
+#   whose raw visits were pruned are still added: their unique ips count
+#   is then an upper bound.
+#
+#######################################################################
+
+
+PERIOD_LENGTHS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+
+def period_start(period, moment):
+    """
+    Truncates a moment to the start of its hour or day, in UTC.
+    :param period: 'hour' or 'day'.
+    :param moment: The moment to truncate.
+    :return: The start of the period.
+    """
+
+    if settings.USE_TZ:
+        moment = moment.astimezone(timezone.utc)
+    if period == 'day':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _in_bucket(resource_id, period, start):
+    return SiteConcreteResourceVisit.objects.filter(resource_id=resource_id, visited_on__gte=start,
+                                                    visited_on__lt=start + PERIOD_LENGTHS[period])
+
+
+def _add(resource_id, period, start, first_id, last_id):
+    """
+    Adds the visits of a bucket having ids in (first_id, last_id] to its
+      rollup: all of them to the hits, and their distinct ips which did
+      not visit the bucket up to first_id to the unique ips.
+    """
+
+    bucket = _in_bucket(resource_id, period, start)
+    seen = bucket.filter(id__lte=first_id).values('visited_from')
+    stats = bucket.filter(id__gt=first_id, id__lte=last_id).aggregate(
+        hits=Count('id'), unique_ips=Count(Case(When(~Q(visited_from__in=seen), then='visited_from')), distinct=True)
+    )
+    rollup, created = SiteConcreteResourceVisitRollup.objects.get_or_create(
+        resource_id=resource_id, period=period, period_start=start, defaults=stats
+    )
+    if not created:
+        SiteConcreteResourceVisitRollup.objects.filter(pk=rollup.pk).update(
+            hits=F('hits') + stats['hits'], unique_ips=F('unique_ips') + stats['unique_ips']
+        )
+
+
+def _settled_top(lag):
+    """
+    Gets the highest visit id which can be rolled up: the highest one
+      seen by a run at least `lag` seconds ago (or right now, without
+      lag), so the transactions which were still writing lower ids back
+      then are committed by now. Visits are not dated by their insertion
+      (a spooled visit may be inserted long after it happened), hence the
+      ids.
+    """
+
+    with transaction.atomic():
+        mark = SiteConcreteResourceVisitRollupMark.current()
+        highest = SiteConcreteResourceVisit.objects.aggregate(top=Max('id'))['top'] or 0
+        moment = timezone.now()
+        if not lag:
+            return highest
+        top = mark.last_visit_id
+        if mark.pending_on is not None and moment - mark.pending_on >= timedelta(seconds=lag):
+            top = mark.pending_visit_id
+            mark.pending_on = None
+        if mark.pending_on is None:
+            mark.pending_visit_id = highest
+            mark.pending_on = moment
+            mark.save(update_fields=['pending_visit_id', 'pending_on'])
+        return top
+
+
+def rollup_visits(batch_size=10000, lag=None):
+    """
+    Rolls up the visits past the high-water mark, in batches.
+    :param batch_size: How many visits are read per batch.
+    :param lag: How many seconds a visit id must have been seen before
+      it is rolled up, since transactions still writing visits may commit
+      lower ids later. Defaults to MANYSITES_VISIT_ROLLUP_LAG (60).
+    :return: The number of rolled up visits.
+    """
+
+    if lag is None:
+        lag = getattr(settings, 'MANYSITES_VISIT_ROLLUP_LAG', 60)
+    top = _settled_top(lag)
+
+    processed = 0
+    while True:
+        with transaction.atomic():
+            mark = SiteConcreteResourceVisitRollupMark.current()
+            rows = list(SiteConcreteResourceVisit.objects.filter(
+                id__gt=mark.last_visit_id, id__lte=top
+            ).order_by('id').values_list('id', 'resource_id', 'visited_on')[:batch_size])
+            if not rows:
+                return processed
+
+            buckets = set()
+            for _, resource_id, visited_on in rows:
+                for period in PERIOD_LENGTHS:
+                    buckets.add((resource_id, period, period_start(period, visited_on)))
+            last_id = rows[-1][0]
+            for resource_id, period, start in buckets:
+                _add(resource_id, period, start, mark.last_visit_id, last_id)
+
+            mark.last_visit_id = last_id
+            mark.updated_on = timezone.now()
+            mark.save(update_fields=['last_visit_id', 'updated_on'])
+            processed += len(rows)
+
+
+def prune_visits(retention_days=None, chunk_size=10000):
+    """
+    Deletes the raw visits which were already rolled up and whose whole
+      day is older than the retention period.
+    :param retention_days: How many days of raw visits are kept. Defaults
+      to MANYSITES_VISIT_RETENTION_DAYS. Nothing is pruned if None.
+    :param chunk_size: How many visits are deleted per query.
+    :return: The number of deleted visits.
+    """
+
+    if retention_days is None:
+        retention_days = getattr(settings, 'MANYSITES_VISIT_RETENTION_DAYS', None)
+    if retention_days is None:
+        return 0
+
+    horizon = period_start('day', timezone.now() - timedelta(days=retention_days))
+    mark = SiteConcreteResourceVisitRollupMark.current()
+    prunable = SiteConcreteResourceVisit.objects.filter(id__lte=mark.last_visit_id, visited_on__lt=horizon)
+    deleted = 0
+    while True:
+        ids = list(prunable.values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        SiteConcreteResourceVisit.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
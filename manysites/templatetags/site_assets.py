@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django import template
+from django.template.library import SimpleNode
+from django.utils import six
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+from manysites.derivatives import FORMAT_MIME_TYPES, derivative_formats
+from manysites.caches import asset_index
+from manysites.models import ImageAsset, TextAsset
+
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def site_bundle(context, subtype, bundle=''):
+    """
+    Gets the url of a built bundle of the current site. Usage:
+
+        <link rel="stylesheet" href="{% site_bundle 'css' 'main' %}" />
+        <script src="{% site_bundle 'javascript' %}"></script>
+
+    The second one refers to the default bundle. An empty string is
+      returned if there is no such bundle (or it has no such assets).
+    """
+
+    artifact = asset_index.artifact(context['request'].site.pk, bundle, subtype)
+    return artifact.url if artifact else ''
+
+
+def find_asset(site, path):
+    """
+    Finds an asset of a site by its '<bundle>/<asset>' path (or just
+      '<asset>', for the default bundle).
+    :return: The asset, or None if not found.
+    """
+
+    return asset_index.resolve(site.pk, path)
+
+
+def referenced_assets(template):
+    """
+    Gets the paths of the assets a compiled template refers to (by
+      literal strings) through site_asset and site_image tags. They are
+      computed once per template.
+    :param template: A template of the django engine.
+    :return: A list of asset paths.
+    """
+
+    paths = getattr(template, 'site_asset_paths', None)
+    if paths is None:
+        paths = []
+        for node in template.template.nodelist.get_nodes_by_type(SimpleNode):
+            position = {site_asset: 1, site_image: 0}.get(node.func)
+            if position is not None and len(node.args) > position:
+                path = node.args[position].var
+                if isinstance(path, six.string_types):
+                    paths.append(path)
+        template.site_asset_paths = paths
+    return paths
+
+
+@register.simple_tag(takes_context=True)
+def site_asset(context, kind, path):
+    """
+    Gets an asset of the current site. Usage:
+
+        <img src="{% site_asset 'image' 'main/logo' %}" />
+        <style>{% site_asset 'css' 'main/extra' %}</style>
+
+    Images give their url, and text assets give their content. An empty
+      string is returned if there is no such asset (or it's not of that
+      kind).
+    """
+
+    asset = find_asset(context['request'].site, path)
+    if isinstance(asset, ImageAsset) and kind == 'image':
+        return asset.image.url
+    if isinstance(asset, TextAsset) and kind == asset.content_subtype:
+        return mark_safe(asset.content)
+    return ''
+
+
+@register.simple_tag(takes_context=True)
+def site_image(context, path, sizes='100vw', alt=''):
+    """
+    Renders a responsive image asset of the current site, offering its
+      derivatives in each format. Usage:
+
+        {% site_image 'main/banner' sizes='(max-width: 640px) 100vw, 50vw' alt='Our banner' %}
+    """
+
+    asset = find_asset(context['request'].site, path)
+    if not isinstance(asset, ImageAsset):
+        return ''
+    # Formats without derivatives (e.g. for images narrower than every
+    #   derivative) get no source: the original is offered instead.
+    srcsets = [(image_format, asset.srcset(image_format)) for image_format in derivative_formats()[1:]]
+    sources = format_html_join('', '<source type="{0}" srcset="{1}" sizes="{2}" />', (
+        (FORMAT_MIME_TYPES.get(image_format, 'image/' + image_format.lower()), srcset, sizes)
+        for image_format, srcset in srcsets if srcset
+    ))
+    return format_html('<picture>{0}<img src="{1}" srcset="{2}" sizes="{3}" width="{4}" height="{5}" alt="{6}" />'
+                       '</picture>', sources, asset.image.url, asset.srcset(), sizes, asset.width, asset.height, alt)
@@ -1,6 +1,711 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import csv
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import timedelta
+from io import BytesIO
+from captcha.signals import captcha_generated
+from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.template import Context, Engine, TemplateDoesNotExist
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import six, timezone
+from django.utils.six import StringIO
+from grimoire.django.tracked.models.polymorphic import TrackedLiveQuerySet
+from PIL import Image
+from .assets import _build_after, _naive_cssmin
+from .caches import MISSING, InvalidationBus, SiteCache, drop_site, resolution_cache, site_routes
+from .derivatives import generate_derivatives
+from .loaders import CompiledTemplateCache
+from .exports import HEADERS, iter_visit_rows, visits_for, write_csv, write_xlsx
+from .metrics import MetricsRegistry, registry
+from .models import SiteSetting, SiteResource, SiteResourceAlias, SiteConcreteResource, SiteConcreteResourceVisit, \
+    SiteBundle, SiteBundleArtifact, TextAsset, ImageAsset, SiteConcreteResourceVisitRollup, \
+    SiteConcreteResourceVisitRollupMark, SiteCacheVersion
+from .provisioning import export_site, provision_site
+from .rollups import period_start, prune_visits, rollup_visits
+from .visits import VisitBuffer, VisitWriter, format_spool_row
 
-# Create your tests here.
+
+@override_settings(MANYSITES_CACHE_STALENESS=None)
+class SiteTestCase(TestCase):
+    """
+    A site (served at example.test) with a page, and fresh caches.
+    """
+
+    host = 'example.test'
+
+    def setUp(self):
+        self.site = Site.objects.create(domain=self.host, name='Example')
+        self.setting = SiteSetting.objects.create(site=self.site)
+        self.page = self.create_page('page', 'Hello from {{ site.name }}')
+        site_routes.invalidate()
+        drop_site()
+
+    def create_page(self, url_code, content, **kwargs):
+        return SiteConcreteResource.objects.create(setting=self.setting, url_code=url_code, title=url_code,
+                                                   description=url_code, content=content, **kwargs)
+
+    def get(self, path, **headers):
+        return self.client.get(path, HTTP_HOST=self.host, **headers)
+
+
+@override_settings(STATIC_ROOT=os.path.join(tempfile.gettempdir(), 'manysites-static'))
+class AdminTestCase(SiteTestCase):
+    """
+    A site, and a superuser logged in the admin (whose static files must
+      not share their root with the media ones).
+    """
+
+    def setUp(self):
+        super(AdminTestCase, self).setUp()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.test', 'admin'))
+
+
+class ServeTests(SiteTestCase):
+
+    def test_cacheable_page_is_validated(self):
+        response = self.get('/page')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept-Language', response['Vary'])
+        self.assertEqual(self.get('/page', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.get('/page', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+    def test_etag_depends_on_the_variant(self):
+        etag = self.get('/page')['ETag']
+        self.assertNotEqual(self.get('/page?a=1')['ETag'], etag)
+        self.assertEqual(self.get('/page?a=1', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_etag_changes_with_the_assets(self):
+        bundle = SiteBundle.objects.create(setting=self.setting, code='', title='Default')
+        asset = TextAsset.objects.create(bundle=bundle, code='main', content_subtype='css', content='a{color:red}')
+        self.create_page('styled', "{% load site_assets %}<style>{% site_asset 'css' 'main' %}</style>")
+        etag = self.get('/styled')['ETag']
+        asset.content = 'a{color:blue}'
+        asset.save()
+        response = self.get('/styled', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'blue', response.content)
+
+    def test_etag_changes_once_a_bundle_is_built(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        bundle = SiteBundle.objects.create(setting=self.setting, code='', title='Default')
+        TextAsset.objects.create(bundle=bundle, code='main', content_subtype='css', content='a { color: red; }')
+        self.create_page('linked', "{% load site_assets %}<link href=\"{% site_bundle 'css' %}\" />")
+        with self.settings(STATIC_ROOT=static_root):
+            etag = self.get('/linked')['ETag']
+            _build_after(bundle.pk)
+            response = self.get('/linked', HTTP_IF_NONE_MATCH=etag)
+            url = SiteBundleArtifact.objects.get(bundle=bundle).url
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(url.encode('utf-8'), response.content)
+
+    def test_page_depending_on_the_visitor_is_not_validated(self):
+        self.create_page('form', '<form>{% csrf_token %}</form>')
+        response = self.get('/form')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+        self.assertFalse(response.has_header('Last-Modified'))
+        response = self.get('/form', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'csrfmiddlewaretoken', response.content)
+
+
+class MetricsTests(SimpleTestCase):
+
+    def test_collectors_render_numbers_only(self):
+        metrics = MetricsRegistry()
+        metrics.register_collector('pool', lambda: {'depth': 0, 'mode': 'spool', 'running': True, 'ratio': 0.5,
+                                                    'unknown': None})
+        lines = metrics.render().splitlines()
+        self.assertIn('pool_depth 0', lines)
+        self.assertIn('pool_running 1', lines)
+        self.assertIn('pool_ratio 0.5', lines)
+        self.assertFalse([line for line in lines if 'mode' in line or 'unknown' in line])
+
+    @override_settings(MANYSITES_METRICS=True)
+    def test_captcha_signals_are_measured(self):
+        captcha_generated.send(sender=None, captcha=None, source='rendered', seconds=0.01)
+        rendered = registry.render()
+        self.assertIn('captcha_generated_total{source="rendered"}', rendered)
+        self.assertIn('# TYPE captcha_generate_seconds histogram', rendered)
+
+
+@override_settings(MANYSITES_VISIT_BUFFER_TIMER=False)
+class SpoolTestCase(SiteTestCase):
+    """
+    A site, and an empty spool directory.
+    """
+
+    def setUp(self):
+        super(SpoolTestCase, self).setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+        spooling = self.settings(MANYSITES_VISIT_SPOOL_DIR=self.spool_dir)
+        spooling.enable()
+        self.addCleanup(spooling.disable)
+
+    def write_spool(self, name, lines):
+        with open(os.path.join(self.spool_dir, name), 'w') as spool:
+            spool.write(''.join(lines))
+
+    def queued_name(self, pid, age=10):
+        return 'visits-%d.spool.%d.queued' % (pid, int((time.time() - age) * 1000000))
+
+
+@override_settings(MANYSITES_VISIT_BUFFER='queue', MANYSITES_VISIT_QUEUE_MAX_BYTES=1024)
+class VisitQueueTests(SpoolTestCase):
+
+    def test_backpressure_counts_the_whole_backlog(self):
+        # Another process' queued file fills the backlog on its own.
+        self.write_spool(self.queued_name(1), ['x' * 1024])
+        buffer = VisitBuffer()
+        buffer.add(self.page.pk, '127.0.0.1')
+        self.assertEqual(buffer.stats()['dropped_rows'], 1)
+        self.assertFalse(os.path.exists(buffer._spool_path()))
+
+    def test_enqueues_below_the_limit(self):
+        buffer = VisitBuffer()
+        buffer.add(self.page.pk, '127.0.0.1')
+        self.assertEqual(buffer.stats()['dropped_rows'], 0)
+        self.assertTrue(os.path.exists(buffer._spool_path()))
+
+    @override_settings(MANYSITES_VISIT_MAX_ATTEMPTS=2)
+    def test_broken_files_are_set_aside(self):
+        broken = self.queued_name(1, 20)
+        self.write_spool(broken, ['not a visit\n'])
+        self.write_spool(self.queued_name(2), [format_spool_row(self.page.pk, timezone.now(), '127.0.0.1')])
+        writer = VisitWriter()
+        with self.assertLogs('manysites.visits', 'ERROR'):
+            self.assertEqual(writer.drain(), 0)
+            self.assertEqual(writer.drain(), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.spool_dir, broken + '.failed')))
+        self.assertEqual(writer.stats()['quarantined_files'], 1)
+        self.assertEqual(SiteConcreteResourceVisit.objects.filter(resource=self.page).count(), 1)
+
+
+class VisitBufferTests(SpoolTestCase):
+
+    @override_settings(MANYSITES_VISIT_BUFFER='spool')
+    def test_spools_of_dead_processes_are_recovered(self):
+        gone = subprocess.Popen([sys.executable, '-c', 'pass'])
+        gone.wait()
+        visited_on = timezone.now()
+        self.write_spool('visits-%d.spool' % gone.pid, [format_spool_row(self.page.pk, visited_on, '127.0.0.1')])
+        self.write_spool('visits-%d.spool.1.flushing' % gone.pid, [
+            format_spool_row(self.page.pk, visited_on, '127.0.0.2'), '1\tbroken'
+        ])
+        buffer = VisitBuffer()
+        with self.assertLogs('manysites.visits', 'ERROR'):
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(buffer.stats()['recovered_files'], 2)
+        self.assertEqual(buffer.stats()['dropped_rows'], 1)
+        self.assertEqual(os.listdir(self.spool_dir), ['recover.lock'])
+
+    @override_settings(MANYSITES_VISIT_BUFFER='memory', MANYSITES_VISIT_MAX_ATTEMPTS=2)
+    def test_rows_failing_to_flush_are_set_aside(self):
+        buffer = VisitBuffer()
+        # Without an ip, the row can't be stored.
+        buffer.add(self.page.pk, None)
+        with self.assertLogs('manysites.visits', 'ERROR'):
+            buffer.flush()
+            self.assertEqual(buffer.stats()['pending_rows'], 1)
+            buffer.flush()
+        self.assertEqual(buffer.stats()['pending_rows'], 0)
+        self.assertEqual(buffer.stats()['quarantined_rows'], 1)
+        failed, = os.listdir(self.spool_dir)
+        self.assertTrue(failed.endswith('.failed'))
+
+
+class QueryPlanTests(TestCase):
+    """
+    The queries in the hot paths (resource lookups, visits by resource
+      and date) must be answered by an index instead of a full table
+      scan, in SQLite and PostgreSQL.
+    """
+
+    # A full scan looks like "SCAN TABLE <table>" (or "SCAN <table>" in
+    #   newer versions) in SQLite, unless it scans an index, and "Seq Scan
+    #   on <table>" in PostgreSQL.
+    FULL_SCAN_PATTERNS = {
+        'sqlite': r'SCAN (TABLE )?%s\b(?! USING (COVERING )?INDEX)',
+        'postgresql': r'Seq Scan on %s\b',
+    }
+
+    def setUp(self):
+        if connection.vendor not in self.FULL_SCAN_PATTERNS:
+            self.skipTest('Query plans are only checked in SQLite and PostgreSQL')
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+            # Tables in a test database are too small for the planner to
+            #   bother with indexes, unless we forbid sequential scans.
+            with transaction.atomic():
+                cursor.execute('SET LOCAL enable_seqscan TO off')
+                cursor.execute('EXPLAIN ' + sql, params)
+                return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def assertIndexed(self, queryset, model):
+        plan = self.explain(queryset)
+        self.assertIsNone(re.search(self.FULL_SCAN_PATTERNS[connection.vendor] % re.escape(model._meta.db_table),
+                                    plan), plan)
+
+    def test_resource_lookup(self):
+        self.assertIndexed(SiteConcreteResource.objects.non_polymorphic().filter(
+            setting__site_id=1, url_code='index'
+        ).values_list('pk', 'enabled', 'log_visits'), SiteResource)
+
+    def test_latest_visits_of_a_resource(self):
+        self.assertIndexed(SiteConcreteResourceVisit.objects.filter(resource_id=1).order_by('-visited_on')[:20],
+                           SiteConcreteResourceVisit)
+
+    def test_visits_of_a_resource_in_a_range(self):
+        moment = timezone.now()
+        self.assertIndexed(SiteConcreteResourceVisit.objects.filter(
+            resource_id=1, visited_on__gte=moment - timedelta(days=1), visited_on__lt=moment
+        ), SiteConcreteResourceVisit)
+
+
+class TemplateCacheTests(SiteTestCase):
+
+    def test_templates_are_compiled_once_per_version(self):
+        cache = CompiledTemplateCache()
+        template = cache.get_template(self.page.pk, self.page.updated_on)
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get_template(self.page.pk, self.page.updated_on), template)
+        self.assertEqual(template.render({'site': self.site}), 'Hello from Example')
+        self.page.content = 'Bye from {{ site.name }}'
+        self.page.save()
+        with self.assertNumQueries(0):
+            template = cache.get_template(self.page.pk, self.page.updated_on, self.page.content)
+        self.assertEqual(template.render({'site': self.site}), 'Bye from Example')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 2})
+
+    @override_settings(MANYSITES_TEMPLATE_CACHE_SIZE=1)
+    def test_least_recently_used_templates_are_evicted(self):
+        cache = CompiledTemplateCache()
+        other = self.create_page('other', 'Other')
+        cache.get_template(self.page.pk, self.page.updated_on)
+        cache.get_template(other.pk, other.updated_on)
+        with self.assertNumQueries(1):
+            cache.get_template(self.page.pk, self.page.updated_on)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 3, 'evictions': 2, 'size': 1})
+
+    def test_resources_are_included_through_the_loader(self):
+        engine = Engine(loaders=['manysites.loaders.ResourceLoader'])
+        template = engine.from_string("{%% include 'manysites/resource/%d' %%}!" % self.page.pk)
+        self.assertEqual(template.render(Context({'site': self.site})), 'Hello from Example!')
+        with self.assertRaises(TemplateDoesNotExist):
+            engine.get_template('manysites/resource/0')
+        with self.assertRaises(TemplateDoesNotExist):
+            engine.get_template('manysites/page.html')
+
+
+class AssetTests(SiteTestCase):
+
+    def test_naive_cssmin_keeps_strings_and_selectors(self):
+        self.assertEqual(_naive_cssmin('/* x */ a :hover , div  p > b { content: "a ;}  /* y */" ; color: red ; }'),
+                         'a :hover,div p>b{content:"a ;}  /* y */";color:red}')
+
+    def test_unchanged_bundles_are_not_built_again(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        bundle = SiteBundle.objects.create(setting=self.setting, code='', title='Default')
+        TextAsset.objects.create(bundle=bundle, code='main', content_subtype='css', content='a { color: red; }')
+        with self.settings(STATIC_ROOT=static_root):
+            _build_after(bundle.pk)
+            built_on = SiteBundleArtifact.objects.get(bundle=bundle).built_on
+            # Only the bundle and its assets are read.
+            with self.assertNumQueries(2):
+                _build_after(bundle.pk)
+            TextAsset.objects.filter(bundle=bundle).update(content='a { color: blue; }')
+            _build_after(bundle.pk)
+        self.assertGreater(SiteBundleArtifact.objects.get(bundle=bundle).built_on, built_on)
+
+
+class RollupTests(SiteTestCase):
+
+    def visit(self, visited_on, visited_from='127.0.0.1'):
+        return SiteConcreteResourceVisit.objects.create(resource=self.page, visited_on=visited_on,
+                                                        visited_from=visited_from)
+
+    def daily(self, moment):
+        return SiteConcreteResourceVisitRollup.objects.get(resource=self.page, period='day',
+                                                           period_start=period_start('day', moment))
+
+    def test_late_visits_are_added_to_pruned_days(self):
+        old = timezone.now() - timedelta(days=10)
+        self.visit(old)
+        self.visit(old, '127.0.0.2')
+        self.assertEqual(rollup_visits(lag=0), 2)
+        self.assertEqual(prune_visits(retention_days=1), 2)
+        # A spooled visit of that day, stored later.
+        self.visit(old, '127.0.0.3')
+        self.assertEqual(rollup_visits(lag=0), 1)
+        self.assertEqual((self.daily(old).hits, self.daily(old).unique_ips), (3, 3))
+
+    def test_unique_ips_are_merged_across_runs(self):
+        moment = timezone.now()
+        self.visit(moment)
+        rollup_visits(lag=0)
+        self.visit(moment)
+        self.visit(moment, '127.0.0.2')
+        self.visit(moment, '127.0.0.2')
+        self.assertEqual(rollup_visits(lag=0), 3)
+        self.assertEqual((self.daily(moment).hits, self.daily(moment).unique_ips), (4, 2))
+
+    def test_lag_is_measured_on_ids(self):
+        # Visited long ago, but inserted right now.
+        old = timezone.now() - timedelta(days=1)
+        self.visit(old)
+        self.assertEqual(rollup_visits(lag=60), 0)
+        self.visit(old)
+        SiteConcreteResourceVisitRollupMark.objects.update(pending_on=timezone.now() - timedelta(seconds=61))
+        # Only the visit seen by the previous run is settled.
+        self.assertEqual(rollup_visits(lag=60), 1)
+        self.assertEqual(self.daily(old).hits, 1)
+
+
+@override_settings(MANYSITES_IMAGE_DERIVATIVE_WIDTHS=(160,))
+class DerivativeTests(SiteTestCase):
+
+    def setUp(self):
+        super(DerivativeTests, self).setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = self.settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.bundle = SiteBundle.objects.create(setting=self.setting, code='main', title='Main')
+
+    def create_image(self, width):
+        content = BytesIO()
+        Image.new('RGB', (width, 10)).save(content, format='PNG')
+        return ImageAsset.objects.create(bundle=self.bundle, code='logo',
+                                         image=ContentFile(content.getvalue(), 'logo.png'))
+
+    @override_settings(MANYSITES_IMAGE_DERIVATIVE_FORMATS=('UNKNOWN',))
+    def test_unsupported_formats_are_recorded_apart(self):
+        asset = self.create_image(320)
+        with self.assertLogs('manysites.derivatives', 'WARNING'):
+            generate_derivatives(asset.pk, asset.image.name)
+        asset = ImageAsset.objects.get(pk=asset.pk)
+        self.assertEqual((asset.ready_formats, asset.unsupported_formats), ('ORIGINAL', 'UNKNOWN'))
+        self.assertEqual(asset.pending_formats(), [])
+        self.assertEqual(len(asset.derivative_urls()), 1)
+        self.assertEqual(asset.derivative_urls('UNKNOWN'), [])
+
+    @override_settings(MANYSITES_IMAGE_DERIVATIVE_FORMATS=('WEBP', 'PNG'))
+    def test_formats_are_ready_on_their_own(self):
+        asset = self.create_image(320)
+        self.assertEqual(asset.pending_formats(), [None, 'WEBP', 'PNG'])
+        ImageAsset.objects.filter(pk=asset.pk).update(ready_formats='ORIGINAL PNG')
+        asset = ImageAsset.objects.get(pk=asset.pk)
+        self.assertEqual(asset.pending_formats(), ['WEBP'])
+        self.assertTrue(asset.srcset('PNG'))
+        self.assertEqual(asset.srcset('WEBP'), '')
+
+    @override_settings(MANYSITES_IMAGE_DERIVATIVE_FORMATS=('WEBP',))
+    def test_images_without_derivatives_offer_the_original(self):
+        asset = self.create_image(100)
+        ImageAsset.objects.filter(pk=asset.pk).update(ready_formats='ORIGINAL WEBP')
+        self.create_page('banner', "{% load site_assets %}{% site_image 'main/logo' %}")
+        content = self.get('/banner').content.decode('utf-8')
+        self.assertNotIn('<source', content)
+        self.assertIn('srcset="%s 100w"' % asset.image.url, content)
+
+
+class CacheTests(SiteTestCase):
+
+    @override_settings(MANYSITES_TEST_CACHE_SIZE=2)
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = SiteCache()
+        cache.SIZE_SETTING = 'MANYSITES_TEST_CACHE_SIZE'
+        for key in 'abc':
+            if key == 'c':
+                cache.get(1, 'a')
+            cache.set(1, key, key.upper(), cache.generation(1))
+        self.assertEqual([cache.get(1, key) for key in 'abc'], ['A', MISSING, 'C'])
+
+    def test_invalid_url_codes_are_not_cached(self):
+        self.assertIsNone(resolution_cache.resolve(self.site.pk, '/no/such.page'))
+        self.assertEqual(resolution_cache.stats()['size'], 0)
+        self.assertEqual(self.get('/no/such.page').status_code, 404)
+
+
+@override_settings(MANYSITES_CACHE_STALENESS=None)
+class CommitInvalidationTests(TransactionTestCase):
+
+    def test_caches_are_dropped_once_committed(self):
+        site = Site.objects.create(domain='example.test', name='Example')
+        setting = SiteSetting.objects.create(site=site)
+        with transaction.atomic():
+            page = SiteConcreteResource.objects.create(setting=setting, url_code='page', title='page',
+                                                       description='page', content='page')
+            # Another thread, not seeing the page yet, caches a miss.
+            resolution_cache.set(site.pk, 'page', None, resolution_cache.generation(site.pk))
+        self.assertEqual(resolution_cache.resolve(site.pk, '/page').resource_id, page.pk)
+
+
+class RoutingTests(SiteTestCase):
+
+    def test_hosts_are_routed_from_memory(self):
+        site_routes.for_host(self.host)
+        with self.assertNumQueries(0):
+            route = site_routes.for_host('Example.test:8000')
+            self.assertIsNone(site_routes.for_host('unknown.test'))
+        self.assertEqual((route.site, route.setting_id, route.enabled), (self.site, self.setting.pk, True))
+        self.assertEqual(self.client.get('/page', HTTP_HOST='unknown.test').status_code, 404)
+
+    def test_disabled_sites_are_not_served(self):
+        self.setting.enabled = False
+        self.setting.save()
+        self.assertEqual(self.get('/page').status_code, 404)
+        # But they can still be managed.
+        self.assertEqual(self.get('/admin/').status_code, 302)
+
+    def test_index_is_served_at_the_root(self):
+        self.assertEqual(self.get('/').status_code, 404)
+        self.setting.index = self.page
+        self.setting.save()
+        self.assertEqual(self.get('/').content, b'Hello from Example')
+
+    def test_saves_tell_the_site_without_queries(self):
+        site_routes.for_host(self.host)
+        page = SiteConcreteResource.objects.get(pk=self.page.pk)
+        bundle = SiteBundle.objects.create(setting=self.setting, code='', title='Default')
+        with CaptureQueriesContext(connection) as queries:
+            page.save()
+            bundle.save()
+            TextAsset.objects.create(bundle=bundle, code='main', content_subtype='css', content='a{}')
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT')])
+
+
+@override_settings(MANYSITES_CACHE_STALENESS=0)
+class InvalidationBusTests(TestCase):
+
+    def setUp(self):
+        self.bus = InvalidationBus()
+        drop_site()
+        for site_id in (1, 2):
+            resolution_cache.set(site_id, 'page', None, resolution_cache.generation(site_id))
+
+    def cached(self):
+        return [site_id for site_id in (1, 2) if resolution_cache.get(site_id, 'page') is not MISSING]
+
+    def test_publish_bumps_the_version(self):
+        self.bus.publish(1)
+        self.bus.publish(1)
+        self.bus.publish()
+        self.assertEqual(dict(SiteCacheVersion.objects.values_list('site_id', 'version')), {0: 1, 1: 2})
+
+    def test_first_poll_keeps_the_caches(self):
+        SiteCacheVersion.bump(1)
+        self.bus.poll()
+        self.assertEqual(self.cached(), [1, 2])
+
+    def test_poll_drops_the_changed_sites(self):
+        self.bus.poll()
+        SiteCacheVersion.bump(1)
+        self.bus.poll()
+        self.assertEqual(self.cached(), [2])
+        SiteCacheVersion.bump(0)
+        self.bus.poll()
+        self.assertEqual(self.cached(), [])
+
+    @override_settings(MANYSITES_CACHE_STALENESS=60)
+    def test_changes_are_seen_after_the_staleness_window(self):
+        self.bus.poll()
+        SiteCacheVersion.bump(1)
+        with self.assertNumQueries(0):
+            self.bus.poll()
+        self.assertEqual(self.cached(), [1, 2])
+        self.bus._polled_on -= 60
+        self.bus.poll()
+        self.assertEqual(self.cached(), [2])
+
+    @override_settings(MANYSITES_CACHE_STALENESS=None)
+    def test_bus_can_be_disabled(self):
+        with self.assertNumQueries(0):
+            self.bus.publish(1)
+            self.bus.poll()
+
+
+class ResourceQueryTests(AdminTestCase):
+
+    def setUp(self):
+        super(ResourceQueryTests, self).setUp()
+        self.alias = SiteResourceAlias.objects.create(setting=self.setting, url_code='start', title='start',
+                                                      description='start', resource=self.page)
+
+    def add_resources(self, count):
+        for index in range(count):
+            page = self.create_page('page-%d' % index, 'Page')
+            SiteResourceAlias.objects.create(setting=self.setting, url_code='alias-%d' % index, title='alias',
+                                             description='alias', resource=page)
+
+    def test_tracked_lookups_are_kept(self):
+        self.assertIsInstance(SiteResource.objects.all(), TrackedLiveQuerySet)
+        self.assertIsInstance(SiteResource.objects.with_children(), TrackedLiveQuerySet)
+        self.assertTrue(callable(SiteResource.objects.created_or_updated_on))
+
+    def test_resolution_misses_take_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(resolution_cache.resolve(self.site.pk, '/start').resource_id, self.page.pk)
+        with self.assertNumQueries(1):
+            self.assertIsNone(resolution_cache.resolve(self.site.pk, '/missing'))
+
+    def test_changelist_queries_do_not_depend_on_the_rows(self):
+        url = reverse('admin:manysites_siteresource_changelist')
+        self.client.get(url)
+        with self.assertNumQueries(5):
+            self.client.get(url)
+        self.add_resources(5)
+        with self.assertNumQueries(5):
+            self.client.get(url)
+
+    def test_export_queries_do_not_depend_on_the_rows(self):
+        with self.assertNumQueries(4):
+            export_site(self.site)
+        self.add_resources(5)
+        with self.assertNumQueries(4):
+            export_site(self.site)
+
+
+class ExportTests(AdminTestCase):
+
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        moment = timezone.now()
+        self.old = SiteConcreteResourceVisit.objects.create(resource=self.page, visited_on=moment - timedelta(days=10),
+                                                            visited_from='127.0.0.1')
+        self.new = SiteConcreteResourceVisit.objects.create(resource=self.page, visited_on=moment,
+                                                            visited_from='127.0.0.2')
+
+    def test_csv_has_a_row_per_visit(self):
+        output = StringIO()
+        self.assertEqual(write_csv(iter_visit_rows(visits_for(resources=[self.page.pk]), chunk_size=1), output), 2)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual(rows[0], list(HEADERS))
+        self.assertEqual([row[:3] for row in rows[1:]],
+                         [[str(self.old.pk), self.host, 'page'], [str(self.new.pk), self.host, 'page']])
+
+    def test_xlsx_has_a_row_per_visit(self):
+        output = BytesIO()
+        self.assertEqual(write_xlsx(iter_visit_rows(visits_for(sites=[self.site.pk])), output), 2)
+        with zipfile.ZipFile(BytesIO(output.getvalue())) as workbook:
+            sheet = workbook.read('xl/worksheets/sheet1.xml').decode('utf-8')
+        self.assertEqual(sheet.count('<row '), 3)
+        self.assertIn(self.host, sheet)
+
+    def test_command_writes_csv_lines_once_ended(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'visits.csv')
+        call_command('exportvisits', sites=[self.host], output=path, stderr=StringIO())
+        with open(path, 'rb') as exported:
+            content = exported.read()
+        self.assertEqual(content.count(b'\r\n'), 3)
+        self.assertNotIn(b'\r\r\n', content)
+
+    def test_admin_actions_ask_for_the_dates(self):
+        url = reverse('admin:manysites_siteresource_changelist')
+        selection = {'action': 'export_visits_csv', helpers.ACTION_CHECKBOX_NAME: [self.page.pk]}
+        self.assertContains(self.client.post(url, dict(selection, index=0)), 'name="since"')
+        since = timezone.localtime(self.new.visited_on).date() - timedelta(days=1)
+        response = self.client.post(url, dict(selection, export='Export', since=since.isoformat()))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [str(self.new.pk)])
+
+
+class VisitAdminTests(AdminTestCase):
+
+    def setUp(self):
+        super(VisitAdminTests, self).setUp()
+        self.url = reverse('admin:manysites_siteconcreteresourcevisit_changelist')
+        visit_admin = admin.site._registry[SiteConcreteResourceVisit]
+        visit_admin.list_per_page = 2
+        self.addCleanup(delattr, visit_admin, 'list_per_page')
+
+    def visit(self, visited_on):
+        return SiteConcreteResourceVisit.objects.create(resource=self.page, visited_on=visited_on,
+                                                        visited_from='127.0.0.1')
+
+    def test_pages_seek_past_their_last_visit(self):
+        moment = timezone.now()
+        older = self.visit(moment - timedelta(minutes=1))
+        tied = [self.visit(moment) for _ in range(2)]
+        newest = self.visit(moment + timedelta(minutes=1))
+        response = self.client.get(self.url, {'resource': self.page.pk})
+        self.assertEqual(response.context['visits'], [newest, tied[1]])
+        response = self.client.get(self.url, {'resource': self.page.pk, 'before': response.context['following']})
+        self.assertEqual(response.context['visits'], [tied[0], older])
+        self.assertIsNone(response.context['following'])
+
+    def test_malformed_pages_are_rejected(self):
+        for before in ('2017-13-45T00:00:00+00:00_1', 'last', '2017-01-01T00:00:00+00:00_x'):
+            response = self.client.get(self.url, {'resource': self.page.pk, 'before': before})
+            self.assertEqual(response.status_code, 400)
+
+    def test_resources_show_a_summary_of_the_rollups(self):
+        today = period_start('day', timezone.now())
+        for days_ago, hits in ((0, 2), (30, 5)):
+            SiteConcreteResourceVisitRollup.objects.create(resource=self.page, period='day', hits=hits, unique_ips=1,
+                                                           period_start=today - timedelta(days=days_ago))
+        response = self.client.get(reverse('admin:manysites_siteresource_change', args=(self.page.pk,)))
+        self.assertContains(response, '7 visits (2 in the last 7 days, as of the last rollup)')
+        self.assertContains(response, '%s?resource=%d' % (self.url, self.page.pk))
+
+
+class ProvisioningTests(TestCase):
+
+    MANIFEST = {
+        'name': 'Example', 'enabled': True, 'index': 'home',
+        'resources': [
+            {'type': 'concrete', 'url_code': 'home', 'title': 'Home', 'description': 'Home', 'content': 'Home',
+             'log_visits': True, 'enabled': True},
+            {'type': 'alias', 'url_code': 'start', 'title': 'Start', 'description': 'Start', 'target': 'home',
+             'enabled': True},
+        ],
+        'bundles': [
+            {'code': '', 'title': 'Default', 'description': '', 'assets': [
+                {'type': 'text', 'code': 'main', 'content_subtype': 'css', 'content': 'a { color: red; }'},
+            ]},
+        ],
+    }
+
+    def test_provisioned_sites_export_their_manifest(self):
+        site = provision_site(self.MANIFEST, 'example.test')
+        self.assertEqual(export_site(site), dict(self.MANIFEST, domain='example.test'))
+        alias = SiteResource.objects.get(setting__site=site, url_code='start')
+        self.assertEqual(alias.resource.url_code, 'home')
+
+    def test_repeated_codes_are_rejected(self):
+        resources = self.MANIFEST['resources']
+        bundle = self.MANIFEST['bundles'][0]
+        for manifest in (dict(self.MANIFEST, resources=resources + [dict(resources[0], title='Again')]),
+                         dict(self.MANIFEST, bundles=[dict(bundle, assets=bundle['assets'] * 2)])):
+            with six.assertRaisesRegex(self, ValueError, 'more than one'):
+                provision_site(manifest, 'example.test')
+        self.assertFalse(Site.objects.filter(domain='example.test').exists())
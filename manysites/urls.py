@@ -0,0 +1,9 @@
+from django.conf.urls import url
+from . import views
+
+app_name = 'manysites'
+urlpatterns = [
+    url(r'^manysites/metrics$', views.metrics, name='metrics'),
+    url(r'^$', views.serve, name='index'),
+    url(r'^([-\w]+)/?$', views.serve, name='resource'),
+]
@@ -1,6 +1,108 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.shortcuts import render
+import hashlib
+import time
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.encoding import force_bytes
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import http_date, quote_etag
+from django.utils.translation import get_language
+from .caches import MISSING, CachedResponse, resolution_cache, response_cache, asset_index
+from .loaders import template_cache
+from .metrics import registry
+from .models import SiteConcreteResource
+from .templatetags.site_assets import referenced_assets
 
-# Create your views here.
+
+def _is_cacheable(request, response):
+    """
+    A rendered page can be reused for other visitors unless rendering it
+      depended on the visitor: touching the session (e.g. the user or a
+      captcha) or the csrf token, or setting cookies.
+    """
+
+    session = getattr(request, 'session', None)
+    return (getattr(settings, 'MANYSITES_RESPONSE_CACHE', True) and request.method in ('GET', 'HEAD') and
+            not response.cookies and not request.META.get('CSRF_COOKIE_USED') and
+            not (session is not None and session.accessed))
+
+
+def _etag(key, content):
+    """
+    Computes the ETag of a page, out of the variant (url code, language
+      and query string) it was rendered for and its content. So it
+      changes whenever anything the page shows does (the resource, the
+      resources it includes, its assets and bundles), and it is the same
+      in every process.
+    """
+
+    return quote_etag(hashlib.md5(force_bytes('%s:%s:%s:' % key) + force_bytes(content)).hexdigest())
+
+
+def _validate(request, response, etag, last_modified):
+    """
+    Answers a conditional request with a 304 (or a 412), or sets the
+      validators (and the headers the page varies on) of the response.
+    """
+
+    conditional = get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+    if conditional is not response:
+        return conditional
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ('Accept-Language', 'Cookie'))
+    return response
+
+
+def serve(request, url_code=''):
+    """
+    Serves a resource of the current site, rendering its content as a
+      template. Rendered pages are cached per (url code, language, query
+      string). Only those pages (which do not depend on the visitor) get
+      validators: their content's ETag, and when they were rendered as
+      Last-Modified. A conditional request matching a cached page is
+      answered with a 304 without rendering anything; pages depending
+      on the visitor are always rendered, and never validated.
+    :param url_code: The url code of the resource ('' for the index).
+    :return: The response.
+    """
+
+    site_id = request.site.pk
+    resolved = resolution_cache.resolve(site_id, url_code)
+    if resolved is None or not resolved.enabled:
+        raise Http404
+
+    key = (url_code, get_language(), request.META.get('QUERY_STRING', ''))
+    cached = response_cache.get(site_id, key)
+    if cached is not MISSING and cached.updated_on == resolved.updated_on:
+        return _validate(request, HttpResponse(cached.content, content_type=cached.content_type),
+                         cached.etag, cached.last_modified)
+
+    generation = response_cache.generation(site_id)
+    template = template_cache.get_template(resolved.resource_id, resolved.updated_on)
+    asset_index.resolve_many(site_id, referenced_assets(template))
+    resource = SimpleLazyObject(lambda: SiteConcreteResource.objects.get(pk=resolved.resource_id))
+    response = HttpResponse(template.render({'resource': resource, 'site': request.site}, request))
+    if not _is_cacheable(request, response):
+        return response
+    # Rendered now: assets may have changed since the resource did.
+    cached = CachedResponse(resolved.updated_on, _etag(key, response.content), int(time.time()),
+                            response.content, response['Content-Type'])
+    response_cache.set(site_id, key, cached, generation)
+    return _validate(request, response, cached.etag, cached.last_modified)
+
+
+def metrics(request):
+    """
+    Exposes the metrics of this process in the Prometheus text format.
+      Only for the INTERNAL_IPS (e.g. the Prometheus server) and staff.
+    """
+
+    user = getattr(request, 'user', None)
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS and not (user and user.is_staff):
+        raise PermissionDenied
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import errno
+import glob
+import logging
+import os
+import time
+from datetime import datetime
+from threading import Lock, Thread
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+#######################################################################
+#
+# Visits are not required to be stored the very moment they happen.
+#   Setting MANYSITES_VISIT_BUFFER to 'memory' or 'spool' makes them be
+#   collected (in a list, or in an append-only file for the current
+#   process) and stored in batches by using bulk_create, once either
+#   MANYSITES_VISIT_BUFFER_SIZE rows are pending or the oldest pending
+#   row is older than MANYSITES_VISIT_BUFFER_AGE seconds (checked on
+#   each visit, and by a daemon thread, so idle processes flush too,
+#   unless MANYSITES_VISIT_BUFFER_TIMER is False). Anything left is
+#   flushed when the process exits, and the spool files of processes
+#   which died before are taken over by the first flush of another one.
+#
+# Setting it to 'queue' takes the database off the request path: visits
+#   are only appended to the spool file of the process, and a separate
+#   writer process (manage.py visitwriter) stores them (see VisitWriter).
+#
+#######################################################################
+
+
+SPOOL_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def max_attempts():
+    return getattr(settings, 'MANYSITES_VISIT_MAX_ATTEMPTS', 5)
+
+
+def quarantine(path):
+    """
+    Sets aside a spool file which could not be stored after
+      MANYSITES_VISIT_MAX_ATTEMPTS attempts, renaming it to .failed (so
+      it can be looked into, and stored by hand once fixed).
+    """
+
+    logger.error('Giving up on the visits of %s, set aside as .failed', path)
+    os.rename(path, '%s.failed' % path)
+
+
+class VisitBuffer(object):
+    """
+    Collects visits and stores them in batches.
+
+    Rows are dropped (and counted as such) when more than
+      MANYSITES_VISIT_BUFFER_MAX_ROWS are pending in memory, which
+      only happens when flushes keep failing. After
+      MANYSITES_VISIT_MAX_ATTEMPTS failed flushes in a row, the pending
+      rows are set aside in a .failed file (see `quarantine`).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._rows = []
+        self._pending = 0
+        self._oldest = None
+        self._backlog = (None, 0)
+        self._failures = 0
+        self._recovered = False
+        self._timer = None
+        self._stats = {
+            'pending_rows': 0,
+            'flushes': 0,
+            'flushed_rows': 0,
+            'failed_flushes': 0,
+            'dropped_rows': 0,
+            'recovered_files': 0,
+            'quarantined_rows': 0,
+            'last_batch_size': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+        }
+
+    @property
+    def mode(self):
+        return getattr(settings, 'MANYSITES_VISIT_BUFFER', None)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'MANYSITES_VISIT_BUFFER_SIZE', 100)
+
+    @property
+    def max_age(self):
+        return getattr(settings, 'MANYSITES_VISIT_BUFFER_AGE', 5)
+
+    @property
+    def max_rows(self):
+        return getattr(settings, 'MANYSITES_VISIT_BUFFER_MAX_ROWS', 10000)
+
+    @property
+    def spool_dir(self):
+        return getattr(settings, 'MANYSITES_VISIT_SPOOL_DIR',
+                       os.path.join(settings.BASE_DIR, 'spool', 'visits'))
+
+    def _spool_path(self):
+        return os.path.join(self.spool_dir, 'visits-%d.spool' % os.getpid())
+
+    def stats(self):
+        """
+        Returns a copy of the buffer's counters.
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_rows'] = self._pending
+            return stats
+
+    def add(self, resource_id, visited_from, visited_on=None):
+        """
+        Buffers a visit, flushing the buffer if a threshold was reached.
+        :param resource_id: The id of the visited concrete resource.
+        :param visited_from: The visitor's ip.
+        :param visited_on: The visit's date, or now if not given.
+        :return:
+        """
+
+        visited_on = visited_on or timezone.now()
+        with self._lock:
+            if self.mode == 'queue':
+                self._enqueue((resource_id, visited_on, visited_from))
+                return
+            self._ensure_timer()
+            if self.mode == 'spool':
+                try:
+                    self._spool((resource_id, visited_on, visited_from))
+                except (IOError, OSError):
+                    logger.exception('Could not spool a visit')
+                    self._stats['dropped_rows'] += 1
+                    return
+            elif self._pending >= self.max_rows:
+                self._stats['dropped_rows'] += 1
+                return
+            else:
+                self._rows.append((resource_id, visited_on, visited_from))
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+            must_flush = self._pending >= self.batch_size or time.time() - self._oldest >= self.max_age
+        if must_flush:
+            self.flush()
+
+    @property
+    def max_queue_bytes(self):
+        return getattr(settings, 'MANYSITES_VISIT_QUEUE_MAX_BYTES', 64 * 1024 * 1024)
+
+    def _backlog_bytes(self):
+        # The size of every file waiting for the writer, of every process,
+        #   checked at most once a second (not on each visit).
+        checked_on, size = self._backlog
+        current = time.time()
+        if checked_on is None or current - checked_on >= 1:
+            size = 0
+            for pattern in ('visits-*.spool', 'visits-*.spool.*.queued'):
+                for path in glob.glob(os.path.join(self.spool_dir, pattern)):
+                    try:
+                        size += os.path.getsize(path)
+                    except OSError:
+                        # Stored (or taken over) meanwhile.
+                        pass
+            self._backlog = (current, size)
+        return size
+
+    def _enqueue(self, row):
+        # Backpressure: when the writer falls behind, the backlog grows
+        #   until its limit, and visits are dropped from then on.
+        if self._backlog_bytes() >= self.max_queue_bytes:
+            self._stats['dropped_rows'] += 1
+            return
+        try:
+            self._spool(row)
+        except (IOError, OSError):
+            logger.exception('Could not queue a visit')
+            self._stats['dropped_rows'] += 1
+
+    def _spool(self, row):
+        path = self._spool_path()
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        with open(path, 'a') as spool:
+            spool.write(format_spool_row(*row))
+
+    def _take_rows(self):
+        """
+        Takes the pending rows out of the buffer. In spool mode, the
+          current spool file is renamed so new visits start a new one.
+        """
+
+        rows = self._rows
+        self._rows = []
+        self._pending = 0
+        self._oldest = None
+        if self.mode == 'spool':
+            path = self._spool_path()
+            if os.path.isfile(path):
+                os.rename(path, '%s.%d.flushing' % (path, int(time.time() * 1000000)))
+            rows = []
+            for flushing in sorted(glob.glob('%s.*.flushing' % path)):
+                with open(flushing) as spool:
+                    for line in spool:
+                        try:
+                            rows.append(parse_spool_row(line))
+                        except ValueError:
+                            # A partial write, e.g. of a process killed
+                            #   while spooling: nothing to retry.
+                            if line.strip():
+                                logger.error('Dropping a malformed spooled visit: %r', line)
+                                self._stats['dropped_rows'] += 1
+        return rows
+
+    def _tick(self):
+        while True:
+            time.sleep(max(self.max_age, 1))
+            with self._lock:
+                due = self._oldest is not None and time.time() - self._oldest >= self.max_age
+            if not due:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not flush the buffered visits')
+            finally:
+                connection.close()
+
+    def _ensure_timer(self):
+        # Starts the thread flushing the visits of idle processes.
+        if self._timer is not None or not getattr(settings, 'MANYSITES_VISIT_BUFFER_TIMER', True):
+            return
+        self._timer = Thread(target=self._tick, name='visit-buffer')
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _recover(self):
+        """
+        Takes over the spool files (pending or being flushed) of the
+          processes which are gone, as files being flushed by this one.
+          Processes recover one at a time, under a lock file.
+        """
+
+        if fcntl is None or not os.path.isdir(self.spool_dir):
+            return
+        with open(os.path.join(self.spool_dir, 'recover.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                taken_on = int(time.time() * 1000000)
+                for pattern in ('visits-*.spool', 'visits-*.spool.*.flushing'):
+                    for path in sorted(glob.glob(os.path.join(self.spool_dir, pattern))):
+                        try:
+                            pid = int(os.path.basename(path).split('.')[0][len('visits-'):])
+                        except ValueError:
+                            continue
+                        if pid == os.getpid() or _alive(pid):
+                            continue
+                        taken_on += 1
+                        os.rename(path, '%s.%d.flushing' % (self._spool_path(), taken_on))
+                        self._stats['recovered_files'] += 1
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def flush(self):
+        """
+        Stores all the pending visits with a single bulk_create.
+        :return: The number of stored rows.
+        """
+
+        # Queued visits are stored by the writer process.
+        if self.mode == 'queue':
+            return 0
+        # Only one flush at a time: a concurrent one would read the
+        #   same spool files, and there is nothing left for it anyway.
+        if not self._flush_lock.acquire(False):
+            return 0
+        try:
+            with self._lock:
+                if self.mode == 'spool' and not self._recovered:
+                    self._recovered = True
+                    self._recover()
+                rows = self._take_rows()
+            return self._store(rows) if rows else 0
+        finally:
+            self._flush_lock.release()
+
+    def _store(self, rows):
+        from .models import SiteConcreteResourceVisit
+
+        started = time.time()
+        try:
+            SiteConcreteResourceVisit.objects.bulk_create([
+                SiteConcreteResourceVisit(resource_id=resource_id, visited_on=visited_on, visited_from=visited_from)
+                for resource_id, visited_on, visited_from in rows
+            ], batch_size=self.batch_size)
+        except Exception:
+            logger.exception('Could not flush %d buffered visits', len(rows))
+            with self._lock:
+                self._stats['failed_flushes'] += 1
+                self._failures += 1
+                if self._failures >= max_attempts():
+                    self._failures = 0
+                    self._set_aside(rows)
+                elif self.mode != 'spool':
+                    # Put them back, as long as there is room for them.
+                    room = max(self.max_rows - self._pending, 0)
+                    self._stats['dropped_rows'] += max(len(rows) - room, 0)
+                    self._rows[:0] = rows[:room]
+                    self._pending += min(len(rows), room)
+                    if self._oldest is None:
+                        self._oldest = started
+            return 0
+
+        latency = time.time() - started
+        with self._lock:
+            self._failures = 0
+            if self.mode == 'spool':
+                for flushing in glob.glob('%s.*.flushing' % self._spool_path()):
+                    os.remove(flushing)
+            self._stats['flushes'] += 1
+            self._stats['flushed_rows'] += len(rows)
+            self._stats['last_batch_size'] = len(rows)
+            self._stats['last_flush_latency'] = latency
+            self._stats['max_flush_latency'] = max(self._stats['max_flush_latency'], latency)
+        return len(rows)
+
+    def _set_aside(self, rows):
+        # The spool files being flushed are set aside, or, in memory, the
+        #   rows are written to a new one.
+        self._stats['quarantined_rows'] += len(rows)
+        if self.mode == 'spool':
+            for flushing in glob.glob('%s.*.flushing' % self._spool_path()):
+                quarantine(flushing)
+            return
+        path = '%s.%d' % (self._spool_path(), int(time.time() * 1000000))
+        try:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            with open(path, 'w') as spool:
+                spool.writelines(format_spool_row(*row) for row in rows)
+            quarantine(path)
+        except (IOError, OSError):
+            logger.exception('Could not set aside %d buffered visits', len(rows))
+            self._stats['quarantined_rows'] -= len(rows)
+            self._stats['dropped_rows'] += len(rows)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def format_spool_row(resource_id, visited_on, visited_from):
+    if timezone.is_aware(visited_on):
+        visited_on = timezone.make_naive(visited_on, timezone.utc)
+    return '%d\t%s\t%s\n' % (resource_id, visited_on.strftime(SPOOL_DATE_FORMAT), visited_from)
+
+
+def parse_spool_row(line):
+    resource_id, visited_on, visited_from = line.rstrip('\n').split('\t')
+    visited_on = datetime.strptime(visited_on, SPOOL_DATE_FORMAT)
+    if settings.USE_TZ:
+        visited_on = timezone.make_aware(visited_on, timezone.utc)
+    return int(resource_id), visited_on, visited_from
+
+
+visit_buffer = VisitBuffer()
+
+
+class VisitWriter(object):
+    """
+    Drains the spool files of the 'queue' mode into the database, for
+      the writer process. Each drain takes the spool files over by
+      renaming them (their processes start new ones on their next visit),
+      and stores the files taken over at least SETTLE seconds before (so
+      a write in progress while renaming is not missed), each file with a
+      bulk_create. Files are only removed once stored: a failed batch is
+      retried on the next drain, up to MANYSITES_VISIT_MAX_ATTEMPTS times
+      (by default 5), and then set aside so the next ones go on.
+
+    Repeated visits to a resource from the same ip, within
+      MANYSITES_VISIT_DEDUPE_WINDOW seconds of the last one counted (by
+      default 0: none are discarded), are discarded as bursts.
+    """
+
+    SETTLE = 1.0
+
+    def __init__(self):
+        self._last_seen = {}
+        self._attempts = {}
+        self._stats = {
+            'drains': 0,
+            'written_rows': 0,
+            'deduped_rows': 0,
+            'failed_batches': 0,
+            'quarantined_files': 0,
+            'last_batch_size': 0,
+            'last_batch_latency': 0.0,
+            'backlog_files': 0,
+            'backlog_bytes': 0,
+            'lag': 0.0,
+        }
+
+    @property
+    def spool_dir(self):
+        return visit_buffer.spool_dir
+
+    @property
+    def dedupe_window(self):
+        return getattr(settings, 'MANYSITES_VISIT_DEDUPE_WINDOW', 0)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'MANYSITES_VISIT_WRITER_BATCH_SIZE', 1000)
+
+    def stats(self):
+        """
+        Returns a copy of the writer's counters. The backlog (files and
+          bytes waiting to be stored) and the lag (age, in seconds, of
+          the oldest of them) tell how far behind the writer is.
+        """
+
+        return dict(self._stats)
+
+    def _take_over(self):
+        for path in glob.glob(os.path.join(self.spool_dir, 'visits-*.spool')):
+            try:
+                os.rename(path, '%s.%d.queued' % (path, int(time.time() * 1000000)))
+            except OSError:
+                # Taken over by another writer.
+                pass
+
+    def _queued(self):
+        queued = []
+        for path in glob.glob(os.path.join(self.spool_dir, 'visits-*.spool.*.queued')):
+            try:
+                queued.append((int(path.rsplit('.', 2)[1]) / 1000000.0, path))
+            except ValueError:
+                continue
+        return sorted(queued)
+
+    def _dedupe(self, rows):
+        # Works on a copy of the last seen visits, kept only once the rows
+        #   are stored (a failed batch is deduped the same way when retried).
+        window = self.dedupe_window
+        if not window:
+            return rows, self._last_seen
+        last_seen = dict(self._last_seen)
+        kept = []
+        for resource_id, visited_on, visited_from in rows:
+            key = (resource_id, visited_from)
+            last = last_seen.get(key)
+            if last is not None and abs((visited_on - last).total_seconds()) < window:
+                continue
+            last_seen[key] = visited_on
+            kept.append((resource_id, visited_on, visited_from))
+        if kept:
+            # Forget the visitors not seen within the window.
+            horizon = max(visited_on for _, visited_on, _ in kept)
+            last_seen = dict((key, last) for key, last in last_seen.items()
+                             if (horizon - last).total_seconds() < window)
+        return kept, last_seen
+
+    def _store(self, path):
+        from .models import SiteConcreteResourceVisit
+
+        started = time.time()
+        try:
+            with open(path) as spool:
+                rows = [parse_spool_row(line) for line in spool if line.strip()]
+            kept, last_seen = self._dedupe(rows)
+            SiteConcreteResourceVisit.objects.bulk_create([
+                SiteConcreteResourceVisit(resource_id=resource_id, visited_on=visited_on, visited_from=visited_from)
+                for resource_id, visited_on, visited_from in kept
+            ], batch_size=self.batch_size)
+        except Exception:
+            logger.exception('Could not store the queued visits of %s', path)
+            self._stats['failed_batches'] += 1
+            self._attempts[path] = self._attempts.get(path, 0) + 1
+            if self._attempts[path] < max_attempts():
+                return False
+            del self._attempts[path]
+            quarantine(path)
+            self._stats['quarantined_files'] += 1
+            return True
+        self._attempts.pop(path, None)
+        os.remove(path)
+        self._last_seen = last_seen
+        self._stats['deduped_rows'] += len(rows) - len(kept)
+        self._stats['written_rows'] += len(kept)
+        self._stats['last_batch_size'] = len(kept)
+        self._stats['last_batch_latency'] = time.time() - started
+        return True
+
+    def drain(self):
+        """
+        Stores the queued visits that settled, and updates the backlog.
+        :return: The number of stored (or set aside) files.
+        """
+
+        if not os.path.isdir(self.spool_dir):
+            return 0
+        self._take_over()
+        stored = 0
+        current = time.time()
+        for taken_on, path in self._queued():
+            if current - taken_on < self.SETTLE:
+                break
+            if not self._store(path):
+                # Keep the order: retry on the next drain.
+                break
+            stored += 1
+        self._stats['drains'] += 1
+        backlog = self._queued()
+        self._stats['backlog_files'] = len(backlog)
+        self._stats['backlog_bytes'] = sum(os.path.getsize(path) for _, path in backlog)
+        self._stats['lag'] = time.time() - backlog[0][0] if backlog else 0.0
+        return stored
+
+
+@atexit.register
+def flush_at_exit():
+    try:
+        visit_buffer.flush()
+    except Exception:
+        logger.exception('Could not flush the buffered visits at exit')
@@ -42,10 +42,12 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'manysites.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sites.middleware.CurrentSiteMiddleware',
+    'manysites.middlewares.SiteRoutingMiddleware',
     'manysites.middlewares.SiteResourceVisitsLogger',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'captcha.middleware.CaptchaRequestMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -14,10 +14,14 @@ Including another URLconf
     2. Add a URL to urlpatterns:  url(r'^blog/', include('blog.urls'))
 """
 from django.conf import settings
-from django.conf.urls import url
+from django.conf.urls import url, include
 from django.conf.urls.static import static
 from django.contrib import admin
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    url(r'^captcha/', include('captcha.urls')),
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + [
+    # Site resources must come last: they match almost any url.
+    url(r'^', include('manysites.urls')),
+]